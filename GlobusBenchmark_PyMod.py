@@ -0,0 +1,290 @@
+'''
+GlobusBenchmark_PyMod.py
+
+Performance benchmark for GlobusDaemon that needs no live endpoints. Every run
+builds a synthetic acquisition tree of lux10* datasets, points the daemon at
+the fake Globus CLI and fake rsync target of GlobusFakeCLI_PyMod, and drives
+the daemon loop until every dataset has been transferred and freed. It reports:
+
+	- SyncFolders cycle time (first pass, mean, 95th percentile, max)
+	- submit-to-cleanup latency per dataset (from the state store's
+	  submit_time and freed_time)
+	- delete throughput (files/s and MB/s over all DeleteTree calls)
+	- how many Globus CLI calls (or REST API calls, and connections) were
+	  made, by command
+
+	results = RunBenchmark(1000,files_per_dataset=10,cli_latency=0.05,transfer_sec=5)
+	PrintResults([results])
+
+With transport='rest' the daemon talks to the fake Transfer API of
+GlobusFakeCLI_PyMod through GlobusRESTTransport instead of to the fake CLI.
+
+Run this module directly for the 10, 1k and 10k dataset suite (or other sizes):
+
+	python GlobusBenchmark_PyMod.py [n_datasets ...]
+
+20261017 - Created
+20261017 - The daemon loop also finishes the jobs of the background cleanup queue
+20261017 - Options to run with destination verification
+20261017 - Endpoint credential checks scaled to pass_interval; credential_sec to make the
+				fake credentials expire during a run
+20261017 - transport option, to run against the fake Transfer REST API
+'''
+
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from GlobusDelete_PyMod import MakeSyntheticTree
+from GlobusFakeCLI_PyMod import ConfigureFakeCLI, WriteFakeCommands, StartFakeTransferAPI
+from GlobusMetrics_PyMod import GetRegistry
+from GlobusScheduler_PyMod import AdaptivePoller
+from GlobusSession_PyMod import SetSSHCommand, GetGlobusPool
+from GlobusTransport_PyMod import MakeTransport
+from SyncGlobus_PyMod import GlobusDaemon
+
+DATASET_PREFIX = 'lux10'
+INCOMING_FLAG = 'incoming_data_complete'
+OUTGOING_FLAG = 'outgoing_transfer_done'
+DELETE_FLAGS = ('delete_dat_files','no_dp','no_event_build')
+
+def MakeAcquisitionTree(root,n_datasets,files_per_dataset=10,file_size=1024,delete_fraction=0.,
+	complete=True,start_time=datetime.datetime(2014,10,10,12,0),seed=0):
+	'''
+	Create n_datasets lux10_YYYYMMDDTHHMM datasets (one minute apart) under
+	root, each with files_per_dataset .dat files of file_size bytes and a
+	.log file. Finished datasets get the incoming data complete flag and a
+	delete_fraction of them also get the delete_dat_files/no_dp/no_event_build
+	flags. Returns the dataset names.
+	'''
+	rng = random.Random(seed)
+	datasets = []
+	for i in range(n_datasets):
+		name = '%s_%s' % (DATASET_PREFIX,(start_time + datetime.timedelta(minutes=i)).strftime('%Y%m%dT%H%M'))
+		path = MakeSyntheticTree(os.path.join(root,name),files_per_dataset,file_size)
+		open(os.path.join(path,'%s.log' % name),'w').write('synthetic dataset %d\n' % i)
+		if complete:
+			open(os.path.join(path,INCOMING_FLAG),'w').close()
+		if rng.random() < delete_fraction:
+			for flag in DELETE_FLAGS:
+				open(os.path.join(path,flag),'w').close()
+		datasets.append(name)
+	return datasets
+
+def MakeBenchmarkDaemon(work_dir,source_root,destination_root,ssh_command,rsync_command,pass_interval=1.,
+	transport='cli'):
+	'''
+	A GlobusDaemon on source_root with its waits scaled down to
+	pass_interval, so a benchmark run takes seconds instead of hours.
+	'''
+	daemon = GlobusDaemon('lux#bench_src','lux#bench_dst','true',source_root,'lux','localhost',
+		destination_root,INCOMING_FLAG,OUTGOING_FLAG,execute_delete_dat_files=True,watch_mode='off',
+		state_db_path=os.path.join(work_dir,'state.sqlite'),transport=transport)
+	daemon.sleep_time_sec = pass_interval
+	daemon.rsync_timeout = pass_interval
+	daemon.rsync_command = rsync_command
+	daemon.wait_for_delete_dat_files_flag = 0
+	daemon.submit_batch_window_sec = 0
+	daemon.poll_slack_sec = pass_interval/2.
+	daemon.poller = AdaptivePoller(min_interval=pass_interval/2.,max_interval=pass_interval*10,
+		default_interval=pass_interval)
+	daemon.cleanup_poll_sec = min(daemon.cleanup_poll_sec,pass_interval/4.)
+	daemon.quiescence_interval_sec = pass_interval
+	daemon.destination_ssh_command = ssh_command
+	daemon.endpoint_check_sec = pass_interval*5
+	daemon.endpoint_retry_sec = pass_interval
+	daemon.endpoints.ttl = daemon.endpoint_check_sec
+	return daemon
+
+def RunDaemon(daemon,timeout,done=None):
+	'''
+	The start_daemon loop (without a watcher) for at most timeout seconds,
+	or until done() is true. Returns the duration of every SyncFolders pass.
+	'''
+	pass_seconds = []
+	deadline = time.time() + timeout
+	next_pass = 0.
+	daemon.CheckEndpoints()
+	while time.time() < deadline and not (done is not None and done()):
+		if time.time() >= next_pass:
+			start = time.time()
+			daemon.SyncFolders()
+			pass_seconds.append(time.time() - start)
+			next_pass = time.time() + daemon.PassInterval(None)
+
+		daemon.scheduler.RunDue()
+		daemon.cleanup_queue.ProcessCompleted()
+
+		wait = min(next_pass,deadline) - time.time()
+		time_until_timer = daemon.scheduler.TimeUntilNext()
+		if time_until_timer is not None:
+			wait = min(wait,time_until_timer)
+		if daemon.cleanup_queue.Pending():
+			wait = min(wait,daemon.cleanup_poll_sec)
+		if wait > 0:
+			time.sleep(wait)
+	return pass_seconds
+
+def _Percentile(values,fraction):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values)-1,int(fraction*len(values)))]
+
+def _Mean(values):
+	if not values:
+		return None
+	return sum(values)/float(len(values))
+
+def _MetricsSnapshot():
+	'''
+	The registry values the benchmark reports on, to diff before/after a run.
+	'''
+	registry = GetRegistry()
+	delete_seconds = registry.histograms.get('globus_delete_seconds',dict()).get(())
+	cli_calls = dict()
+	for (labels,histogram) in registry.histograms.get('globus_cli_seconds',dict()).items():
+		cli_calls[dict(labels).get('command')] = histogram.count
+	for (labels,histogram) in registry.histograms.get('globus_rest_seconds',dict()).items():
+		cli_calls['rest:%s' % dict(labels).get('call')] = histogram.count
+	return dict(deleted_files=registry.counters.get('globus_deleted_files_total',dict()).get((),0),
+		deleted_bytes=registry.counters.get('globus_deleted_bytes_total',dict()).get((),0),
+		delete_seconds=delete_seconds.sum if delete_seconds is not None else 0.,
+		cli_calls=cli_calls,
+		rest_connections=registry.counters.get('globus_rest_connections_total',dict()).get((),0))
+
+def RunBenchmark(n_datasets,files_per_dataset=10,file_size=1024,delete_fraction=0.1,
+	cli_latency=0.05,connect_latency=0.5,transfer_sec=5.,pass_interval=1.,timeout=3600,
+	verify_destination=False,verify_checksums=False,credential_sec=264*3600,transport='cli',
+	base_dir=None,keep=False):
+	'''
+	Build a tree of n_datasets datasets, run the daemon against the fake CLI
+	until they are all freed (or timeout) and return a results dictionary.
+	verify_destination/verify_checksums turn on the daemon's check of each
+	finished transfer against the (local) destination. The fake endpoint
+	credentials last credential_sec seconds; the daemon renews them once
+	half of that is left. transport is 'cli' or 'rest' (the fake Transfer
+	API, with the same latencies).
+	The daemon's output goes to daemon.log in the work directory, which is
+	removed afterwards unless keep is set.
+	'''
+	work_dir = tempfile.mkdtemp(prefix='globus_bench_%d_' % n_datasets,dir=base_dir)
+	source_root = os.path.join(work_dir,'source')
+	destination_root = os.path.join(work_dir,'destination')
+	os.mkdir(destination_root)
+
+	(ssh_command,rsync_command) = WriteFakeCommands(os.path.join(work_dir,'bin'))
+	ConfigureFakeCLI(os.path.join(work_dir,'globus'),cli_latency=cli_latency,
+		connect_latency=connect_latency,transfer_sec=transfer_sec,copy_data=verify_destination,
+		credential_sec=credential_sec)
+	SetSSHCommand(ssh_command)
+	server = None
+	if transport == 'rest':
+		server = StartFakeTransferAPI()
+		transport = MakeTransport('rest','lux',base_url=server.URL())
+
+	start = time.time()
+	datasets = MakeAcquisitionTree(source_root,n_datasets,files_per_dataset,file_size,delete_fraction)
+	tree_seconds = time.time() - start
+
+	def Drained():
+		return not [d for d in os.listdir(source_root) if d.startswith(DATASET_PREFIX)] and \
+			not daemon.cleanup_queue.Pending()
+
+	before = _MetricsSnapshot()
+	stdout = sys.stdout
+	log = open(os.path.join(work_dir,'daemon.log'),'w')
+	sys.stdout = log
+	try:
+		daemon = MakeBenchmarkDaemon(work_dir,source_root,destination_root,ssh_command,rsync_command,pass_interval,
+			transport)
+		daemon.verify_destination = verify_destination
+		daemon.verify_checksums = verify_checksums
+		daemon.endpoints.refresh_margin = min(daemon.endpoints.refresh_margin,credential_sec/2.)
+		start = time.time()
+		pass_seconds = RunDaemon(daemon,timeout,Drained)
+		run_seconds = time.time() - start
+	finally:
+		sys.stdout = stdout
+		log.close()
+	after = _MetricsSnapshot()
+
+	submit_to_cleanup = []
+	for d in datasets:
+		row = daemon.state_store.GetDataset(d)
+		if row is not None and row['submit_time'] and row['freed_time']:
+			submit_to_cleanup.append(row['freed_time'] - row['submit_time'])
+	daemon.state_store.Close()
+	# The fake ssh goes away with the work directory
+	GetGlobusPool().CloseAll()
+	daemon.transport.Close()
+	if server is not None:
+		server.shutdown()
+		server.server_close()
+
+	deleted_files = after['deleted_files'] - before['deleted_files']
+	deleted_bytes = after['deleted_bytes'] - before['deleted_bytes']
+	delete_seconds = after['delete_seconds'] - before['delete_seconds']
+	cli_calls = dict([(command,count - before['cli_calls'].get(command,0))
+		for (command,count) in after['cli_calls'].items() if count > before['cli_calls'].get(command,0)])
+
+	results = dict(n_datasets=n_datasets,files_per_dataset=files_per_dataset,file_size=file_size,
+		tree_seconds=tree_seconds,run_seconds=run_seconds,
+		remaining=len([d for d in os.listdir(source_root) if d.startswith(DATASET_PREFIX)]),
+		passes=len(pass_seconds),first_pass_seconds=pass_seconds[0] if pass_seconds else None,
+		pass_mean_seconds=_Mean(pass_seconds),pass_p95_seconds=_Percentile(pass_seconds,0.95),
+		pass_max_seconds=max(pass_seconds) if pass_seconds else None,
+		latency_n=len(submit_to_cleanup),latency_mean_seconds=_Mean(submit_to_cleanup),
+		latency_p50_seconds=_Percentile(submit_to_cleanup,0.5),
+		latency_p95_seconds=_Percentile(submit_to_cleanup,0.95),
+		latency_max_seconds=max(submit_to_cleanup) if submit_to_cleanup else None,
+		deleted_files=deleted_files,deleted_bytes=deleted_bytes,delete_seconds=delete_seconds,
+		delete_files_per_sec=deleted_files/delete_seconds if delete_seconds > 0 else None,
+		delete_bytes_per_sec=deleted_bytes/delete_seconds if delete_seconds > 0 else None,
+		cli_calls=cli_calls,rest_connections=after['rest_connections'] - before['rest_connections'],
+		work_dir=work_dir if keep else None)
+
+	if not keep:
+		shutil.rmtree(work_dir,ignore_errors=True)
+	return results
+
+def _Format(value,format='%.3f'):
+	if value is None:
+		return '-'
+	return format % value
+
+def PrintResults(all_results):
+	print '%9s %8s %7s %9s %9s %9s %9s %9s %9s %9s %11s %8s  %s' % ('datasets','run s','passes',
+		'first s','mean s','p95 s','max s','lat p50','lat p95','lat max','del files/s','del MB/s','Globus calls')
+	for r in all_results:
+		print '%9d %8.1f %7d %9s %9s %9s %9s %9s %9s %9s %11s %8s  %s%s' % (r['n_datasets'],r['run_seconds'],
+			r['passes'],_Format(r['first_pass_seconds']),_Format(r['pass_mean_seconds']),
+			_Format(r['pass_p95_seconds']),_Format(r['pass_max_seconds']),
+			_Format(r['latency_p50_seconds'],'%.1f'),_Format(r['latency_p95_seconds'],'%.1f'),
+			_Format(r['latency_max_seconds'],'%.1f'),_Format(r['delete_files_per_sec'],'%.0f'),
+			_Format(r['delete_bytes_per_sec'] and r['delete_bytes_per_sec']/1e6,'%.1f'),
+			' '.join(['%s=%d' % item for item in sorted(r['cli_calls'].items())] +
+				(['connections=%d' % r['rest_connections']] if r.get('rest_connections') else [])),
+			'  (%d datasets left at timeout)' % r['remaining'] if r['remaining'] else '')
+
+def RunBenchmarkSuite(scales=(10,1000,10000),**kwargs):
+	'''
+	RunBenchmark at each number of datasets in scales and print a table.
+	'''
+	all_results = []
+	for n_datasets in scales:
+		print '%s: benchmarking %d datasets...' % (time.ctime(),n_datasets)
+		sys.stdout.flush()
+		all_results.append(RunBenchmark(n_datasets,**kwargs))
+	PrintResults(all_results)
+	return all_results
+
+if __name__ == '__main__':
+	scales = [int(x) for x in sys.argv[1:]]
+	if scales:
+		RunBenchmarkSuite(scales)
+	else:
+		RunBenchmarkSuite()
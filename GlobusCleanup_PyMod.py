@@ -0,0 +1,215 @@
+'''
+GlobusCleanup_PyMod.py
+
+The final step of a dataset, off the main loop: the rsync that carries the
+log and flag files over (and removes them from the source), then the deletion
+of what is left.
+
+RunRsync streams rsync's output with select() instead of reading it line by
+line, so it can enforce real deadlines (an overall one, and a stall timeout
+for when nothing has been printed for a while) and kill rsync when they pass.
+The --progress output is parsed into bytes and bytes/s as it arrives.
+
+	result = RunRsync(['rsync','-aP','/data/lux10_foo','lux@dest:/data/'],timeout=600,stall_timeout=90)
+	if result.Succeeded():
+		...
+
+CleanupQueue runs these jobs on a bounded number of background threads and
+hands the results back to the daemon's own thread, so one slow destination
+doesn't hold up the sync loop and all state changes still happen in one place.
+
+	queue = CleanupQueue(workers=4)
+	queue.Submit('lux10_foo',RunRsync,(args,600,90),daemon.FinishCleanupRsync)
+	...
+	queue.ProcessCompleted()	# in the main loop: runs FinishCleanupRsync('lux10_foo',result,error)
+
+20261017 - Created
+'''
+
+import os
+import re
+import select
+import time
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT
+from GlobusExecutor_PyMod import GlobusCLIExecutor
+
+# "     32,768  45%   12.34MB/s    0:00:01 (xfr#3, to-chk=7/12)"
+_PROGRESS_RE = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kKMGT]?B)/s')
+_RATE_UNITS = {'B':1,'kB':1024,'KB':1024,'MB':1024**2,'GB':1024**3,'TB':1024**4}
+
+class RsyncProgress:
+	'''
+	Running totals from rsync --progress lines.
+	'''
+
+	def __init__(self):
+		self.files = 0
+		self.completed_bytes = 0
+		self.current_bytes = 0
+		self.rate = None
+		self.updates = 0
+
+	def Feed(self,line):
+		'''
+		Take one progress update (rsync separates them with \\r). Returns True
+		if it was one.
+		'''
+		match = _PROGRESS_RE.match(line)
+		if match is None:
+			return False
+		self.updates += 1
+		n_bytes = int(match.group(1).replace(',',''))
+		self.rate = float(match.group(3))*_RATE_UNITS.get(match.group(4),1)
+		if 'xfr#' in line:
+			# This file is done
+			self.files += 1
+			self.completed_bytes += n_bytes
+			self.current_bytes = 0
+		else:
+			self.current_bytes = n_bytes
+		return True
+
+	def Bytes(self):
+		return self.completed_bytes + self.current_bytes
+
+class RsyncResult:
+	'''
+	How a RunRsync call went.
+	'''
+
+	def __init__(self,args):
+		self.args = args
+		self.returncode = None
+		self.timed_out = None	# None, 'deadline' or 'stalled'
+		self.seconds = 0.
+		self.progress = RsyncProgress()
+		self.output_tail = deque(maxlen=20)
+
+	def Succeeded(self):
+		return self.returncode == 0 and self.timed_out is None
+
+	def BytesPerSec(self):
+		'''
+		Average over the whole run, falling back on rsync's last reported rate.
+		'''
+		if self.seconds > 0 and self.progress.Bytes():
+			return self.progress.Bytes()/self.seconds
+		return self.progress.rate
+
+	def __str__(self):
+		if self.timed_out:
+			status = 'killed (%s)' % self.timed_out
+		else:
+			status = 'exit code %s' % self.returncode
+		rate = self.BytesPerSec()
+		return '%s: %d files, %.1f MB in %.1f s%s' % (status,self.progress.files,self.progress.Bytes()/1e6,
+			self.seconds,' (%.1f MB/s)' % (rate/1e6) if rate else '')
+
+def _Kill(p):
+	try:
+		p.kill()
+	except OSError:
+		pass
+
+def RunRsync(args,timeout=None,stall_timeout=None):
+	'''
+	Run rsync (argument list) and stream its output. It is killed once it
+	has run for timeout seconds or printed nothing for stall_timeout
+	seconds. Returns an RsyncResult.
+	'''
+	result = RsyncResult(args)
+	start = time.time()
+	p = Popen(args, stdout=PIPE, stderr=STDOUT, close_fds=True)
+	fd = p.stdout.fileno()
+	last_output = start
+	pending = ''
+
+	while True:
+		now = time.time()
+		wait = 1.
+		if timeout:
+			if now - start >= timeout:
+				result.timed_out = 'deadline'
+				break
+			wait = min(wait,start + timeout - now)
+		if stall_timeout:
+			if now - last_output >= stall_timeout:
+				result.timed_out = 'stalled'
+				break
+			wait = min(wait,last_output + stall_timeout - now)
+
+		try:
+			(ready,unused,unused) = select.select([fd],[],[],wait)
+		except select.error:
+			# Interrupted by a signal
+			continue
+		if not ready:
+			continue
+
+		data = os.read(fd,65536)
+		if not data:
+			break
+		last_output = time.time()
+
+		# Progress updates end in \r, everything else in \n
+		lines = re.split('[\r\n]',pending + data)
+		pending = lines.pop()
+		for line in lines:
+			if line.strip() and not result.progress.Feed(line):
+				result.output_tail.append(line)
+
+	if pending.strip() and not result.progress.Feed(pending):
+		result.output_tail.append(pending)
+
+	if result.timed_out:
+		_Kill(p)
+	p.stdout.close()
+	result.returncode = p.wait()
+	result.seconds = time.time() - start
+	return result
+
+class CleanupQueue:
+	'''
+	Runs cleanup jobs on up to `workers` background threads. Each job has a
+	key (the dataset) and at most one job per key is in flight. Callbacks
+	run in whichever thread calls ProcessCompleted, as
+	callback(key,result,error) with error the exception text or None.
+	'''
+
+	def __init__(self,workers=4):
+		self.workers = workers
+		self.executor = GlobusCLIExecutor(max_workers=workers,call_timeout=None)
+		self.jobs = dict()
+
+	def Submit(self,key,function,args=(),callback=None):
+		'''
+		Queue function(*args). Returns False if a job for key is in flight.
+		'''
+		if key in self.jobs:
+			return False
+		self.jobs[key] = (self.executor.SubmitTimed(None,function,*args),callback)
+		return True
+
+	def InFlight(self,key):
+		return key in self.jobs
+
+	def Pending(self):
+		return len(self.jobs)
+
+	def ProcessCompleted(self):
+		'''
+		Run the callbacks of the jobs that finished. Returns how many.
+		'''
+		finished = [key for key,(future,callback) in self.jobs.items() if future.Done()]
+		for key in finished:
+			(future,callback) = self.jobs.pop(key)
+			error = None
+			if future.exc_info is not None:
+				error = '%s: %s' % (future.exc_info[0].__name__,future.exc_info[1])
+			if callback is not None:
+				callback(key,future.result,error)
+		return len(finished)
+
+	def Shutdown(self):
+		self.executor.Shutdown()
@@ -0,0 +1,256 @@
+'''
+GlobusDatasetIndex_PyMod.py
+
+One-pass index of what is in a dataset directory. GlobusDaemon used to glob
+each dataset up to five times per pass (incoming flag, the three deletion
+flags and the globus_transfer_* marker), and every glob is a full readdir of a
+folder that may hold tens of thousands of .dat files. Here one scandir pass
+records the names in it (file sizes are only looked up once the dataset is
+complete), and the result is reused until the directory's mtime changes, so
+an unchanged dataset costs one stat per lookup and a dataset still being
+written at most one listing per pass.
+
+	index_cache = DatasetIndexCache(source_root,[incoming_flag,'delete_dat_files'])
+	index = index_cache.Get('lux10_20141010T1200')
+	if index.HasFlag(incoming_flag): ...
+	index.transfer_id, index.n_files, index.TotalBytes()
+
+20261017 - Created
+20261017 - Names only until the dataset is complete, sizes looked up lazily; a directory
+				that keeps changing is listed once per pass instead of on every lookup. The
+				newest transfer marker wins if there are several.
+'''
+
+import os
+import re
+import stat
+import time
+from fnmatch import fnmatch
+
+# os.scandir is only in Python 3.5+, the scandir package backports it. Fall
+# back to listdir + lstat if neither is around.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+TRANSFER_ID_REGEX = re.compile('\w{8}-\w{4}-\w{4}-\w{4}-\w{12}$')
+
+# A directory modified less than this long before it was scanned may change
+# again without its mtime moving, so such an index is rescanned (once per
+# pass) until it is older than that.
+RACY_MTIME_SEC = 1.
+
+def _ListNames(path):
+	'''
+	Yields (name,is_dir) for everything in path, without a stat per entry.
+	is_dir is None where the directory type isn't known for free (no
+	scandir).
+	'''
+	if scandir is not None:
+		for entry in scandir(path):
+			try:
+				is_dir = entry.is_dir()
+			except OSError:
+				# Deleted while we were looking
+				continue
+			yield entry.name, is_dir
+	else:
+		for name in os.listdir(path):
+			yield name, None
+
+def _GlobMatch(name,pattern):
+	# Like glob: wildcards don't match hidden files unless the pattern does
+	if name.startswith('.') and not pattern.startswith('.'):
+		return False
+	return fnmatch(name,pattern)
+
+class DatasetIndex:
+	'''
+	Snapshot of one dataset directory: flags present, transfer marker and
+	file names. File sizes (TotalBytes, DatBytes) take a stat per file, so
+	they are only looked up when asked for, once per snapshot, and only once
+	the dataset has its size_flag (if given): until then it is still being
+	written and its size means nothing.
+	'''
+
+	def __init__(self,dataset,path,flag_patterns,marker_prefix='globus_transfer_',size_flag=None):
+		self.dataset = dataset
+		self.path = path
+		self.size_flag = size_flag
+		self.mtime = None
+		self.scan_time = None
+		self.checked_pass = None
+		self.flags = dict()
+		self.transfer_marker = None
+		self.transfer_id = None
+		self.names = []
+		self.n_files = 0
+		self.n_dat_files = 0
+		self.sizes = None
+
+		self.Scan(flag_patterns,marker_prefix)
+
+	def Scan(self,flag_patterns,marker_prefix):
+		self.scan_time = time.time()
+		self.mtime = os.stat(self.path).st_mtime
+
+		self.flags = dict([(pattern,[]) for pattern in flag_patterns])
+		markers = []
+		for name,is_dir in _ListNames(self.path):
+			if is_dir:
+				continue
+			self.names.append(name)
+			self.n_files += 1
+			if name.endswith('.dat'):
+				self.n_dat_files += 1
+				continue
+
+			if name.startswith(marker_prefix) and TRANSFER_ID_REGEX.search(name):
+				markers.append(name)
+
+			for pattern in flag_patterns:
+				if _GlobMatch(name,pattern):
+					self.flags[pattern].append(name)
+
+		self.transfer_marker = self._NewestMarker(markers)
+		if self.transfer_marker is not None:
+			self.transfer_id = TRANSFER_ID_REGEX.findall(self.transfer_marker)[0]
+
+	def _NewestMarker(self,markers):
+		# There should be one, but if a dataset has several (e.g. a
+		# resubmission interrupted halfway) take the newest, then the last
+		# by name, whatever order the directory lists them in
+		if len(markers) < 2:
+			return markers[0] if markers else None
+		def Key(name):
+			try:
+				return (os.lstat(os.path.join(self.path,name)).st_mtime,name)
+			except OSError:
+				return (0,name)
+		return max(markers,key=Key)
+
+	def _Sizes(self):
+		if self.sizes is None:
+			total_bytes = 0
+			dat_bytes = 0
+			for name in self.names:
+				try:
+					st = os.lstat(os.path.join(self.path,name))
+				except OSError:
+					continue
+				if stat.S_ISDIR(st.st_mode):
+					continue
+				total_bytes += st.st_size
+				if name.endswith('.dat'):
+					dat_bytes += st.st_size
+			self.sizes = (total_bytes,dat_bytes)
+		return self.sizes
+
+	def HasSizes(self):
+		return self.size_flag is None or self.HasFlag(self.size_flag)
+
+	def TotalBytes(self):
+		'''
+		Bytes in the dataset's files, None until it has its size_flag.
+		'''
+		if not self.HasSizes():
+			return None
+		return self._Sizes()[0]
+
+	def DatBytes(self):
+		if not self.HasSizes():
+			return None
+		return self._Sizes()[1]
+
+	def HasFlag(self,pattern):
+		'''
+		True if a file matching pattern (which may have wildcards) was found.
+		'''
+		if pattern in self.flags:
+			return len(self.flags[pattern]) > 0
+		# Not one of the patterns indexed up front
+		return os.path.exists(os.path.join(self.path,pattern))
+
+	def IsStale(self,pass_number=None):
+		'''
+		True if the directory changed since the scan. A directory that was
+		modified right before it was scanned is stale too, but only the first
+		time it is asked about in a pass.
+		'''
+		try:
+			mtime = os.stat(self.path).st_mtime
+		except OSError:
+			return True
+		if mtime != self.mtime:
+			return True
+		if pass_number is not None and self.checked_pass == pass_number:
+			return False
+		return self.scan_time - self.mtime < RACY_MTIME_SEC
+
+class DatasetIndexCache:
+	'''
+	Keeps one DatasetIndex per dataset under root and rebuilds it only when
+	the dataset directory's mtime changes, and at most once per pass for a
+	directory that keeps changing. ListDatasets starts a new pass. File sizes
+	are only looked up for datasets with size_flag.
+	'''
+
+	def __init__(self,root,flag_patterns,marker_prefix='globus_transfer_',size_flag=None):
+		self.root = root
+		self.flag_patterns = list(flag_patterns)
+		self.marker_prefix = marker_prefix
+		self.size_flag = size_flag
+		self.indexes = dict()
+		self.scans = 0
+		self.pass_number = 0
+
+	def ListDatasets(self,prefix='lux10'):
+		'''
+		Dataset directories in root. Only names with the right prefix are
+		looked at, and scandir tells directories apart without a stat.
+		'''
+		self.NewPass()
+		dataset_list = []
+		if scandir is not None:
+			for entry in scandir(self.root):
+				if not entry.name.startswith(prefix):
+					continue
+				try:
+					if entry.is_dir():
+						dataset_list.append(entry.name)
+				except OSError:
+					continue
+		else:
+			dataset_list = [x for x in os.listdir(self.root) if x.startswith(prefix) and os.path.isdir(os.path.join(self.root,x))]
+
+		self.Prune(dataset_list)
+		return dataset_list
+
+	def NewPass(self):
+		self.pass_number += 1
+
+	def Get(self,dataset):
+		index = self.indexes.get(dataset)
+		if index is None or index.IsStale(self.pass_number):
+			index = DatasetIndex(dataset,os.path.join(self.root,dataset),self.flag_patterns,
+				self.marker_prefix,self.size_flag)
+			self.indexes[dataset] = index
+			self.scans += 1
+		index.checked_pass = self.pass_number
+		return index
+
+	def Invalidate(self,dataset):
+		self.indexes.pop(dataset,None)
+
+	def Prune(self,dataset_list):
+		'''
+		Forget datasets that no longer exist.
+		'''
+		keep = set(dataset_list)
+		for dataset in self.indexes.keys():
+			if dataset not in keep:
+				del self.indexes[dataset]
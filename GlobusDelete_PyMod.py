@@ -0,0 +1,244 @@
+'''
+GlobusDelete_PyMod.py
+
+In-process deletion of dataset directories. A dataset can hold a very large
+number of .dat files and `rm -r` unlinks them one at a time, so how fast the
+acquisition disk frees up depends on how fast we can unlink. DeleteTree walks
+the tree with scandir and hands the files to a small pool of threads, reports
+files/s and bytes freed, and can be rate limited so the live DAQ writes don't
+get starved of disk.
+
+	stats = DeleteTree('/data/lux10_20141010T1200',workers=8,max_bytes_per_sec=500e6)
+	print stats
+
+Run this module directly to compare against `rm -r` on synthetic trees:
+
+	python GlobusDelete_PyMod.py [n_files] [file_size_bytes] [workers]
+
+20261017 - Created
+'''
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from Queue import Queue
+
+# os.scandir is only in Python 3.5+, the scandir package backports it
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+class DeleteStats:
+	'''
+	What a DeleteTree call did and how fast.
+	'''
+
+	def __init__(self,path):
+		self.path = path
+		self.files = 0
+		self.dirs = 0
+		self.bytes = 0
+		self.seconds = 0.
+		self.errors = []
+		self._lock = threading.Lock()
+
+	def AddFiles(self,n_files,n_bytes):
+		with self._lock:
+			self.files += n_files
+			self.bytes += n_bytes
+
+	def AddError(self,path,e):
+		with self._lock:
+			self.errors.append((path,str(e)))
+
+	def FilesPerSec(self):
+		if self.seconds <= 0:
+			return 0.
+		return self.files/self.seconds
+
+	def BytesPerSec(self):
+		if self.seconds <= 0:
+			return 0.
+		return self.bytes/self.seconds
+
+	def __str__(self):
+		return '%s: %d files, %d dirs, %.1f MB freed in %.2f s (%.0f files/s, %.1f MB/s)%s' % \
+			(self.path,self.files,self.dirs,self.bytes/1e6,self.seconds,self.FilesPerSec(),
+			self.BytesPerSec()/1e6,', %d errors' % len(self.errors) if self.errors else '')
+
+class RateLimiter:
+	'''
+	Paces deletions to at most max_files_per_sec and/or max_bytes_per_sec.
+	Wait() blocks the caller until it may delete one more file of that size.
+	'''
+
+	def __init__(self,max_files_per_sec=None,max_bytes_per_sec=None):
+		self.max_files_per_sec = max_files_per_sec
+		self.max_bytes_per_sec = max_bytes_per_sec
+		self.start = time.time()
+		self.files = 0
+		self.bytes = 0
+
+	def Wait(self,size):
+		self.files += 1
+		self.bytes += size
+		delay = 0.
+		elapsed = time.time() - self.start
+		if self.max_files_per_sec:
+			delay = max(delay,self.files/float(self.max_files_per_sec) - elapsed)
+		if self.max_bytes_per_sec:
+			delay = max(delay,self.bytes/float(self.max_bytes_per_sec) - elapsed)
+		if delay > 0:
+			time.sleep(delay)
+
+def _Walk(path):
+	'''
+	Yields ('file',path,size) for every non-directory and ('dir',path,depth)
+	for every directory under (and including) path.
+	'''
+	stack = [(path,0)]
+	while stack:
+		(dirpath,depth) = stack.pop()
+		yield 'dir', dirpath, depth
+		if scandir is not None:
+			for entry in scandir(dirpath):
+				try:
+					if entry.is_dir(follow_symlinks=False):
+						stack.append((entry.path,depth+1))
+					else:
+						yield 'file', entry.path, entry.stat(follow_symlinks=False).st_size
+				except OSError:
+					continue
+		else:
+			for name in os.listdir(dirpath):
+				full_path = os.path.join(dirpath,name)
+				try:
+					st = os.lstat(full_path)
+				except OSError:
+					continue
+				if stat.S_ISDIR(st.st_mode):
+					stack.append((full_path,depth+1))
+				else:
+					yield 'file', full_path, st.st_size
+
+def DeleteTree(path,workers=8,max_files_per_sec=None,max_bytes_per_sec=None):
+	'''
+	Recursively delete path with a pool of unlink threads. Returns a
+	DeleteStats; errors are collected in stats.errors rather than raised.
+	'''
+	stats = DeleteStats(path)
+	start = time.time()
+
+	# Files go to the threads in batches to keep the queue overhead down
+	work = Queue(maxsize=workers*4)
+	limiter = RateLimiter(max_files_per_sec,max_bytes_per_sec)
+	rate_limited = max_files_per_sec or max_bytes_per_sec
+	batch_size = 16 if rate_limited else 512
+
+	def Unlinker():
+		while True:
+			batch = work.get()
+			if batch is None:
+				return
+			n_files = 0
+			n_bytes = 0
+			for (file_path,size) in batch:
+				try:
+					os.unlink(file_path)
+					n_files += 1
+					n_bytes += size
+				except OSError,e:
+					stats.AddError(file_path,e)
+			stats.AddFiles(n_files,n_bytes)
+
+	threads = [threading.Thread(target=Unlinker) for i in range(max(1,workers))]
+	for t in threads:
+		t.daemon = True
+		t.start()
+
+	directories = []
+	batch = []
+	try:
+		for (kind,item_path,extra) in _Walk(path):
+			if kind == 'dir':
+				directories.append((extra,item_path))
+				continue
+			if rate_limited:
+				limiter.Wait(extra)
+			batch.append((item_path,extra))
+			if len(batch) >= batch_size:
+				work.put(batch)
+				batch = []
+	except OSError,e:
+		stats.AddError(path,e)
+	finally:
+		if batch:
+			work.put(batch)
+		for t in threads:
+			work.put(None)
+		for t in threads:
+			t.join()
+
+	# Directories are empty now, remove the deepest ones first
+	directories.sort(reverse=True)
+	for (depth,dir_path) in directories:
+		try:
+			os.rmdir(dir_path)
+			stats.dirs += 1
+		except OSError,e:
+			stats.AddError(dir_path,e)
+
+	stats.seconds = time.time() - start
+	return stats
+
+def MakeSyntheticTree(path,n_files,file_size=0,n_subdirs=0,extension='.dat'):
+	'''
+	Fill path with n_files files of file_size bytes, spread over n_subdirs
+	subdirectories (0 means all at the top level).
+	'''
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	subdirs = [path]
+	for i in range(n_subdirs):
+		subdir = os.path.join(path,'sub%04d' % i)
+		os.mkdir(subdir)
+		subdirs.append(subdir)
+	data = '\0'*file_size
+	for i in range(n_files):
+		f = open(os.path.join(subdirs[i % len(subdirs)],'file%07d%s' % (i,extension)),'wb')
+		f.write(data)
+		f.close()
+	return path
+
+def BenchmarkDelete(n_files=20000,file_size=4096,workers=8,base_dir=None):
+	'''
+	Time `rm -r` and DeleteTree on identical synthetic trees.
+	'''
+	work_dir = tempfile.mkdtemp(prefix='globus_delete_bench_',dir=base_dir)
+	try:
+		tree = MakeSyntheticTree(os.path.join(work_dir,'rm'),n_files,file_size)
+		start = time.time()
+		subprocess.call(['rm','-r',tree])
+		rm_seconds = time.time() - start
+		print 'rm -r:      %d files in %.2f s (%.0f files/s)' % (n_files,rm_seconds,n_files/max(rm_seconds,1e-9))
+
+		tree = MakeSyntheticTree(os.path.join(work_dir,'deletetree'),n_files,file_size)
+		stats = DeleteTree(tree,workers=workers)
+		print 'DeleteTree: %s' % stats
+	finally:
+		shutil.rmtree(work_dir,ignore_errors=True)
+
+	return rm_seconds, stats
+
+if __name__ == '__main__':
+	args = [int(x) for x in sys.argv[1:4]]
+	BenchmarkDelete(*args)
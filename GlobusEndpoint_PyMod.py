@@ -0,0 +1,213 @@
+'''
+GlobusEndpoint_PyMod.py
+
+Health of the Globus endpoints the daemon uses, so an expired credential is
+caught before a submission fails on it instead of after.
+
+EndpointHealthCache keeps the credential status and expiry of each endpoint
+(endpoint-list credential_status/credential_time_left) for ttl seconds.
+RefreshDue, called every so often from the main loop, checks stale entries in
+the background and reactivates an endpoint (its Globus Connect command, then
+endpoint-activate) when it is not active or its credential has less than
+refresh_margin seconds left. A reactivation is single-flight: all the failures
+reported for an endpoint while one is running share it.
+
+	endpoints = EndpointHealthCache('lux',{'lux#src':'globusconnect -start','lux#dst':None})
+	if not endpoints.IsHealthy('lux#src'):
+		endpoints.Reactivate('lux#src')	# CLIFuture, shared by concurrent callers
+	...
+	endpoints.RefreshDue()	# every few minutes
+
+20261017 - Created
+20261017 - Endpoints are checked and activated through a GlobusTransport (CLI or REST)
+20261017 - Status serves a stale entry and refreshes it in the background instead of
+				checking on the caller's thread
+'''
+
+import threading
+import time
+from subprocess import Popen, PIPE
+from GlobusTransport_PyMod import GlobusCLITransport
+from GlobusExecutor_PyMod import GetExecutor
+from GlobusMetrics_PyMod import Increment, SetGauge, LogEvent
+
+class EndpointStatus:
+	'''
+	What endpoint-list said about an endpoint's credential, and when.
+	'''
+
+	def __init__(self,endpoint,credential_status,time_left,checked=None):
+		self.endpoint = endpoint
+		self.credential_status = credential_status
+		self.checked = checked if checked is not None else time.time()
+		self.expires = self.checked + time_left if time_left is not None else None
+
+	def Known(self):
+		# False if the CLI call failed
+		return self.credential_status is not None
+
+	def Age(self):
+		return time.time() - self.checked
+
+	def TimeLeft(self):
+		if self.expires is None:
+			return None
+		return self.expires - time.time()
+
+	def IsActive(self):
+		time_left = self.TimeLeft()
+		return self.credential_status == 'ACTIVE' and (time_left is None or time_left > 0)
+
+	def __str__(self):
+		time_left = self.TimeLeft()
+		if time_left is None:
+			return '%s is %s' % (self.endpoint,self.credential_status)
+		time_left = max(0,int(time_left))
+		return '%s is %s, %d:%02d:%02d left' % (self.endpoint,self.credential_status,time_left/3600,time_left/60 % 60,time_left % 60)
+
+class EndpointHealthCache:
+	'''
+	Cached credential status of the endpoints in local_commands (endpoint ->
+	shell command that starts Globus Connect for it, or None), checked and
+	reactivated as user through transport (GlobusTransport_PyMod, the CLI if
+	None).
+	'''
+
+	def __init__(self,user,local_commands,ttl=5*60,refresh_margin=12*3600,timeout=5*60,transport=None):
+		self.user = user
+		self.transport = transport if transport is not None else GlobusCLITransport(user)
+		self.local_commands = dict(local_commands)
+		self.ttl = ttl
+		self.refresh_margin = refresh_margin
+		self.timeout = timeout
+		self.statuses = dict()
+		self.last_reactivation = dict()
+		self.in_flight = dict()
+		self._lock = threading.Lock()
+
+	def Check(self,endpoint):
+		'''
+		Ask for the endpoint's credentials now. Returns the new EndpointStatus.
+		'''
+		(credential_status,time_left) = self.transport.EndpointCredentials(endpoint)
+		status = EndpointStatus(endpoint,credential_status,time_left)
+		Increment('globus_endpoint_checks_total',endpoint=endpoint,ok=str(status.Known()).lower())
+		if status.Known():
+			SetGauge('globus_endpoint_active',int(status.IsActive()),endpoint=endpoint)
+			if time_left is not None:
+				SetGauge('globus_endpoint_credential_seconds_left',time_left,endpoint=endpoint)
+		with self._lock:
+			self.statuses[endpoint] = status
+		return status
+
+	def Status(self,endpoint):
+		'''
+		The cached EndpointStatus. One older than ttl is still what is
+		returned, while a background check (Reactivate) refreshes it. Only an
+		endpoint never checked is asked about right away, unless a check is
+		on its way already: its status is unknown until then.
+		'''
+		with self._lock:
+			status = self.statuses.get(endpoint)
+			busy = self.Reactivating(endpoint)
+		if status is None:
+			if busy:
+				return EndpointStatus(endpoint,None,None)
+			return self.Check(endpoint)
+		if status.Age() >= self.ttl and not busy:
+			self.Reactivate(endpoint)
+		return status
+
+	def IsHealthy(self,endpoint):
+		'''
+		False if the endpoint's credential is known to be inactive or
+		expired. An endpoint whose status can't be had counts as healthy;
+		submitting to it is what will tell.
+		'''
+		status = self.Status(endpoint)
+		return not status.Known() or status.IsActive()
+
+	def Expiring(self,status):
+		time_left = status.TimeLeft()
+		return time_left is not None and time_left < self.refresh_margin
+
+	def Invalidate(self,endpoint):
+		with self._lock:
+			self.statuses.pop(endpoint,None)
+
+	def Reactivating(self,endpoint):
+		future = self.in_flight.get(endpoint)
+		return future is not None and not future.Done()
+
+	def Reactivate(self,endpoint):
+		'''
+		Check the endpoint in the background and bring it back if needed.
+		Returns the CLIFuture of the reactivation, which is the one already
+		running if there is one.
+		'''
+		with self._lock:
+			if self.Reactivating(endpoint):
+				Increment('globus_endpoint_reactivations_joined_total',endpoint=endpoint)
+				return self.in_flight[endpoint]
+			future = GetExecutor().SubmitTimed(self.timeout,self._Reactivate,endpoint)
+			self.in_flight[endpoint] = future
+			return future
+
+	def ReportFailure(self,endpoint):
+		'''
+		Something failed in a way that may be the endpoint's fault: forget
+		its cached status and reactivate it if it needs it.
+		'''
+		self.Invalidate(endpoint)
+		return self.Reactivate(endpoint)
+
+	def RefreshDue(self):
+		'''
+		Start background checks of the endpoints whose status is stale, and
+		reactivations of the ones that are inactive or expiring. Returns the
+		CLIFutures involved.
+		'''
+		futures = []
+		for endpoint in sorted(self.local_commands):
+			status = self.statuses.get(endpoint)
+			if status is None or status.Age() >= self.ttl or not status.IsActive():
+				futures.append(self.Reactivate(endpoint))
+			elif self.Expiring(status) and time.time() - self.last_reactivation.get(endpoint,0) >= self.ttl:
+				# Don't keep at it every call if activating doesn't extend it
+				futures.append(self.Reactivate(endpoint))
+		return futures
+
+	def _RunLocalCommand(self,endpoint):
+		local_command = self.local_commands.get(endpoint)
+		if not local_command:
+			return
+		print 'Executing local command to re-animate Globus at %s' % endpoint
+		p = Popen(local_command, stdout=PIPE, shell=True)
+		killer = threading.Timer(self.timeout,p.kill)
+		killer.daemon = True
+		killer.start()
+		try:
+			p.communicate()
+		finally:
+			killer.cancel()
+
+	def _Reactivate(self,endpoint):
+		status = self.Check(endpoint)
+		print 'Status for %s' % status
+		if not status.Known() or (status.IsActive() and not self.Expiring(status)):
+			return status
+
+		self.last_reactivation[endpoint] = time.time()
+		start = time.time()
+		if not status.IsActive():
+			self._RunLocalCommand(endpoint)
+		print 'Activating endpoint %s' % endpoint
+		activated = self.transport.ActivateEndpoint(endpoint)
+		new_status = self.Check(endpoint)
+
+		result = 'ok' if activated and new_status.IsActive() else 'failed'
+		Increment('globus_endpoint_reactivations_total',endpoint=endpoint,result=result)
+		LogEvent('endpoint_reactivated',endpoint=endpoint,result=result,seconds=time.time() - start,
+			reason='expiring' if status.IsActive() else (status.credential_status or 'unknown').lower(),
+			seconds_left=new_status.TimeLeft())
+		return new_status
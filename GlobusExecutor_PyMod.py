@@ -0,0 +1,235 @@
+'''
+GlobusExecutor_PyMod.py
+
+Runs Globus CLI work concurrently so one slow `details` or `endpoint-activate`
+doesn't hold up everything else. Calls are handed to a pool of worker threads
+and come back as CLIFutures:
+
+	executor = GetExecutor()
+	futures = [executor.Submit(GlobusTransferStatus,transfer_id) for transfer_id in transfer_ids]
+	(done,not_done) = WaitAll(futures,timeout=60)
+	all_details = [f.Result() for f in done]
+
+Every call has a deadline (the executor's call_timeout, or SubmitTimed).
+When it passes, or when Cancel() is called, the CLI commands the call has
+running are killed and the ones it hasn't started yet are never run
+(see CancelToken in GlobusSession_PyMod). How many CLI commands run at once
+across all threads is limited by the global semaphore in GlobusSession_PyMod.
+
+Python 2 has no asyncio, so this is threads waiting on ssh subprocesses; the
+work itself is all I/O bound, so that is where the time goes anyway.
+
+20261017 - Created
+20261017 - Shutdown(wait=True) joins the worker threads, and a call's deadline timer is
+				joined when the call returns.
+20261017 - Workers still finishing a call after Shutdown no longer count as idle, so a call
+				submitted after Shutdown always gets a worker
+'''
+
+import sys
+import threading
+import time
+import traceback
+from Queue import Queue
+from GlobusSession_PyMod import CancelToken, SetCancelToken, GetCancelToken
+from GlobusMetrics_PyMod import Increment
+
+class CLIFuture:
+	'''
+	The pending result of a call handed to a GlobusCLIExecutor.
+	'''
+
+	def __init__(self,function,args,kwargs,timeout=None):
+		self.function = function
+		self.args = args
+		self.kwargs = kwargs
+		self.timeout = timeout
+		self.token = CancelToken()
+		self.result = None
+		self.exc_info = None
+		self.started = False
+		self.timed_out = False
+		self._done = threading.Event()
+
+	def Name(self):
+		return getattr(self.function,'__name__',str(self.function))
+
+	def Cancel(self):
+		'''
+		Kill the call's running CLI commands and skip the rest. A call that
+		had not started yet never runs.
+		'''
+		self.token.Cancel()
+
+	def Cancelled(self):
+		return self.token.cancelled
+
+	def Done(self):
+		return self._done.isSet()
+
+	def Wait(self,timeout=None):
+		'''
+		Wait for the call to finish. Returns True if it did.
+		'''
+		self._done.wait(timeout)
+		return self._done.isSet()
+
+	def Result(self,timeout=None):
+		'''
+		The call's return value (None if it was cancelled before it started
+		or isn't done within timeout). Exceptions raised by the call are
+		raised again here.
+		'''
+		if not self.Wait(timeout):
+			return None
+		if self.exc_info is not None:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.result
+
+	def _Expire(self):
+		self.timed_out = True
+		Increment('globus_executor_timeouts_total',call=self.Name())
+		self.Cancel()
+
+	def _Run(self):
+		if self.token.cancelled:
+			self._done.set()
+			return
+		self.started = True
+		watchdog = None
+		if self.timeout:
+			watchdog = threading.Timer(self.timeout,self._Expire)
+			watchdog.daemon = True
+			watchdog.start()
+		previous_token = GetCancelToken()
+		SetCancelToken(self.token)
+		try:
+			try:
+				self.result = self.function(*self.args,**self.kwargs)
+			except:
+				self.exc_info = sys.exc_info()
+		finally:
+			SetCancelToken(previous_token)
+			if watchdog is not None:
+				# Joined so no timer thread outlives the call
+				watchdog.cancel()
+				watchdog.join()
+			self._done.set()
+
+class GlobusCLIExecutor:
+	'''
+	A pool of up to max_workers threads running calls in submission order.
+	Calls submitted from one of the pool's own threads run right away in
+	that thread, so a call that fans out into more calls can't deadlock the
+	pool waiting on itself.
+	'''
+
+	def __init__(self,max_workers=8,call_timeout=10*60):
+		self.max_workers = max_workers
+		self.call_timeout = call_timeout
+		self._queue = Queue()
+		self._threads = []
+		self._idle = 0
+		# Bumped by Shutdown: workers of an earlier generation are on their
+		# way out and no longer count as idle
+		self._generation = 0
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	def Submit(self,function,*args,**kwargs):
+		'''
+		Run function(*args,**kwargs) in the pool. Returns a CLIFuture.
+		'''
+		return self.SubmitTimed(self.call_timeout,function,*args,**kwargs)
+
+	def SubmitTimed(self,timeout,function,*args,**kwargs):
+		'''
+		Same as Submit, with its own deadline in seconds (None for none).
+		'''
+		future = CLIFuture(function,args,kwargs,timeout)
+		if getattr(self._local,'in_worker',False):
+			# Nested call: share the caller's deadline and cancellation
+			future.token = GetCancelToken() or future.token
+			future.timeout = None
+			future._Run()
+			return future
+		with self._lock:
+			self._queue.put(future)
+			if self._idle == 0 and len(self._threads) < self.max_workers:
+				t = threading.Thread(target=self._Worker,args=(self._generation,))
+				t.daemon = True
+				self._threads.append(t)
+				t.start()
+			else:
+				self._idle -= 1
+		return future
+
+	def Map(self,function,args_list,timeout=None):
+		'''
+		function(*args) for every args in args_list, concurrently. Returns the
+		results in order (None for calls that didn't finish within timeout,
+		which are cancelled).
+		'''
+		futures = [self.Submit(function,*args) for args in args_list]
+		WaitAll(futures,timeout)
+		return [f.Result(0) for f in futures]
+
+	def _Worker(self,generation):
+		self._local.in_worker = True
+		while True:
+			future = self._queue.get()
+			if future is None:
+				return
+			future._Run()
+			if future.exc_info is not None:
+				print '*** ERROR in %s%s: %s' % (future.Name(),future.args,
+					''.join(traceback.format_exception_only(*future.exc_info[:2])).strip())
+			with self._lock:
+				if generation == self._generation:
+					self._idle += 1
+
+	def Shutdown(self,cancel=False,wait=False):
+		'''
+		Stop the worker threads once the queue is empty (or right away, with
+		the pending calls cancelled, if cancel is set). With wait, return only
+		once they have stopped.
+		'''
+		if cancel:
+			while not self._queue.empty():
+				future = self._queue.get()
+				if future is not None:
+					future.Cancel()
+					future._done.set()
+		with self._lock:
+			threads = self._threads
+			self._threads = []
+			self._idle = 0
+			self._generation += 1
+		for t in threads:
+			self._queue.put(None)
+		if wait:
+			for t in threads:
+				t.join()
+
+def WaitAll(futures,timeout=None):
+	'''
+	Wait for all futures, at most timeout seconds overall. The ones not done
+	by then are cancelled. Returns (done,not_done).
+	'''
+	deadline = time.time() + timeout if timeout is not None else None
+	for future in futures:
+		if deadline is None:
+			future.Wait()
+		else:
+			future.Wait(max(0.,deadline - time.time()))
+	done = [f for f in futures if f.Done()]
+	not_done = [f for f in futures if not f.Done()]
+	for future in not_done:
+		future.Cancel()
+	return done, not_done
+
+# Module level executor shared by GlobusTransferTools_PyMod and the daemon
+_executor = GlobusCLIExecutor()
+
+def GetExecutor():
+	return _executor
@@ -0,0 +1,669 @@
+'''
+GlobusFakeCLI_PyMod.py
+
+Local stand-ins for the hosted Globus CLI (reached over ssh) and for the rsync
+target, so GlobusDaemon can be run and timed without live endpoints.
+
+Run as a script, this module behaves like `ssh` or `rsync`:
+
+	python GlobusFakeCLI_PyMod.py ssh [ssh options] user@host details <id> ...
+	python GlobusFakeCLI_PyMod.py rsync [rsync options] source user@host:destination/
+
+The fake ssh understands the ControlMaster calls made by GlobusSession_PyMod
+(-M, -O check, -O exit) and the CLI commands the daemon uses: transfer
+(with --generate-id, or a task read from stdin), details (one or more task
+IDs), task-list and endpoint-list / endpoint-activate. Any other command is run locally
+through sh, standing in for the destination host. Submitted tasks are kept as JSON
+files in a state directory. A task is ACTIVE, with bytes_transferred growing
+linearly, for transfer_sec seconds after it was submitted and then SUCCEEDED
+(or FAILED, for the fail_rate fraction of first submissions; a resubmitted
+task always succeeds). Endpoint credentials last credential_sec seconds from
+their last endpoint-activate (or from the first time they were asked about),
+after which endpoint-list reports them EXPIRED.
+
+StartFakeTransferAPI serves the same tasks and endpoints over HTTP, as the
+Globus Transfer REST API calls of GlobusRESTTransport (GlobusTransport_PyMod):
+submission_id, transfer, task/<id> (GET, and PUT to change its label),
+task_list (paginated, filter=task_id:...), endpoint/<endpoint> and
+endpoint/<endpoint>/autoactivate. Like Globus, it gives every submitted task
+a new task ID. Run as `python GlobusFakeCLI_PyMod.py api [port]` it serves in
+the foreground.
+
+The fake rsync copies what the real one would (excludes, --remove-source-files)
+into the local directory named by the destination, ignoring user@host, and
+prints rsync style --progress lines.
+
+Latencies, transfer times and exit codes come from GLOBUS_FAKE_* environment
+variables, see ConfigureFakeCLI. WriteFakeCommands puts `ssh` and `rsync`
+wrapper scripts in a directory:
+
+	(ssh_command,rsync_command) = WriteFakeCommands('/tmp/bench/bin')
+	ConfigureFakeCLI('/tmp/bench/globus',cli_latency=0.2,transfer_sec=30)
+	SetSSHCommand(ssh_command)
+
+20261017 - Created
+20261017 - The fake rsync prints --progress lines
+20261017 - The fake ssh runs other commands locally, as the destination host
+20261017 - Endpoint credentials expire (credential_sec) and endpoint-list prints the fields
+				asked for with -f, including Credential Time Left
+20261017 - Fake Transfer REST API (StartFakeTransferAPI) on the same task and endpoint state
+20261017 - The fake ssh answers task-list (-l limit, --filter task_id:...).
+20261017 - The fake API takes PUT task/<id> to change a task's label.
+20261017 - FakeTransferAPIServer.DropConnections, to test reconnecting after an idle
+				keep-alive connection is closed by the server.
+20261017 - The fake ssh master started with -f stays in the background holding its stdout and
+				stderr until -O exit, as OpenSSH before 8.5 does
+'''
+
+import BaseHTTPServer
+import SocketServer
+import fnmatch
+import glob
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+def _EnvFloat(name,default):
+	try:
+		return float(os.environ.get(name,default))
+	except ValueError:
+		return default
+
+def ConfigureFakeCLI(state_dir,cli_latency=0.,connect_latency=0.,transfer_sec=10.,fail_rate=0.,
+	rsync_latency=0.,rsync_returncode=0,copy_data=False,credential_sec=264*3600):
+	'''
+	Set the environment the fake commands read their behaviour from.
+	Subprocesses started afterwards inherit it. With copy_data, a task's
+	files really are copied (locally) when it succeeds.
+	'''
+	if not os.path.isdir(state_dir):
+		os.makedirs(state_dir)
+	os.environ['GLOBUS_FAKE_DIR'] = state_dir
+	os.environ['GLOBUS_FAKE_LATENCY'] = str(cli_latency)
+	os.environ['GLOBUS_FAKE_CONNECT_LATENCY'] = str(connect_latency)
+	os.environ['GLOBUS_FAKE_TRANSFER_SEC'] = str(transfer_sec)
+	os.environ['GLOBUS_FAKE_FAIL_RATE'] = str(fail_rate)
+	os.environ['GLOBUS_FAKE_RSYNC_LATENCY'] = str(rsync_latency)
+	os.environ['GLOBUS_FAKE_RSYNC_RC'] = str(rsync_returncode)
+	os.environ['GLOBUS_FAKE_COPY'] = '1' if copy_data else ''
+	os.environ['GLOBUS_FAKE_CREDENTIAL_SEC'] = str(credential_sec)
+
+def WriteFakeCommands(bin_dir):
+	'''
+	Write executable `ssh` and `rsync` wrappers around this module into
+	bin_dir. Returns their paths.
+	'''
+	if not os.path.isdir(bin_dir):
+		os.makedirs(bin_dir)
+	module_path = os.path.abspath(__file__)
+	if module_path.endswith('.pyc'):
+		module_path = module_path[:-1]
+	paths = []
+	for command in ('ssh','rsync'):
+		path = os.path.join(bin_dir,command)
+		f = open(path,'w')
+		f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable,module_path,command))
+		f.close()
+		os.chmod(path,0755)
+		paths.append(path)
+	return tuple(paths)
+
+#-------------------------------------------------------------------- fake ssh
+
+def _TaskPath(transfer_id):
+	return os.path.join(os.environ.get('GLOBUS_FAKE_DIR','.'),'%s.json' % transfer_id)
+
+def _LoadTask(transfer_id):
+	try:
+		f = open(_TaskPath(transfer_id))
+	except IOError:
+		return None
+	try:
+		return json.load(f)
+	finally:
+		f.close()
+
+def _SaveTask(task):
+	# Write then rename so a concurrent `details` never reads half a file
+	path = _TaskPath(task['transfer_id'])
+	f = open(path + '.tmp','w')
+	json.dump(task,f)
+	f.close()
+	os.rename(path + '.tmp',path)
+
+def _LocalPath(globus_path):
+	# lux#src//data/lux10_foo/ -> /data/lux10_foo/
+	return '/' + globus_path.split('/',1)[1].lstrip('/')
+
+def _TreeSize(path):
+	n_files = 0
+	n_bytes = 0
+	for (dirpath,dirnames,filenames) in os.walk(path):
+		for name in filenames:
+			try:
+				n_bytes += os.lstat(os.path.join(dirpath,name)).st_size
+				n_files += 1
+			except OSError:
+				pass
+	return n_files, n_bytes
+
+def _Transfer(args,input_text):
+	if '--generate-id' in args:
+		print str(uuid.uuid1())
+		return 0
+
+	options = dict([arg[2:].split('=',1) for arg in args if arg.startswith('--') and '=' in arg])
+	transfer_id = options.get('taskid')
+	if not transfer_id:
+		sys.stderr.write('Error: no --taskid given\n')
+		return 1
+
+	lines = [line.split() for line in input_text.split('\n') if line.strip()]
+	_SubmitTask(transfer_id,options.get('label',''),[line[:2] for line in lines])
+	print 'Task ID: %s' % transfer_id
+	return 0
+
+def _SubmitTask(transfer_id,label,paths):
+	# paths: [source,destination] pairs like lux#src//data/lux10_foo/
+	n_files = 0
+	n_bytes = 0
+	for (source,destination) in paths:
+		(files,size) = _TreeSize(_LocalPath(source))
+		n_files += files
+		n_bytes += size
+
+	old = _LoadTask(transfer_id)
+	attempt = old['attempt'] + 1 if old is not None else 1
+	fail = attempt == 1 and random.random() < _EnvFloat('GLOBUS_FAKE_FAIL_RATE',0.)
+	task = dict(transfer_id=transfer_id,label=label,submit_time=time.time(),
+		attempt=attempt,fail=fail,files=n_files,total_bytes=n_bytes,paths=paths)
+	_SaveTask(task)
+	return task
+
+def _CopyTask(task):
+	# What Globus would have put at the destination
+	for (source,destination) in task['paths']:
+		source = _LocalPath(source).rstrip('/')
+		destination = _LocalPath(destination).rstrip('/')
+		for (dirpath,dirnames,filenames) in os.walk(source):
+			target_dir = os.path.join(destination,os.path.relpath(dirpath,source))
+			if not os.path.isdir(target_dir):
+				os.makedirs(target_dir)
+			for name in filenames:
+				try:
+					shutil.copy2(os.path.join(dirpath,name),os.path.join(target_dir,name))
+				except (IOError,OSError):
+					pass
+
+def _TaskProgress(task,now):
+	# Status, bytes and files so far, and transfer rate of a task
+	transfer_sec = _EnvFloat('GLOBUS_FAKE_TRANSFER_SEC',10.)
+	elapsed = now - task['submit_time']
+	if elapsed < transfer_sec:
+		status = 'ACTIVE'
+		fraction = elapsed/transfer_sec if transfer_sec > 0 else 1.
+	elif task['fail']:
+		status = 'FAILED'
+		fraction = 0.5
+	else:
+		status = 'SUCCEEDED'
+		fraction = 1.
+		if os.environ.get('GLOBUS_FAKE_COPY') and not task.get('copied'):
+			_CopyTask(task)
+			task['copied'] = True
+			_SaveTask(task)
+	bytes_transferred = int(task['total_bytes']*fraction)
+	files = int(task['files']*fraction)
+	mbits = bytes_transferred*8/1e6/max(min(elapsed,transfer_sec),1e-3)
+	return status, bytes_transferred, files, mbits, task['submit_time'] + transfer_sec
+
+def _DetailsBlock(task,now):
+	(status,bytes_transferred,files,mbits,completion_time) = _TaskProgress(task,now)
+	fields = [
+		('Task ID',task['transfer_id']),
+		('Task Type','TRANSFER'),
+		('Status',status),
+		('Request Time',time.strftime('%Y-%m-%d %H:%M:%SZ',time.gmtime(task['submit_time']))),
+		('Completion Time',time.strftime('%Y-%m-%d %H:%M:%SZ',time.gmtime(completion_time)) if status != 'ACTIVE' else 'n/a'),
+		('Total Tasks',len(task['paths'])),
+		('Tasks Successful',len(task['paths']) if status == 'SUCCEEDED' else 0),
+		('Tasks Failed',len(task['paths']) if status == 'FAILED' else 0),
+		('Tasks Pending',len(task['paths']) if status == 'ACTIVE' else 0),
+		('Command','API 0.10 (transfer)'),
+		('Label',task['label']),
+		('Source Endpoint',task['paths'][0][0].split('/')[0] if task['paths'] else 'n/a'),
+		('Destination Endpoint',task['paths'][0][1].split('/')[0] if task['paths'] else 'n/a'),
+		('Files',files),
+		('Files Skipped',0),
+		('Directories',len(task['paths'])),
+		('Bytes Transferred',bytes_transferred),
+		('MBits/sec','%.3f' % mbits),
+		('Faults',1 if status == 'FAILED' else 0),
+		]
+	return '\n'.join(['%s: %s' % (name,value) for (name,value) in fields])
+
+def _Details(transfer_ids):
+	now = time.time()
+	blocks = []
+	missing = []
+	for transfer_id in transfer_ids:
+		task = _LoadTask(transfer_id)
+		if task is None:
+			missing.append(transfer_id)
+		else:
+			blocks.append(_DetailsBlock(task,now))
+	if blocks:
+		print '\n\n'.join(blocks)
+	for transfer_id in missing:
+		sys.stderr.write('Error: Task %s not found\n' % transfer_id)
+	return 1 if missing and not blocks else 0
+
+def _TaskListCommand(args):
+	# task-list [-l limit] [--filter task_id:<id>,<id>]: details blocks,
+	# most recent first
+	limit = None
+	filter = ''
+	i = 0
+	while i < len(args):
+		if args[i] == '-l':
+			limit = int(args[i+1])
+		elif args[i] == '--filter':
+			filter = args[i+1]
+		i += 2
+	(field,sep,values) = filter.partition(':')
+	if field == 'task_id':
+		tasks = [task for task in [_LoadTask(task_id) for task_id in values.split(',')] if task is not None]
+	else:
+		tasks = _AllTasks()
+	if limit is not None:
+		tasks = tasks[:limit]
+	now = time.time()
+	if tasks:
+		print '\n\n'.join([_DetailsBlock(task,now) for task in tasks])
+	return 0
+
+def _EndpointPath(endpoint):
+	return os.path.join(os.environ.get('GLOBUS_FAKE_DIR','.'),'endpoint_%s.json' % endpoint.replace('#','_').replace('/','_'))
+
+def _ActivateEndpoint(endpoint):
+	path = _EndpointPath(endpoint)
+	f = open(path + '.tmp','w')
+	json.dump({'activated':time.time()},f)
+	f.close()
+	os.rename(path + '.tmp',path)
+
+def _CredentialTimeLeft(endpoint):
+	try:
+		f = open(_EndpointPath(endpoint))
+	except IOError:
+		# First time anyone asks: it was just activated
+		_ActivateEndpoint(endpoint)
+		f = open(_EndpointPath(endpoint))
+	try:
+		activated = json.load(f)['activated']
+	finally:
+		f.close()
+	return activated + _EnvFloat('GLOBUS_FAKE_CREDENTIAL_SEC',264*3600) - time.time()
+
+def _FormatTimeLeft(seconds):
+	seconds = max(0,int(seconds))
+	return '%d:%02d:%02d' % (seconds/3600,seconds/60 % 60,seconds % 60)
+
+def _EndpointList(args):
+	fields = ['credential_status']
+	if '-f' in args:
+		fields = args[args.index('-f')+1].split(',')
+	endpoint = args[-1]
+	time_left = _CredentialTimeLeft(endpoint)
+	values = {
+		'name': ('Name',endpoint),
+		'credential_status': ('Credential Status','ACTIVE' if time_left > 0 else 'EXPIRED'),
+		'credential_time_left': ('Credential Time Left',_FormatTimeLeft(time_left)),
+	}
+	for field in fields:
+		if field in values:
+			print '%s: %s' % values[field]
+	return 0
+
+def FakeSSH(args,stdin=sys.stdin):
+	'''
+	Behave like `ssh [options] user@host command...` against the hosted CLI.
+	Returns the exit code.
+	'''
+	control_path = None
+	i = 0
+	while i < len(args):
+		if args[i] == '-o' and args[i+1].startswith('ControlPath='):
+			control_path = args[i+1].split('=',1)[1]
+		if args[i] in ('-o','-O'):
+			i += 2
+			continue
+		if not args[i].startswith('-'):
+			break
+		i += 1
+	options = args[:i]
+	target = args[i] if i < len(args) else None
+	command = args[i+1:]
+
+	if '-O' in options:
+		operation = options[options.index('-O')+1]
+		exists = control_path is not None and os.path.exists(control_path)
+		if operation == 'exit' and exists:
+			os.remove(control_path)
+		return 0 if exists else 255
+
+	if '-M' in options:
+		time.sleep(_EnvFloat('GLOBUS_FAKE_CONNECT_LATENCY',0.))
+		if control_path is not None:
+			open(control_path,'w').close()
+			# Like OpenSSH before 8.5, the master backgrounded by -f keeps the
+			# stdout and stderr it was started with until it exits (-O exit)
+			if '-f' in options and os.fork() == 0:
+				start = time.time()
+				while os.path.exists(control_path) and time.time() - start < 10*60:
+					time.sleep(0.2)
+				os._exit(0)
+		return 0
+
+	if target is None or not command:
+		sys.stderr.write('usage: ssh [options] user@host command\n')
+		return 255
+
+	# Without a master this would have been a full connection
+	if control_path is None or not os.path.exists(control_path):
+		time.sleep(_EnvFloat('GLOBUS_FAKE_CONNECT_LATENCY',0.))
+	time.sleep(_EnvFloat('GLOBUS_FAKE_LATENCY',0.))
+
+	if command[0] == 'transfer':
+		input_text = stdin.read() if '--generate-id' not in command else ''
+		return _Transfer(command[1:],input_text)
+	if command[0] == 'details':
+		return _Details(command[1:])
+	if command[0] == 'task-list':
+		return _TaskListCommand(command[1:])
+	if command[0] == 'endpoint-list':
+		return _EndpointList(command[1:])
+	if command[0] == 'endpoint-activate':
+		_ActivateEndpoint(command[-1])
+		print 'Credential Subject: /C=US/O=Globus Consortium/CN=%s' % target.split('@')[0]
+		print 'Credential Time Left: %s' % _FormatTimeLeft(_CredentialTimeLeft(command[-1]))
+		return 0
+	# Anything else runs here, as if this machine were the remote host (the
+	# fake rsync target is local too)
+	import subprocess
+	return subprocess.call(['sh','-c',' '.join(command)])
+
+#------------------------------------------------------- fake Transfer REST API
+
+def _TaskDocument(task,now):
+	(status,bytes_transferred,files,mbits,completion_time) = _TaskProgress(task,now)
+	n_paths = len(task['paths'])
+	return dict(DATA_TYPE='task',task_id=task['transfer_id'],type='TRANSFER',status=status,
+		request_time=time.strftime('%Y-%m-%dT%H:%M:%S+00:00',time.gmtime(task['submit_time'])),
+		completion_time=time.strftime('%Y-%m-%dT%H:%M:%S+00:00',time.gmtime(completion_time)) if status != 'ACTIVE' else None,
+		subtasks_total=n_paths,
+		subtasks_succeeded=n_paths if status == 'SUCCEEDED' else 0,
+		subtasks_failed=n_paths if status == 'FAILED' else 0,
+		subtasks_pending=n_paths if status == 'ACTIVE' else 0,
+		label=task['label'],
+		source_endpoint=task['paths'][0][0].split('/')[0] if task['paths'] else None,
+		destination_endpoint=task['paths'][0][1].split('/')[0] if task['paths'] else None,
+		files=files,files_skipped=0,directories=n_paths,bytes_transferred=bytes_transferred,
+		effective_bytes_per_second=int(mbits*1e6/8),faults=1 if status == 'FAILED' else 0)
+
+def _AllTasks():
+	tasks = []
+	for path in glob.glob(os.path.join(os.environ.get('GLOBUS_FAKE_DIR','.'),'*.json')):
+		if not os.path.basename(path).startswith('endpoint_'):
+			task = _LoadTask(os.path.basename(path)[:-len('.json')])
+			if task is not None:
+				tasks.append(task)
+	tasks.sort(key=lambda task: task['submit_time'],reverse=True)
+	return tasks
+
+class FakeTransferAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''
+	The Transfer API calls made by GlobusRESTTransport, answered from the
+	task and endpoint state the fake ssh keeps. Connections are kept alive.
+	'''
+
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		# A new connection pays for the TCP (and TLS) handshake
+		time.sleep(_EnvFloat('GLOBUS_FAKE_CONNECT_LATENCY',0.))
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		with self.server.lock:
+			self.server.connections.add(self.connection)
+
+	def finish(self):
+		with self.server.lock:
+			self.server.connections.discard(self.connection)
+		BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+	def log_message(self,format,*args):
+		pass
+
+	def do_GET(self):
+		self._Handle('GET')
+
+	def do_POST(self):
+		self._Handle('POST')
+
+	def do_PUT(self):
+		self._Handle('PUT')
+
+	def _Reply(self,status,document):
+		body = json.dumps(document)
+		self.send_response(status)
+		self.send_header('Content-Type','application/json')
+		self.send_header('Content-Length',str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _Error(self,status,code,message):
+		self._Reply(status,dict(code=code,message=message))
+
+	def _Handle(self,method):
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length) if length else ''
+		time.sleep(_EnvFloat('GLOBUS_FAKE_LATENCY',0.))
+
+		if self.server.token and self.headers.get('Authorization') != 'Bearer %s' % self.server.token:
+			return self._Error(401,'AuthenticationFailed','No valid bearer token')
+		parts = urlparse.urlsplit(self.path)
+		if not parts.path.startswith(self.server.base_path + '/'):
+			return self._Error(404,'ClientError.NotFound','No such API version')
+		route = [urllib.unquote(segment) for segment in parts.path[len(self.server.base_path):].split('/') if segment]
+		query = dict(urlparse.parse_qsl(parts.query))
+		try:
+			document = json.loads(body) if body else dict()
+		except ValueError:
+			return self._Error(400,'ClientError.BadRequest','Body is not JSON')
+
+		if method == 'GET' and route == ['submission_id']:
+			return self._Reply(200,dict(DATA_TYPE='submission_id',value=str(uuid.uuid1())))
+		if method == 'POST' and route == ['transfer']:
+			return self._Transfer(document)
+		if method == 'GET' and len(route) == 2 and route[0] == 'task':
+			task = _LoadTask(route[1])
+			if task is None:
+				return self._Error(404,'ClientError.NotFound','Task %s not found' % route[1])
+			return self._Reply(200,_TaskDocument(task,time.time()))
+		if method == 'PUT' and len(route) == 2 and route[0] == 'task':
+			return self._UpdateTask(route[1],document)
+		if method == 'GET' and route == ['task_list']:
+			return self._TaskList(query)
+		if method == 'GET' and len(route) == 2 and route[0] == 'endpoint':
+			time_left = _CredentialTimeLeft(route[1])
+			return self._Reply(200,dict(DATA_TYPE='endpoint',canonical_name=route[1],
+				activated=time_left > 0,expires_in=int(max(time_left,0))))
+		if method == 'POST' and len(route) == 3 and route[0] == 'endpoint' and route[2] == 'autoactivate':
+			_ActivateEndpoint(route[1])
+			return self._Reply(200,dict(DATA_TYPE='activation_result',code='AutoActivated.CachedCredential',
+				expires_in=int(_CredentialTimeLeft(route[1])),message='Endpoint activated successfully using cached credential'))
+		return self._Error(404,'ClientError.NotFound','No such resource %s %s' % (method,parts.path))
+
+	def _Transfer(self,document):
+		submission_id = document.get('submission_id')
+		if not submission_id or not document.get('DATA'):
+			return self._Error(400,'ClientError.BadRequest','A transfer needs a submission_id and items')
+		# The same submission_id twice is the same task, as with Globus
+		with self.server.lock:
+			if submission_id in self.server.submissions:
+				return self._Reply(200,dict(DATA_TYPE='transfer_result',code='Duplicate',
+					task_id=self.server.submissions[submission_id],submission_id=submission_id,
+					message='A transfer with id %s was already submitted' % submission_id))
+			task_id = str(uuid.uuid1())
+			self.server.submissions[submission_id] = task_id
+		paths = [['%s/%s' % (document['source_endpoint'],item['source_path']),
+			'%s/%s' % (document['destination_endpoint'],item['destination_path'])] for item in document['DATA']]
+		_SubmitTask(task_id,document.get('label',''),paths)
+		self._Reply(202,dict(DATA_TYPE='transfer_result',code='Accepted',task_id=task_id,submission_id=submission_id,
+			message='The transfer has been accepted and a task has been created and queued for execution'))
+
+	def _UpdateTask(self,task_id,document):
+		# Only the label can be changed
+		with self.server.lock:
+			task = _LoadTask(task_id)
+			if task is None:
+				return self._Error(404,'ClientError.NotFound','Task %s not found' % task_id)
+			if 'label' in document:
+				task['label'] = document['label']
+				_SaveTask(task)
+		self._Reply(200,dict(DATA_TYPE='result',code='Updated',resource='/task/%s' % task_id,
+			message='Updated task %s' % task_id))
+
+	def _TaskList(self,query):
+		offset = int(query.get('offset',0))
+		limit = min(int(query.get('limit',10)),1000)
+		(field,sep,values) = query.get('filter','').partition(':')
+		if field == 'task_id':
+			tasks = [task for task in [_LoadTask(task_id) for task_id in values.split(',')] if task is not None]
+		else:
+			tasks = _AllTasks()
+		now = time.time()
+		self._Reply(200,dict(DATA_TYPE='task_list',offset=offset,limit=limit,total=len(tasks),
+			DATA=[_TaskDocument(task,now) for task in tasks[offset:offset+limit]]))
+
+class FakeTransferAPIServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+	'''
+	Serves FakeTransferAPIHandler under base_path, one thread per connection.
+	With a token, requests must carry it as their bearer token.
+	'''
+
+	daemon_threads = True
+
+	def __init__(self,address,base_path='/v0.10',token=None):
+		BaseHTTPServer.HTTPServer.__init__(self,address,FakeTransferAPIHandler)
+		self.base_path = base_path
+		self.token = token
+		self.submissions = dict()
+		self.connections = set()
+		self.lock = threading.Lock()
+
+	def URL(self):
+		return 'http://%s:%d%s' % (self.server_address[0],self.server_address[1],self.base_path)
+
+	def handle_error(self,request,client_address):
+		# A connection closed by either end is not worth a traceback
+		if isinstance(sys.exc_info()[1],socket.error):
+			return
+		BaseHTTPServer.HTTPServer.handle_error(self,request,client_address)
+
+	def DropConnections(self):
+		'''
+		Close every open connection from this end, as a server timing out
+		idle keep-alive connections does.
+		'''
+		with self.lock:
+			connections = list(self.connections)
+		for connection in connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+def StartFakeTransferAPI(port=0,token=None):
+	'''
+	Serve the fake Transfer API on localhost:port (any free port if 0) in
+	a background thread. Returns the server: server.URL() is the base_url
+	for GlobusRESTTransport, server.shutdown() stops it.
+	'''
+	server = FakeTransferAPIServer(('127.0.0.1',port),token=token)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+#------------------------------------------------------------------ fake rsync
+
+def FakeRsync(args):
+	'''
+	Behave like `rsync [options] source [user@host:]destination` for a
+	local destination. Returns the exit code (GLOBUS_FAKE_RSYNC_RC).
+	'''
+	time.sleep(_EnvFloat('GLOBUS_FAKE_RSYNC_LATENCY',0.))
+	returncode = int(_EnvFloat('GLOBUS_FAKE_RSYNC_RC',0))
+	if returncode != 0:
+		sys.stderr.write('rsync error: fake failure (code %d)\n' % returncode)
+		return returncode
+
+	excludes = [arg.split('=',1)[1].strip('\'"') for arg in args if arg.startswith('--exclude=')]
+	remove_source_files = '--remove-source-files' in args
+	paths = [arg for arg in args if not arg.startswith('-')]
+	if len(paths) < 2:
+		sys.stderr.write('rsync: need a source and a destination\n')
+		return 1
+	(source,destination) = (paths[-2],paths[-1])
+	destination = destination.split(':',1)[1] if ':' in destination else destination
+
+	# Like rsync, "dir" (no trailing slash) is copied as destination/dir
+	if not source.endswith('/'):
+		destination = os.path.join(destination,os.path.basename(source))
+	source = source.rstrip('/')
+
+	n_files = 0
+	for (dirpath,dirnames,filenames) in os.walk(source):
+		dirnames[:] = [d for d in dirnames if not [p for p in excludes if fnmatch.fnmatch(d,p)]]
+		target_dir = os.path.join(destination,os.path.relpath(dirpath,source))
+		if not os.path.isdir(target_dir):
+			os.makedirs(target_dir)
+		for name in filenames:
+			if [p for p in excludes if fnmatch.fnmatch(name,p)]:
+				continue
+			source_path = os.path.join(dirpath,name)
+			start = time.time()
+			shutil.copy2(source_path,os.path.join(target_dir,name))
+			size = os.path.getsize(source_path)
+			if remove_source_files:
+				os.remove(source_path)
+			# The same --progress lines as rsync
+			n_files += 1
+			print os.path.relpath(source_path,os.path.dirname(source))
+			print '%15s 100%% %7.2fMB/s    0:00:00 (xfr#%d, to-chk=0/0)' % ('{:,}'.format(size),
+				size/1048576./max(time.time() - start,1e-6),n_files)
+	return 0
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] not in ('ssh','rsync','api'):
+		sys.stderr.write('usage: %s ssh|rsync|api [arguments]\n' % sys.argv[0])
+		sys.exit(2)
+	sys.stdout.flush()
+	if sys.argv[1] == 'api':
+		server = FakeTransferAPIServer(('127.0.0.1',int(sys.argv[2]) if len(sys.argv) > 2 else 0))
+		print 'Serving the fake Transfer API at %s' % server.URL()
+		sys.stdout.flush()
+		server.serve_forever()
+	elif sys.argv[1] == 'ssh':
+		sys.exit(FakeSSH(sys.argv[2:]))
+	else:
+		sys.exit(FakeRsync(sys.argv[2:]))
@@ -0,0 +1,302 @@
+'''
+GlobusManifest_PyMod.py
+
+Per-dataset manifests of (name, size, mtime), to tell when a dataset has
+stopped changing and whether a transfer really delivered everything.
+
+The incoming data complete flag can show up while the last .dat files are
+still being written, and appending to a file doesn't touch the directory's
+mtime, so neither the flag nor DatasetIndex can tell. ManifestTracker takes a
+snapshot of a dataset every so often and calls it quiescent once a number of
+consecutive snapshots are identical:
+
+	tracker = ManifestTracker('/data',ignore_patterns=['globus_transfer_*'])
+	stable = tracker.Snapshot('lux10_20141010T1200',min_interval=10)
+	if stable >= 3: ...	# unchanged for the last 20 s
+
+Snapshots are compared by a cheap fingerprint first (file count, total
+bytes, newest mtime) and entry by entry only when that matches.
+
+A snapshot is built from the previous one: a directory whose mtime hasn't
+changed is not listed again, and of its files only the ones written
+recently (recent_sec before the previous snapshot) are stat'ed again, since
+those are the ones a writer may still be appending to. Settled files in
+settled directories cost nothing, so a big dataset that is still being
+written costs a handful of lstat calls per snapshot instead of a full walk.
+
+ChecksumFiles hashes files on a few threads, and RemoteManifest lists sizes
+(and optionally checksums) of a directory on the destination over ssh, so
+CompareManifests/VerifyDataset can check a finished transfer against what
+actually arrived.
+
+20261017 - Created
+20261017 - A snapshot is built from the previous one: unchanged directories are not listed
+				again and only recently written files in them are stat'ed again
+'''
+
+import hashlib
+import os
+import stat
+import threading
+import time
+from fnmatch import fnmatch
+from Queue import Queue
+from subprocess import Popen, PIPE
+
+class Manifest:
+	'''
+	(size,mtime) of every file under a dataset directory, by relative path.
+	With a previous Manifest of the same directory, only what may have
+	changed since is looked at again (see above).
+	'''
+
+	def __init__(self,path,ignore_patterns=(),previous=None,recent_sec=60.):
+		self.path = path
+		self.time = time.time()
+		self.entries = dict()
+		self.checksums = dict()
+		# relative dir -> (mtime,file names,subdirectory names)
+		self.dirs = dict()
+		self.stat_calls = 0
+		self.ignore_patterns = ignore_patterns
+		self.recent_sec = recent_sec
+		self._Scan('.',previous)
+
+		self.n_files = len(self.entries)
+		self.total_bytes = sum([size for (size,mtime) in self.entries.values()])
+		self.newest_mtime = max([mtime for (size,mtime) in self.entries.values()] or [0])
+
+	def _Lstat(self,path):
+		self.stat_calls += 1
+		return os.lstat(path)
+
+	def _Scan(self,relative_dir,previous):
+		dirpath = os.path.normpath(os.path.join(self.path,relative_dir))
+		try:
+			dir_mtime = self._Lstat(dirpath).st_mtime
+		except OSError:
+			# Deleted while we were looking
+			return
+
+		known = previous is not None and previous.dirs.get(relative_dir)
+		# A directory changed within a second of the last look may have
+		# changed again with the same (coarse) mtime since
+		if known and known[0] == dir_mtime and dir_mtime < previous.time - 1:
+			(filenames,dirnames) = (known[1],known[2])
+			settled_before = previous.time - self.recent_sec
+			for name in filenames:
+				key = name if relative_dir == '.' else os.path.join(relative_dir,name)
+				if key in previous.entries and previous.entries[key][1] < settled_before:
+					self.entries[key] = previous.entries[key]
+					continue
+				try:
+					st = self._Lstat(os.path.join(dirpath,name))
+				except OSError:
+					continue
+				self.entries[key] = (st.st_size,st.st_mtime)
+		else:
+			(filenames,dirnames) = ([],[])
+			try:
+				names = os.listdir(dirpath)
+			except OSError:
+				return
+			for name in names:
+				try:
+					st = self._Lstat(os.path.join(dirpath,name))
+				except OSError:
+					# Deleted while we were looking
+					continue
+				if stat.S_ISDIR(st.st_mode):
+					dirnames.append(name)
+				# Hidden files and the daemon's own markers don't count
+				elif not name.startswith('.') and not [p for p in self.ignore_patterns if fnmatch(name,p)]:
+					filenames.append(name)
+					key = name if relative_dir == '.' else os.path.join(relative_dir,name)
+					self.entries[key] = (st.st_size,st.st_mtime)
+		self.dirs[relative_dir] = (dir_mtime,filenames,dirnames)
+
+		for name in dirnames:
+			self._Scan(name if relative_dir == '.' else os.path.join(relative_dir,name),previous)
+
+	def Fingerprint(self):
+		return (self.n_files,self.total_bytes,self.newest_mtime)
+
+	def Matches(self,other):
+		if other is None or self.Fingerprint() != other.Fingerprint():
+			return False
+		return self.entries == other.entries
+
+	def Diff(self,other):
+		'''
+		(added,removed,changed) names going from other to this manifest.
+		'''
+		added = [name for name in self.entries if name not in other.entries]
+		removed = [name for name in other.entries if name not in self.entries]
+		changed = [name for name in self.entries if name in other.entries and self.entries[name] != other.entries[name]]
+		return added, removed, changed
+
+	def Names(self,pattern=None):
+		return sorted([name for name in self.entries if pattern is None or fnmatch(os.path.basename(name),pattern)])
+
+class ManifestTracker:
+	'''
+	Latest manifest of each dataset under root, and for how many snapshots
+	in a row it hasn't changed.
+	'''
+
+	def __init__(self,root,ignore_patterns=()):
+		self.root = root
+		self.ignore_patterns = list(ignore_patterns)
+		self.manifests = dict()
+		self.stable_counts = dict()
+		self.snapshots = 0
+		self.stat_calls = 0
+
+	def Snapshot(self,dataset,min_interval=0.):
+		'''
+		Take a new snapshot of dataset, unless the last one is less than
+		min_interval seconds old. Returns how many consecutive snapshots
+		matched (1 for a first or changed one).
+		'''
+		previous = self.manifests.get(dataset)
+		if previous is not None and time.time() - previous.time < min_interval:
+			return self.stable_counts[dataset]
+
+		manifest = Manifest(os.path.join(self.root,dataset),self.ignore_patterns,previous)
+		self.snapshots += 1
+		self.stat_calls += manifest.stat_calls
+		self.manifests[dataset] = manifest
+		if manifest.Matches(previous):
+			self.stable_counts[dataset] += 1
+		else:
+			if previous is not None:
+				(added,removed,changed) = manifest.Diff(previous)
+				print '%s is still changing: %d files added, %d removed, %d changed' % (dataset,len(added),len(removed),len(changed))
+			self.stable_counts[dataset] = 1
+		return self.stable_counts[dataset]
+
+	def TimeUntilNextSnapshot(self,dataset,min_interval):
+		manifest = self.manifests.get(dataset)
+		if manifest is None:
+			return 0.
+		return max(0.,manifest.time + min_interval - time.time())
+
+	def StableCount(self,dataset):
+		return self.stable_counts.get(dataset,0)
+
+	def Forget(self,dataset):
+		self.manifests.pop(dataset,None)
+		self.stable_counts.pop(dataset,None)
+
+def _FileChecksum(path,algorithm='md5',block_size=1<<20):
+	h = hashlib.new(algorithm)
+	f = open(path,'rb')
+	try:
+		while True:
+			block = f.read(block_size)
+			if not block:
+				break
+			h.update(block)
+	finally:
+		f.close()
+	return h.hexdigest()
+
+def ChecksumFiles(path,names,workers=4,algorithm='md5'):
+	'''
+	Checksums of the given files (relative to path) on a pool of threads
+	(hashlib lets go of the GIL while hashing). Returns name -> hex digest;
+	files that can't be read are left out.
+	'''
+	checksums = dict()
+	work = Queue()
+	for name in names:
+		work.put(name)
+
+	def Hasher():
+		while True:
+			name = work.get()
+			if name is None:
+				return
+			try:
+				checksums[name] = _FileChecksum(os.path.join(path,name),algorithm)
+			except IOError:
+				pass
+
+	threads = [threading.Thread(target=Hasher) for i in range(max(1,workers))]
+	for t in threads:
+		t.daemon = True
+		t.start()
+		work.put(None)
+	for t in threads:
+		t.join()
+	return checksums
+
+def _RunRemote(ssh_command,user,host,command,timeout):
+	p = Popen([ssh_command,'-o','BatchMode=yes','%s@%s' % (user,host),command], stdout=PIPE, stderr=PIPE)
+	killer = threading.Timer(timeout,p.kill)
+	killer.daemon = True
+	killer.start()
+	try:
+		(out,err) = p.communicate()
+	finally:
+		killer.cancel()
+	if p.returncode != 0:
+		raise IOError('%s on %s exited with code %d: %s' % (command.split()[0],host,p.returncode,err.strip()))
+	return out
+
+def RemoteManifest(user,host,path,ssh_command='ssh',checksums=False,algorithm='md5',timeout=10*60):
+	'''
+	Sizes (and checksums) of the files under path on user@host, as a
+	dictionary relative path -> (size,checksum or None). Raises IOError if
+	the listing fails.
+	'''
+	quoted = "'%s'" % path.replace("'","'\\''")
+	listing = _RunRemote(ssh_command,user,host,"cd %s && find . -type f -printf '%%s %%P\\n'" % quoted,timeout)
+	entries = dict()
+	for line in listing.split('\n'):
+		if line.strip():
+			(size,name) = line.split(' ',1)
+			entries[name] = (int(size),None)
+
+	if checksums:
+		sums = _RunRemote(ssh_command,user,host,'cd %s && find . -type f -print0 | xargs -0 -r %ssum' % (quoted,algorithm),timeout)
+		for line in sums.split('\n'):
+			if line.strip():
+				(digest,name) = line.split(None,1)
+				name = name.lstrip('*')
+				if name.startswith('./'):
+					name = name[2:]
+				if name in entries:
+					entries[name] = (entries[name][0],digest)
+	return entries
+
+def CompareManifests(source,destination,names):
+	'''
+	Check the files in names of a source Manifest against a RemoteManifest.
+	Checksums are compared where both sides have one. Returns a list of
+	problems, empty if everything arrived.
+	'''
+	problems = []
+	for name in names:
+		if name not in destination:
+			problems.append('%s: missing at the destination' % name)
+			continue
+		(size,checksum) = destination[name]
+		if size != source.entries[name][0]:
+			problems.append('%s: %d bytes at the destination, %d at the source' % (name,size,source.entries[name][0]))
+		elif checksum is not None and name in source.checksums and checksum != source.checksums[name]:
+			problems.append('%s: checksum mismatch' % name)
+	return problems
+
+def VerifyDataset(source_path,user,host,destination_path,pattern='*.dat',checksums=False,
+	workers=4,ssh_command='ssh',ignore_patterns=()):
+	'''
+	Compare the files matching pattern in source_path with what is in
+	destination_path on user@host. Returns a list of problems.
+	'''
+	source = Manifest(source_path,ignore_patterns)
+	names = source.Names(pattern)
+	if checksums:
+		source.checksums = ChecksumFiles(source_path,names,workers)
+	destination = RemoteManifest(user,host,destination_path,ssh_command,checksums)
+	return CompareManifests(source,destination,names)
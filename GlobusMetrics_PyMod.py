@@ -0,0 +1,229 @@
+'''
+GlobusMetrics_PyMod.py
+
+Counters, gauges and histograms for the sync daemon and the Globus CLI calls,
+plus a JSONL event log. Everything goes into one module level registry:
+
+	Observe('globus_cli_seconds',0.42,command='details')
+	with Timer('globus_sync_pass_seconds'):
+		...
+	Increment('globus_deleted_bytes_total',stats.bytes)
+	SetGauge('globus_datasets',12,state='active')
+	LogEvent('submitted',dataset='lux10_20141010T1200',transfer_id=transfer_id)
+
+and can be read out in the Prometheus text format, either from a file
+(WritePrometheusFile, written atomically) or from a small local HTTP endpoint
+(StartMetricsServer). Recording a value is a dictionary update under a lock,
+so instrumenting the hot paths costs next to nothing.
+
+20261017 - Created
+'''
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Seconds, from a fast CLI call up to a long rsync/delete
+DEFAULT_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300,600,1800,3600,4*3600,24*3600)
+
+def _LabelKey(labels):
+	return tuple(sorted(labels.items()))
+
+def _FormatLabels(label_key,extra=()):
+	items = list(label_key) + list(extra)
+	if not items:
+		return ''
+	return '{%s}' % ','.join(['%s="%s"' % (k,str(v).replace('\\','\\\\').replace('"','\\"')) for (k,v) in items])
+
+class Histogram:
+	'''
+	Cumulative bucket counts, sum and count for one label set.
+	'''
+
+	def __init__(self,buckets=DEFAULT_BUCKETS):
+		self.buckets = list(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.
+		self.count = 0
+
+	def Observe(self,value):
+		self.counts[bisect.bisect_left(self.buckets,value)] += 1
+		self.sum += value
+		self.count += 1
+
+class MetricsRegistry:
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.counters = dict()
+		self.gauges = dict()
+		self.histograms = dict()
+		self.help = dict()
+
+	def Describe(self,name,help_text):
+		self.help[name] = help_text
+
+	def Increment(self,name,amount=1,**labels):
+		key = _LabelKey(labels)
+		with self._lock:
+			series = self.counters.setdefault(name,dict())
+			series[key] = series.get(key,0) + amount
+
+	def SetGauge(self,name,value,**labels):
+		with self._lock:
+			self.gauges.setdefault(name,dict())[_LabelKey(labels)] = value
+
+	def RemoveGauge(self,name,**labels):
+		with self._lock:
+			self.gauges.get(name,dict()).pop(_LabelKey(labels),None)
+
+	def ClearGauge(self,name):
+		with self._lock:
+			self.gauges[name] = dict()
+
+	def Observe(self,name,value,**labels):
+		key = _LabelKey(labels)
+		with self._lock:
+			series = self.histograms.setdefault(name,dict())
+			if key not in series:
+				series[key] = Histogram()
+			series[key].Observe(value)
+
+	def FormatPrometheus(self):
+		'''
+		All metrics in the Prometheus text exposition format.
+		'''
+		lines = []
+		with self._lock:
+			for (kind,metrics) in (('counter',self.counters),('gauge',self.gauges)):
+				for name in sorted(metrics):
+					if name in self.help:
+						lines.append('# HELP %s %s' % (name,self.help[name]))
+					lines.append('# TYPE %s %s' % (name,kind))
+					for key in sorted(metrics[name]):
+						lines.append('%s%s %s' % (name,_FormatLabels(key),repr(float(metrics[name][key]))))
+
+			for name in sorted(self.histograms):
+				if name in self.help:
+					lines.append('# HELP %s %s' % (name,self.help[name]))
+				lines.append('# TYPE %s histogram' % name)
+				for key in sorted(self.histograms[name]):
+					h = self.histograms[name][key]
+					cumulative = 0
+					for (bound,count) in zip(h.buckets,h.counts):
+						cumulative += count
+						lines.append('%s_bucket%s %d' % (name,_FormatLabels(key,[('le',repr(float(bound)))]),cumulative))
+					lines.append('%s_bucket%s %d' % (name,_FormatLabels(key,[('le','+Inf')]),h.count))
+					lines.append('%s_sum%s %s' % (name,_FormatLabels(key),repr(h.sum)))
+					lines.append('%s_count%s %d' % (name,_FormatLabels(key),h.count))
+
+		return '\n'.join(lines) + '\n'
+
+class Timer:
+	'''
+	with Timer('name',label=value): ... records the elapsed seconds in a
+	histogram. Elapsed time is also available as .seconds afterwards.
+	'''
+
+	def __init__(self,name,**labels):
+		self.name = name
+		self.labels = labels
+		self.seconds = None
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.seconds = time.time() - self.start
+		Observe(self.name,self.seconds,**self.labels)
+		return False
+
+# The registry everything records into
+_registry = MetricsRegistry()
+
+def GetRegistry():
+	return _registry
+
+def Describe(name,help_text):
+	_registry.Describe(name,help_text)
+
+def Increment(name,amount=1,**labels):
+	_registry.Increment(name,amount,**labels)
+
+def SetGauge(name,value,**labels):
+	_registry.SetGauge(name,value,**labels)
+
+def RemoveGauge(name,**labels):
+	_registry.RemoveGauge(name,**labels)
+
+def ClearGauge(name):
+	_registry.ClearGauge(name)
+
+def Observe(name,value,**labels):
+	_registry.Observe(name,value,**labels)
+
+def WritePrometheusFile(path):
+	'''
+	Write all metrics to path (atomically, so a scraper never sees half a file).
+	'''
+	directory = os.path.dirname(os.path.abspath(path))
+	(fd,tmp_path) = tempfile.mkstemp(prefix='.metrics_',dir=directory)
+	try:
+		os.write(fd,_registry.FormatPrometheus())
+	finally:
+		os.close(fd)
+	os.chmod(tmp_path,0644)
+	os.rename(tmp_path,path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		body = _registry.FormatPrometheus()
+		self.send_response(200)
+		self.send_header('Content-Type','text/plain; version=0.0.4')
+		self.send_header('Content-Length',str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self,format,*args):
+		# Don't print a line per scrape
+		pass
+
+def StartMetricsServer(port,host='127.0.0.1'):
+	'''
+	Serve the metrics at http://host:port/ from a background thread.
+	'''
+	server = HTTPServer((host,port),_MetricsHandler)
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+	return server
+
+# JSONL event log, off until SetEventLog is called
+_event_log = None
+_event_log_lock = threading.Lock()
+
+def SetEventLog(path):
+	global _event_log
+	with _event_log_lock:
+		if _event_log is not None:
+			_event_log.close()
+		_event_log = open(path,'a',1) if path else None
+
+def LogEvent(event,**fields):
+	'''
+	Append one {"time":..., "event":..., ...} line to the event log.
+	'''
+	if _event_log is None:
+		return
+	fields['time'] = time.time()
+	fields['event'] = event
+	line = json.dumps(fields,sort_keys=True)
+	with _event_log_lock:
+		if _event_log is not None:
+			_event_log.write(line + '\n')
@@ -0,0 +1,342 @@
+'''
+GlobusScheduler_PyMod.py
+
+Scheduling helpers for GlobusDaemon.
+
+DeadlineScheduler keeps deferred actions ("delete this dataset in 4 minutes",
+"retry the final rsync in 90 seconds") as timers instead of time.sleep calls,
+so the daemon can keep looking at other datasets while one of them waits.
+
+	scheduler = DeadlineScheduler()
+	scheduler.Schedule(240, ('lux10_foo','delete'), daemon.DeleteDataset, 'lux10_foo')
+	...
+	scheduler.RunDue()
+
+AdaptivePoller decides how often each in-flight transfer is worth checking,
+based on how fast it is moving.
+
+SubmissionQueue holds the datasets waiting to be submitted and hands them out
+best first, so when only a few transfer task slots are free they go to the
+datasets that matter most.
+
+20261017 - Created
+20261017 - Added AdaptivePoller
+20261017 - Added SubmissionQueue
+20261017 - AdaptivePoller.Defer: check again later without counting the check as no progress
+'''
+
+import heapq
+import itertools
+import random
+import time
+
+class DeadlineScheduler:
+	'''
+	Keyed one-shot timers ordered by deadline. Scheduling a key that is
+	already pending replaces the old timer.
+	'''
+
+	def __init__(self):
+		self._heap = []
+		self._entries = dict()
+		self._counter = itertools.count()
+
+	def Schedule(self,delay,key,action,*args):
+		'''
+		Run action(*args) delay seconds from now.
+		'''
+		self.ScheduleAt(time.time() + delay,key,action,*args)
+
+	def ScheduleAt(self,deadline,key,action,*args):
+		self.Cancel(key)
+		entry = [deadline,next(self._counter),key,action,args]
+		self._entries[key] = entry
+		heapq.heappush(self._heap,entry)
+
+	def Cancel(self,key):
+		'''
+		Drop a pending timer. Cancelled entries are skipped lazily when popped.
+		'''
+		entry = self._entries.pop(key,None)
+		if entry is not None:
+			entry[3] = None
+
+	def IsScheduled(self,key):
+		return key in self._entries
+
+	def Deadline(self,key):
+		entry = self._entries.get(key)
+		if entry is None:
+			return None
+		return entry[0]
+
+	def _DropCancelled(self):
+		while self._heap and self._heap[0][3] is None:
+			heapq.heappop(self._heap)
+
+	def NextDeadline(self):
+		self._DropCancelled()
+		if not self._heap:
+			return None
+		return self._heap[0][0]
+
+	def TimeUntilNext(self,now=None):
+		'''
+		Seconds until the next timer is due (0 if overdue, None if no timers).
+		'''
+		deadline = self.NextDeadline()
+		if deadline is None:
+			return None
+		if now is None:
+			now = time.time()
+		return max(0.,deadline - now)
+
+	def RunDue(self,now=None):
+		'''
+		Run every timer whose deadline has passed. Returns how many ran.
+		'''
+		if now is None:
+			now = time.time()
+		n_run = 0
+		while True:
+			self._DropCancelled()
+			if not self._heap or self._heap[0][0] > now:
+				break
+			(deadline,count,key,action,args) = heapq.heappop(self._heap)
+			del self._entries[key]
+			action(*args)
+			n_run += 1
+		return n_run
+
+	def __len__(self):
+		return len(self._entries)
+
+class AdaptivePoller:
+	'''
+	Decides when each in-flight transfer should be polled next, from the
+	bytes_transferred/files progress seen between status checks.
+
+	A task that is moving and has a known total is polled at about half its
+	remaining time (so checks get closer together near completion), a task
+	that isn't moving backs off geometrically. Intervals are clamped to
+	[min_interval,max_interval] and jittered so tasks don't all line up.
+	'''
+
+	def __init__(self,min_interval=15,max_interval=30*60,default_interval=2*60,
+		jitter=0.1,smoothing=0.5,backoff=1.5):
+
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.default_interval = default_interval
+		self.jitter = jitter
+		self.smoothing = smoothing
+		self.backoff = backoff
+		self.tasks = dict()
+
+	def Register(self,transfer_id,total_bytes=None,delay=None,now=None):
+		'''
+		Start tracking a freshly submitted task, first poll in delay seconds
+		(default_interval if not given).
+		'''
+		if now is None:
+			now = time.time()
+		if delay is None:
+			delay = self._Jitter(self.default_interval)
+		self.tasks[transfer_id] = dict(time=now,bytes=0,files=0,total_bytes=total_bytes,
+			rate=None,file_rate=None,interval=self.default_interval,next_poll=now + delay)
+
+	def Update(self,transfer_id,bytes_transferred,files=None,total_bytes=None,now=None):
+		'''
+		Feed in the latest status of a task. Returns seconds until it should
+		be polled again.
+		'''
+		if now is None:
+			now = time.time()
+		task = self.tasks.get(transfer_id)
+		if task is None:
+			self.Register(transfer_id,total_bytes,now=now)
+			task = self.tasks[transfer_id]
+			task['bytes'] = bytes_transferred or 0
+			task['files'] = files or 0
+			return task['next_poll'] - now
+
+		if total_bytes:
+			task['total_bytes'] = total_bytes
+
+		elapsed = now - task['time']
+		delta_bytes = (bytes_transferred or 0) - task['bytes']
+		delta_files = (files or 0) - task['files']
+
+		if elapsed > 0 and delta_bytes > 0:
+			rate = delta_bytes/elapsed
+			if task['rate'] is None:
+				task['rate'] = rate
+			else:
+				task['rate'] = self.smoothing*rate + (1-self.smoothing)*task['rate']
+			if delta_files > 0:
+				task['file_rate'] = delta_files/elapsed
+			interval = self._IntervalFromETA(task,bytes_transferred)
+		else:
+			# No progress since last time: back off
+			interval = task['interval']*self.backoff
+
+		interval = min(self.max_interval,max(self.min_interval,interval))
+		task.update(time=now,bytes=bytes_transferred or 0,files=files or 0,interval=interval,
+			next_poll=now + self._Jitter(interval))
+		return task['next_poll'] - now
+
+	def Defer(self,transfer_id,now=None):
+		'''
+		A status check that told nothing about progress (the call failed, or
+		the task isn't running): check again after the task's current
+		interval, leaving its rate and byte count alone. Returns seconds
+		until then.
+		'''
+		if now is None:
+			now = time.time()
+		task = self.tasks.get(transfer_id)
+		if task is None:
+			self.Register(transfer_id,now=now)
+			task = self.tasks[transfer_id]
+		task['next_poll'] = now + self._Jitter(task['interval'])
+		return task['next_poll'] - now
+
+	def _IntervalFromETA(self,task,bytes_transferred):
+		if not task['total_bytes'] or not task['rate']:
+			return self.default_interval
+		remaining = max(0,task['total_bytes'] - bytes_transferred)
+		return remaining/task['rate']/2.
+
+	def _Jitter(self,interval):
+		return interval*(1 + random.uniform(-self.jitter,self.jitter))
+
+	def IsDue(self,transfer_id,now=None,slack=0.):
+		'''
+		Should this task be polled now? Unknown tasks always are.
+		'''
+		task = self.tasks.get(transfer_id)
+		if task is None:
+			return True
+		if now is None:
+			now = time.time()
+		return task['next_poll'] <= now + slack
+
+	def TimeUntilNextPoll(self,now=None):
+		if not self.tasks:
+			return None
+		if now is None:
+			now = time.time()
+		return max(0.,min([task['next_poll'] for task in self.tasks.values()]) - now)
+
+	def GetThroughput(self,transfer_id):
+		'''
+		Smoothed bytes/s of a task, None until it has been seen moving.
+		'''
+		task = self.tasks.get(transfer_id)
+		if task is None:
+			return None
+		return task['rate']
+
+	def GetETA(self,transfer_id):
+		'''
+		Estimated seconds to completion, None if unknown.
+		'''
+		task = self.tasks.get(transfer_id)
+		if task is None or not task['rate'] or not task['total_bytes']:
+			return None
+		return max(0,task['total_bytes'] - task['bytes'])/task['rate']
+
+	def Forget(self,transfer_id):
+		self.tasks.pop(transfer_id,None)
+
+class SubmissionQueue:
+	'''
+	Datasets waiting for a transfer task, best first. A dataset's priority
+	is in seconds, higher goes first: how long it has been queued (times
+	aging_weight), plus a term that depends on order,
+
+		'age'	how old the data is, so the oldest data goes first
+		'size'	minus its transfer time at size_rate bytes/s, so small
+				datasets go first
+		'fifo'	nothing, first come first served
+
+	plus flag_priority[flag] for every flag the dataset has. Because waiting
+	always adds to the priority, a dataset pushed back by its size or flags
+	still goes out eventually.
+	'''
+
+	ORDERS = ('age','size','fifo')
+
+	def __init__(self,order='age',aging_weight=1.,size_rate=100e6,flag_priority=None):
+		if order not in self.ORDERS:
+			raise ValueError('Unknown submission order %r, use one of %s' % (order,', '.join(self.ORDERS)))
+		self.order = order
+		self.aging_weight = aging_weight
+		self.size_rate = size_rate
+		self.flag_priority = dict(flag_priority or dict())
+		self.entries = dict()
+
+	def Add(self,dataset,created=None,n_bytes=None,flags=(),now=None):
+		'''
+		Queue a dataset (created: when its data was taken, n_bytes: its size,
+		flags: names of its flags). Adding one that is already queued
+		updates it but keeps its place in line.
+		'''
+		if now is None:
+			now = time.time()
+		entry = self.entries.get(dataset)
+		if entry is None:
+			entry = self.entries[dataset] = dict(queued=now)
+		entry.update(created=created if created is not None else entry['queued'],
+			bytes=n_bytes or 0,flags=list(flags))
+
+	def Remove(self,dataset):
+		self.entries.pop(dataset,None)
+
+	def Take(self,datasets):
+		'''
+		Remove datasets from the queue. Returns their entries, for Return.
+		'''
+		return dict([(d,self.entries.pop(d)) for d in datasets if d in self.entries])
+
+	def Return(self,entries):
+		'''
+		Put taken datasets back in their old place in line (e.g. their
+		submission failed).
+		'''
+		self.entries.update(entries)
+
+	def __contains__(self,dataset):
+		return dataset in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def Priority(self,dataset,now=None):
+		if now is None:
+			now = time.time()
+		entry = self.entries[dataset]
+		priority = self.aging_weight*(now - entry['queued'])
+		if self.order == 'age':
+			priority += now - entry['created']
+		elif self.order == 'size':
+			priority -= entry['bytes']/float(self.size_rate)
+		for flag in entry['flags']:
+			priority += self.flag_priority.get(flag,0.)
+		return priority
+
+	def Ordered(self,now=None):
+		'''
+		All queued datasets, best first (ties by name).
+		'''
+		if now is None:
+			now = time.time()
+		return sorted(self.entries,key=lambda dataset: (-self.Priority(dataset,now),dataset))
+
+	def Wait(self,dataset,now=None):
+		'''
+		Seconds the dataset has been queued.
+		'''
+		if now is None:
+			now = time.time()
+		return now - self.entries[dataset]['queued']
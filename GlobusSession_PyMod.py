@@ -0,0 +1,359 @@
+'''
+GlobusSession_PyMod.py
+
+Persistent, multiplexed SSH sessions to the hosted Globus CLI. Every call made
+through GlobusTransferTools_PyMod used to fork a fresh ssh and pay for a full
+TCP and key handshake. Here one OpenSSH ControlMaster connection is kept open
+per user/host and every CLI command is sent over it as a new channel.
+
+	session = GetGlobusSession('lux')
+	(out,err,returncode) = session.Run(['details',transfer_id])
+
+The ssh executable is configurable (SetSSHCommand, or per session) so the
+session layer can be exercised against a local fake ssh.
+
+20261017 - Created
+20261017 - CLI call latency and errors are recorded per command in GlobusMetrics_PyMod
+20261017 - CLI calls have a timeout, share a global concurrency limit and can be cancelled
+				through a CancelToken (used by GlobusExecutor_PyMod).
+20261017 - Connect no longer reads the master's output through pipes: the master backgrounded
+				by -f keeps them open, which made Connect hang on OpenSSH before 8.5
+'''
+
+from subprocess import Popen, PIPE
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+from GlobusMetrics_PyMod import Timer, Increment
+
+GLOBUS_CLI_HOST = 'cli.globusonline.org'
+
+# A CLI command still running after this many seconds is killed
+DEFAULT_CLI_TIMEOUT = 10*60
+
+# At most this many CLI commands run at once, whatever thread they come from.
+# sshd allows 10 sessions per multiplexed connection by default (MaxSessions).
+DEFAULT_MAX_CONCURRENT_CLI = 8
+_cli_slots = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENT_CLI)
+
+# Return codes of CLI commands that were killed by us
+TIMED_OUT_RETURNCODE = -9
+CANCELLED_RETURNCODE = -15
+
+def CommandName(command_args):
+	'''
+	Short name of a CLI command for metrics, e.g. 'details' or 'generate-id'.
+	'''
+	if not command_args:
+		return 'none'
+	if '--generate-id' in command_args:
+		return 'generate-id'
+	return command_args[0]
+
+def _Kill(p):
+	try:
+		p.kill()
+	except OSError:
+		# Already gone
+		pass
+
+class CancelToken:
+	'''
+	Shared by the CLI calls made on behalf of one request. Cancel() kills
+	the commands that are running and stops new ones from starting.
+	A thread picks up a token with SetCancelToken.
+	'''
+
+	def __init__(self):
+		self.cancelled = False
+		self.processes = set()
+		self._lock = threading.Lock()
+
+	def Cancel(self):
+		with self._lock:
+			self.cancelled = True
+			processes = list(self.processes)
+		for p in processes:
+			_Kill(p)
+
+	def Track(self,p):
+		with self._lock:
+			if not self.cancelled:
+				self.processes.add(p)
+				return
+		_Kill(p)
+
+	def Untrack(self,p):
+		with self._lock:
+			self.processes.discard(p)
+
+# The CancelToken of the request the current thread is working on, if any
+_call_context = threading.local()
+
+def SetCancelToken(token):
+	_call_context.token = token
+
+def GetCancelToken():
+	return getattr(_call_context,'token',None)
+
+def SetMaxConcurrentCLI(n):
+	'''
+	Change the global limit on CLI commands running at once.
+	'''
+	global _cli_slots
+	_cli_slots = threading.BoundedSemaphore(n)
+
+class GlobusSSHSession:
+	'''
+	One long-lived multiplexed connection to user@host.
+
+	Connect() starts the master, IsAlive() asks it whether it is still up,
+	Run() sends a command over it (reconnecting first if needed) and Close()
+	tears it down.
+	'''
+
+	def __init__(self,user,host=GLOBUS_CLI_HOST,ssh_command='ssh',control_dir=None,
+		idle_timeout=10*60,connect_timeout=30,health_check_interval=60,command_timeout=DEFAULT_CLI_TIMEOUT):
+
+		self.user = user
+		self.host = host
+		self.ssh_command = ssh_command
+		self.idle_timeout = idle_timeout
+		self.connect_timeout = connect_timeout
+		self.health_check_interval = health_check_interval
+		self.command_timeout = command_timeout
+
+		# Control sockets live in a private directory. Unix socket paths are
+		# limited to ~100 characters, so keep the name short.
+		self._own_control_dir = control_dir is None
+		if control_dir is None:
+			control_dir = tempfile.mkdtemp(prefix='globus_ssh_')
+		self.control_dir = control_dir
+		self.control_path = os.path.join(self.control_dir,'%s@%s' % (user,host))
+
+		self.connections_opened = 0
+		self.last_used = 0.
+		self.last_health_check = 0.
+		self._lock = threading.Lock()
+
+	def _BaseArgs(self):
+		return [self.ssh_command,
+			'-o','ControlPath=%s' % self.control_path,
+			'-o','ConnectTimeout=%d' % self.connect_timeout,
+			'-o','BatchMode=yes']
+
+	def _Target(self):
+		return '%s@%s' % (self.user,self.host)
+
+	def _Control(self,operation):
+		# Send a control command (check, exit) to the master
+		args = self._BaseArgs() + ['-O',operation,self._Target()]
+		p = Popen(args, stdout=PIPE, stderr=PIPE)
+		p.communicate()
+		return p.returncode
+
+	def IsAlive(self):
+		'''
+		Health check: is the master connection still up?
+		'''
+		if not os.path.exists(self.control_path):
+			return False
+		return self._Control('check') == 0
+
+	def Connect(self):
+		'''
+		Start the master connection in the background. Returns True on success.
+		'''
+		if not os.path.isdir(self.control_dir):
+			os.makedirs(self.control_dir,0700)
+		args = self._BaseArgs() + ['-M','-N','-f',
+			'-o','ControlMaster=yes',
+			'-o','ServerAliveInterval=30',
+			self._Target()]
+		# With -f the master forks into the background still holding the
+		# stdout and stderr it was started with (OpenSSH before 8.5 never lets
+		# go of them), so reading pipes to EOF would wait for the master to
+		# exit. Only wait for the foreground ssh, with stderr in a file.
+		devnull = open(os.devnull,'r+')
+		errors = tempfile.TemporaryFile()
+		try:
+			with Timer('globus_ssh_connect_seconds'):
+				p = Popen(args, stdin=devnull, stdout=devnull, stderr=errors)
+				p.wait()
+			errors.seek(0)
+			err = errors.read()
+		finally:
+			devnull.close()
+			errors.close()
+		self.connections_opened += 1
+		self.last_health_check = time.time()
+		if p.returncode != 0:
+			print 'Could not open ssh session to %s: %s' % (self._Target(),err.strip())
+			return False
+		return True
+
+	def EnsureConnected(self):
+		'''
+		Reuse the master if it is healthy, otherwise (re)connect. The health
+		check is only repeated every health_check_interval seconds.
+		'''
+		now = time.time()
+		if os.path.exists(self.control_path) and now - self.last_health_check < self.health_check_interval:
+			return True
+		if self.IsAlive():
+			self.last_health_check = now
+			return True
+		# Stale socket left behind by a dead master
+		if os.path.exists(self.control_path):
+			try:
+				os.remove(self.control_path)
+			except OSError:
+				pass
+		return self.Connect()
+
+	def Run(self,command_args,input=None,timeout=None):
+		'''
+		Run a Globus CLI command (list of arguments) over the shared connection.
+		The command is killed after timeout seconds (command_timeout if not
+		given) or when the thread's CancelToken is cancelled.
+		Returns (stdout,stderr,returncode).
+		'''
+		token = GetCancelToken()
+		if token is not None and token.cancelled:
+			return '', 'Cancelled', CANCELLED_RETURNCODE
+		if timeout is None:
+			timeout = self.command_timeout
+
+		with self._lock:
+			self.EnsureConnected()
+			self.last_used = time.time()
+
+		# ControlMaster=auto falls back to a direct connection if the master
+		# went away in the meantime, so a command is never lost.
+		args = self._BaseArgs() + ['-o','ControlMaster=auto',self._Target()] + list(command_args)
+		command = CommandName(command_args)
+		timed_out = []
+		def Expire(p):
+			timed_out.append(True)
+			_Kill(p)
+
+		with _cli_slots:
+			with Timer('globus_cli_seconds',command=command):
+				p = Popen(args, stdin=PIPE if input is not None else None, stdout=PIPE, stderr=PIPE)
+				killer = None
+				if timeout:
+					killer = threading.Timer(timeout,Expire,(p,))
+					killer.daemon = True
+					killer.start()
+				if token is not None:
+					token.Track(p)
+				try:
+					(out,err) = p.communicate(input)
+				finally:
+					if killer is not None:
+						killer.cancel()
+					if token is not None:
+						token.Untrack(p)
+
+		if timed_out:
+			Increment('globus_cli_timeouts_total',command=command)
+			return out, 'Timed out after %g s' % timeout, TIMED_OUT_RETURNCODE
+		if token is not None and token.cancelled:
+			return out, 'Cancelled', CANCELLED_RETURNCODE
+
+		if p.returncode != 0:
+			Increment('globus_cli_errors_total',command=command)
+
+		# 255 is ssh's own failure code: the master is probably gone
+		if p.returncode == 255:
+			self.last_health_check = 0.
+
+		return out, err, p.returncode
+
+	def IsIdle(self,now=None):
+		if now is None:
+			now = time.time()
+		return self.last_used and now - self.last_used > self.idle_timeout
+
+	def Close(self):
+		'''
+		Shut down the master connection and remove the control directory.
+		'''
+		with self._lock:
+			if os.path.exists(self.control_path):
+				self._Control('exit')
+			self.last_health_check = 0.
+			if self._own_control_dir:
+				shutil.rmtree(self.control_dir,ignore_errors=True)
+
+class GlobusSSHPool:
+	'''
+	Keeps one GlobusSSHSession per (user,host) and evicts idle ones.
+	'''
+
+	def __init__(self,ssh_command='ssh',idle_timeout=10*60):
+		self.ssh_command = ssh_command
+		self.idle_timeout = idle_timeout
+		self.sessions = dict()
+		self._lock = threading.Lock()
+
+	def GetSession(self,user,host=GLOBUS_CLI_HOST):
+		self.EvictIdle()
+		with self._lock:
+			key = (user,host)
+			if key not in self.sessions:
+				self.sessions[key] = GlobusSSHSession(user,host,ssh_command=self.ssh_command,
+					idle_timeout=self.idle_timeout)
+			return self.sessions[key]
+
+	def EvictIdle(self):
+		now = time.time()
+		with self._lock:
+			idle = [key for key,session in self.sessions.iteritems() if session.IsIdle(now)]
+			evicted = [self.sessions.pop(key) for key in idle]
+		for session in evicted:
+			print 'Closing idle Globus ssh session %s@%s' % (session.user,session.host)
+			session.Close()
+
+	def CloseAll(self):
+		with self._lock:
+			sessions = self.sessions.values()
+			self.sessions = dict()
+		for session in sessions:
+			session.Close()
+
+	def ConnectionsOpened(self):
+		return sum([s.connections_opened for s in self.sessions.values()])
+
+# Module level pool shared by everything in GlobusTransferTools_PyMod
+_pool = GlobusSSHPool()
+
+def GetGlobusSession(user,host=GLOBUS_CLI_HOST):
+	return _pool.GetSession(user,host)
+
+def GetGlobusPool():
+	return _pool
+
+def SetSSHCommand(ssh_command):
+	'''
+	Point the shared pool at a different ssh executable (e.g. a local fake).
+	Existing sessions are closed.
+	'''
+	global _pool
+	_pool.CloseAll()
+	_pool = GlobusSSHPool(ssh_command=ssh_command,idle_timeout=_pool.idle_timeout)
+
+def RunGlobusCLI(user,command_args,input=None,timeout=None):
+	'''
+	Run one Globus CLI command for user over the pooled session.
+	Returns (stdout,stderr,returncode).
+	'''
+	return GetGlobusSession(user).Run(command_args,input,timeout)
+
+def _CloseAllSessions():
+	_pool.CloseAll()
+
+atexit.register(_CloseAllSessions)
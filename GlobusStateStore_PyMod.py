@@ -0,0 +1,190 @@
+'''
+GlobusStateStore_PyMod.py
+
+Local SQLite record of what GlobusDaemon has done with each dataset: its
+transfer task, label, daemon state, last Globus status, bytes, and when it was
+submitted, finished and freed, plus the history of every status change.
+
+The touch-file markers (globus_transfer_<id>, outgoing done flag) are still
+written, but with this store a restarted daemon knows right away which task
+belongs to which dataset and which tasks already finished, without globbing
+every dataset or asking the CLI again.
+
+	store = GlobusStateStore('/data/.globus_daemon_state.sqlite','/data')
+	store.RecordSubmission('lux10_20141010T1200',transfer_id,label,n_bytes)
+	store.GetDatasetsByStatus('ACTIVE')
+
+20261017 - Created
+20261017 - Creating the tables is retried when several daemons open a new file at once
+20261017 - RecordGone closes the row of a dataset that disappeared before it was freed
+'''
+
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (
+	source_root TEXT NOT NULL,
+	dataset TEXT NOT NULL,
+	transfer_id TEXT,
+	label TEXT,
+	state TEXT,
+	globus_status TEXT,
+	bytes INTEGER,
+	bytes_transferred INTEGER,
+	details TEXT,
+	submit_time REAL,
+	finish_time REAL,
+	freed_time REAL,
+	updated REAL,
+	PRIMARY KEY (source_root, dataset)
+);
+CREATE INDEX IF NOT EXISTS datasets_globus_status ON datasets (source_root, globus_status);
+CREATE INDEX IF NOT EXISTS datasets_transfer_id ON datasets (transfer_id);
+CREATE TABLE IF NOT EXISTS status_history (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	source_root TEXT NOT NULL,
+	dataset TEXT NOT NULL,
+	transfer_id TEXT,
+	state TEXT,
+	globus_status TEXT,
+	time REAL
+);
+CREATE INDEX IF NOT EXISTS status_history_dataset ON status_history (source_root, dataset);
+'''
+
+FINISHED_STATUSES = ('SUCCEEDED','COMPLETE')
+
+class GlobusStateStore:
+	'''
+	Dataset/task life cycle for one source root, kept in a SQLite file in
+	WAL mode (readers don't block the daemon, several daemons can share it).
+	'''
+
+	def __init__(self,db_path,source_root):
+		self.db_path = db_path
+		self.source_root = source_root
+		self._lock = threading.Lock()
+
+		self.db = sqlite3.connect(db_path,timeout=30,check_same_thread=False)
+		self.db.row_factory = sqlite3.Row
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		for attempt in range(5):
+			try:
+				self.db.executescript(SCHEMA)
+				break
+			except sqlite3.OperationalError:
+				# Another daemon on the same file (GlobusSupervisor_PyMod
+				# workers) is creating the tables right now
+				if attempt == 4:
+					raise
+				time.sleep(0.2)
+		self.db.commit()
+
+	def _Upsert(self,dataset,**fields):
+		'''
+		Update the given columns of a dataset's row, creating it if needed,
+		and log the change in status_history if the state or status moved.
+		'''
+		now = time.time()
+		with self._lock:
+			row = self.db.execute('SELECT * FROM datasets WHERE source_root=? AND dataset=?',
+				(self.source_root,dataset)).fetchone()
+			if row is None:
+				self.db.execute('INSERT INTO datasets (source_root,dataset,updated) VALUES (?,?,?)',
+					(self.source_root,dataset,now))
+				old = dict()
+			else:
+				old = dict(zip(row.keys(),row))
+
+			fields['updated'] = now
+			columns = sorted(fields.keys())
+			self.db.execute('UPDATE datasets SET %s WHERE source_root=? AND dataset=?' % ','.join(['%s=?' % c for c in columns]),
+				[fields[c] for c in columns] + [self.source_root,dataset])
+
+			new = dict(old)
+			new.update(fields)
+			if new.get('state') != old.get('state') or new.get('globus_status') != old.get('globus_status'):
+				self.db.execute('INSERT INTO status_history (source_root,dataset,transfer_id,state,globus_status,time) VALUES (?,?,?,?,?,?)',
+					(self.source_root,dataset,new.get('transfer_id'),new.get('state'),new.get('globus_status'),now))
+			self.db.commit()
+
+	def RecordState(self,dataset,state):
+		self._Upsert(dataset,state=state)
+
+	def RecordSubmission(self,dataset,transfer_id,label,n_bytes=None):
+		self._Upsert(dataset,transfer_id=transfer_id,label=label,bytes=n_bytes,
+			globus_status='SUBMITTED',submit_time=time.time(),finish_time=None)
+
+	def RecordTransferStatus(self,dataset,globus_transfer_details):
+		'''
+		Store the latest Globus details of a dataset's task. The details of
+		finished tasks are kept so they never have to be asked for again.
+		'''
+		status = globus_transfer_details['status']
+		fields = dict(transfer_id=globus_transfer_details['transfer_id'],globus_status=status,
+			bytes_transferred=globus_transfer_details.get('bytes_transferred'))
+		if status in FINISHED_STATUSES:
+			fields['details'] = json.dumps(globus_transfer_details)
+			row = self.GetDataset(dataset)
+			if row is None or not row['finish_time']:
+				fields['finish_time'] = time.time()
+		self._Upsert(dataset,**fields)
+
+	def RecordFreed(self,dataset,state='freed'):
+		self._Upsert(dataset,state=state,freed_time=time.time())
+
+	def RecordGone(self,dataset,state='gone'):
+		'''
+		Close the row of a dataset whose directory went away before it was
+		freed, so it isn't resumed after every restart. Datasets without an
+		open row are left alone.
+		'''
+		row = self.GetDataset(dataset)
+		if row is not None and not row['freed_time']:
+			self._Upsert(dataset,state=state,freed_time=time.time())
+
+	def GetDataset(self,dataset):
+		with self._lock:
+			row = self.db.execute('SELECT * FROM datasets WHERE source_root=? AND dataset=?',
+				(self.source_root,dataset)).fetchone()
+		return self._RowDict(row)
+
+	def GetDatasetsByStatus(self,globus_status):
+		'''
+		All datasets whose task last reported globus_status (e.g. ACTIVE).
+		'''
+		with self._lock:
+			rows = self.db.execute('SELECT * FROM datasets WHERE source_root=? AND globus_status=? ORDER BY submit_time',
+				(self.source_root,globus_status)).fetchall()
+		return [self._RowDict(row) for row in rows]
+
+	def GetOpenDatasets(self):
+		'''
+		Datasets that have not been freed yet, to resume from after a restart.
+		'''
+		with self._lock:
+			rows = self.db.execute('SELECT * FROM datasets WHERE source_root=? AND freed_time IS NULL',
+				(self.source_root,)).fetchall()
+		return [self._RowDict(row) for row in rows]
+
+	def GetHistory(self,dataset):
+		with self._lock:
+			rows = self.db.execute('SELECT * FROM status_history WHERE source_root=? AND dataset=? ORDER BY id',
+				(self.source_root,dataset)).fetchall()
+		return [self._RowDict(row) for row in rows]
+
+	def _RowDict(self,row):
+		if row is None:
+			return None
+		row = dict(zip(row.keys(),row))
+		if row.get('details'):
+			row['details'] = json.loads(row['details'])
+		return row
+
+	def Close(self):
+		with self._lock:
+			self.db.close()
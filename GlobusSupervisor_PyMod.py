@@ -0,0 +1,393 @@
+'''
+GlobusSupervisor_PyMod.py
+
+Runs several GlobusDaemon worker processes, over any number of source roots
+and endpoint pairs, from one entry point, and restarts the ones that die.
+
+Each source root (a "pipeline") gets `workers` processes. The lux10* datasets
+of a root are split between its live workers by a consistent hash ring, so a
+worker joining or leaving only moves its own share. On top of that a worker
+holds an fcntl lock (a lease) on every dataset it works on, so two workers
+never submit or delete the same dataset, even while ownership is changing: a
+dataset the ring moves elsewhere stays with its old worker until that one is
+done cleaning it up. A worker's liveness is a lock it holds for as long as it
+runs, so when a process dies the kernel drops its locks and the others take
+over its datasets on their next pass.
+
+	supervisor = GlobusSupervisor([
+		dict(name='disk1',workers=2,daemon=dict(globus_source='lux#daq',...,source_data_dir='/data1/')),
+		dict(name='disk2',workers=2,daemon=dict(globus_source='lux#daq',...,source_data_dir='/data2/'),
+			settings=dict(sleep_time_sec=60)),
+	],log_dir='/var/log/globus')
+	supervisor.Run()
+
+or, with the same thing in a JSON file ({"pipelines": [...], "log_dir": ...}):
+
+	python GlobusSupervisor_PyMod.py supervisor.json
+
+`daemon` holds the GlobusDaemon arguments and `settings` attributes to set on
+the daemon afterwards. metrics_file, metrics_port and event_log are made
+per-worker (file names get the worker ID, ports count up).
+
+20261017 - Created
+'''
+
+import bisect
+import errno
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from GlobusMetrics_PyMod import Increment, SetGauge, LogEvent
+
+class LockFile:
+	'''
+	An exclusive flock() on a file. The kernel releases it when the process
+	dies, however it dies.
+	'''
+
+	def __init__(self,path):
+		self.path = path
+		self.fd = None
+
+	def Acquire(self,blocking=False):
+		'''
+		Take the lock. Returns False if someone else holds it (and blocking
+		is not set).
+		'''
+		while True:
+			fd = os.open(self.path,os.O_RDWR | os.O_CREAT,0644)
+			try:
+				fcntl.flock(fd,fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+			except IOError,e:
+				os.close(fd)
+				if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+					return False
+				raise
+			# The holder may have removed the file between our open and
+			# flock, in which case we locked an orphan: try again
+			try:
+				same_file = os.fstat(fd).st_ino == os.stat(self.path).st_ino
+			except OSError:
+				same_file = False
+			if same_file:
+				self.fd = fd
+				return True
+			os.close(fd)
+
+	def Held(self):
+		return self.fd is not None
+
+	def Release(self,remove=False):
+		if self.fd is None:
+			return
+		if remove:
+			try:
+				os.unlink(self.path)
+			except OSError:
+				pass
+		os.close(self.fd)
+		self.fd = None
+
+def IsLocked(path):
+	'''
+	True if some process holds the lock on path.
+	'''
+	probe = LockFile(path)
+	if probe.Acquire():
+		probe.Release()
+		return False
+	return True
+
+class HashRing:
+	'''
+	Consistent hash ring with `replicas` virtual nodes per node.
+	'''
+
+	def __init__(self,nodes,replicas=64):
+		self.nodes = sorted(nodes)
+		self._ring = sorted([(self._Hash('%s:%d' % (node,i)),node) for node in self.nodes for i in range(replicas)])
+		self._keys = [h for (h,node) in self._ring]
+
+	def _Hash(self,key):
+		return int(hashlib.md5(key).hexdigest()[:16],16)
+
+	def Node(self,key):
+		if not self._ring:
+			return None
+		i = bisect.bisect(self._keys,self._Hash(key)) % len(self._ring)
+		return self._ring[i][1]
+
+class DatasetShard:
+	'''
+	The datasets of one source root that belong to worker_id, out of the
+	workers in worker_ids. Locks live in lock_dir.
+	'''
+
+	def __init__(self,lock_dir,worker_id,worker_ids,replicas=64):
+		if not os.path.isdir(lock_dir):
+			try:
+				os.makedirs(lock_dir)
+			except OSError:
+				# Another worker just made it
+				pass
+		self.lock_dir = lock_dir
+		self.worker_id = worker_id
+		self.worker_ids = sorted(worker_ids)
+		self.replicas = replicas
+		self.liveness = LockFile(self._WorkerPath(worker_id))
+		self.live = None
+		self.ring = None
+		self.leases = dict()
+
+	def _WorkerPath(self,worker_id):
+		return os.path.join(self.lock_dir,'worker_%s.lock' % worker_id)
+
+	def _LeasePath(self,dataset):
+		return os.path.join(self.lock_dir,'%s.lease' % dataset)
+
+	def Join(self):
+		'''
+		Announce this worker as live (waiting for a previous incarnation with
+		the same ID to let go) and build the ring.
+		'''
+		self.liveness.Acquire(blocking=True)
+		self.Refresh()
+
+	def Leave(self):
+		for dataset in self.leases.keys():
+			self.Release(dataset)
+		self.liveness.Release()
+
+	def LiveWorkers(self):
+		return [w for w in self.worker_ids if w == self.worker_id or IsLocked(self._WorkerPath(w))]
+
+	def Refresh(self,busy=()):
+		'''
+		Rebuild the ring if workers came or went, and give up the leases of
+		datasets that now hash to another worker, except those in busy
+		(datasets this worker is in the middle of). Returns True if the
+		ring changed.
+		'''
+		live = self.LiveWorkers()
+		changed = live != self.live
+		if changed:
+			if self.live is not None:
+				print '%s: Workers changed from %s to %s, rebalancing' % (time.ctime(),', '.join(self.live),', '.join(live))
+				Increment('globus_shard_rebalances_total',worker=self.worker_id)
+				LogEvent('rebalance',worker=self.worker_id,live=live)
+			self.live = live
+			self.ring = HashRing(live,self.replicas)
+			SetGauge('globus_shard_live_workers',len(live),worker=self.worker_id)
+
+		for dataset in self.leases.keys():
+			if not self.MapsTo(dataset) and dataset not in busy:
+				self.Release(dataset)
+		SetGauge('globus_shard_leases',len(self.leases),worker=self.worker_id)
+		return changed
+
+	def MapsTo(self,dataset):
+		'''
+		True if the ring gives dataset to this worker.
+		'''
+		return self.ring is None or self.ring.Node(dataset) == self.worker_id
+
+	def Claim(self,dataset):
+		'''
+		True if this worker may work on dataset: it already holds its lease,
+		or the dataset hashes here and the lease could be taken.
+		'''
+		if dataset in self.leases:
+			return True
+		if not self.MapsTo(dataset):
+			return False
+		lease = LockFile(self._LeasePath(dataset))
+		if not lease.Acquire():
+			# Its previous owner is still finishing up with it
+			return False
+		self.leases[dataset] = lease
+		return True
+
+	def Filter(self,datasets):
+		return [d for d in datasets if self.Claim(d)]
+
+	def Release(self,dataset,remove=False):
+		'''
+		Give up a dataset's lease. remove deletes the lease file too, for
+		datasets that are gone.
+		'''
+		lease = self.leases.pop(dataset,None)
+		if lease is not None:
+			lease.Release(remove)
+
+def _PerWorker(path,worker_id):
+	# /var/log/metrics.prom -> /var/log/metrics.disk1-0.prom
+	(base,extension) = os.path.splitext(path)
+	return '%s.%s%s' % (base,worker_id,extension)
+
+def _Str(value):
+	# JSON gives unicode; the daemon expects plain strings
+	if isinstance(value,unicode):
+		return value.encode('utf-8')
+	if isinstance(value,dict):
+		return dict([(_Str(k),_Str(v)) for (k,v) in value.items()])
+	if isinstance(value,list):
+		return [_Str(v) for v in value]
+	return value
+
+def RunWorker(worker_id,worker_ids,lock_dir,daemon_kwargs,settings,log_path=None):
+	'''
+	Body of a worker process: join the shard and run a GlobusDaemon on it.
+	'''
+	# Forked with the supervisor's SIGTERM handler; a worker just exits
+	signal.signal(signal.SIGTERM,signal.SIG_DFL)
+	if log_path:
+		sys.stdout = sys.stderr = open(log_path,'a',1)
+	# Imported here so the supervisor process itself never sets any of it up
+	from SyncGlobus_PyMod import GlobusDaemon
+
+	print '%s: Worker %s starting (pid %d)' % (time.ctime(),worker_id,os.getpid())
+	shard = DatasetShard(lock_dir,worker_id,worker_ids)
+	shard.Join()
+	daemon = GlobusDaemon(shard=shard,**daemon_kwargs)
+	for (name,value) in settings.items():
+		setattr(daemon,name,value)
+	daemon.start_daemon()
+
+class WorkerProcess:
+	'''
+	One worker of a pipeline and its restart bookkeeping.
+	'''
+
+	def __init__(self,worker_id,args,restart_delay):
+		self.worker_id = worker_id
+		self.args = args
+		self.process = None
+		self.started = None
+		self.starts = 0
+		self.restart_at = 0.
+		self.restart_delay = restart_delay
+
+class GlobusSupervisor:
+	'''
+	Starts the workers of every pipeline and keeps them running. A worker
+	that exits is restarted after restart_delay seconds, doubling up to
+	max_restart_delay while it keeps dying quickly.
+	'''
+
+	def __init__(self,pipelines,lock_root=None,log_dir=None,restart_delay=10,max_restart_delay=10*60,check_sec=1):
+		self.restart_delay = restart_delay
+		self.max_restart_delay = max_restart_delay
+		self.check_sec = check_sec
+		self.log_dir = log_dir
+		if log_dir and not os.path.isdir(log_dir):
+			os.makedirs(log_dir)
+		self.workers = []
+		self.stopping = False
+
+		source_roots = dict()
+		for (n,pipeline) in enumerate(pipelines):
+			daemon_kwargs = dict(pipeline['daemon'])
+			source_root = os.path.normpath(os.path.join(daemon_kwargs.get('globus_source_path_root','/'),
+				os.path.expanduser(daemon_kwargs['source_data_dir'])))
+			name = pipeline.get('name') or os.path.basename(source_root)
+			if source_root in source_roots:
+				raise ValueError('Pipelines %s and %s both use %s' % (source_roots[source_root],name,source_root))
+			source_roots[source_root] = name
+
+			if lock_root:
+				lock_dir = os.path.join(lock_root,name)
+			else:
+				lock_dir = os.path.join(source_root,'.globus_supervisor')
+			worker_ids = ['%s-%d' % (name,i) for i in range(pipeline.get('workers',1))]
+			for (i,worker_id) in enumerate(worker_ids):
+				kwargs = dict(daemon_kwargs)
+				for option in ('metrics_file','event_log'):
+					if kwargs.get(option):
+						kwargs[option] = _PerWorker(kwargs[option],worker_id)
+				if kwargs.get('metrics_port'):
+					kwargs['metrics_port'] += i
+				log_path = os.path.join(log_dir,'%s.log' % worker_id) if log_dir else None
+				self.workers.append(WorkerProcess(worker_id,(worker_id,worker_ids,lock_dir,kwargs,
+					dict(pipeline.get('settings',dict())),log_path),restart_delay))
+
+	def StartWorker(self,worker):
+		worker.process = multiprocessing.Process(target=RunWorker,args=worker.args,name=worker.worker_id)
+		worker.process.start()
+		worker.started = time.time()
+		worker.starts += 1
+		print '%s: Started worker %s (pid %d)' % (time.ctime(),worker.worker_id,worker.process.pid)
+		LogEvent('worker_started',worker=worker.worker_id,pid=worker.process.pid,starts=worker.starts)
+
+	def Check(self):
+		'''
+		Notice workers that exited and (re)start the ones that are due.
+		'''
+		now = time.time()
+		for worker in self.workers:
+			if worker.process is not None and not worker.process.is_alive():
+				worker.process.join()
+				if now - worker.started >= self.max_restart_delay:
+					# It ran for a good while: no backoff
+					worker.restart_delay = self.restart_delay
+				print '*** ERROR: Worker %s exited with code %s, restarting it in %g s. Its datasets go to the other workers meanwhile.' % (worker.worker_id,
+					worker.process.exitcode,worker.restart_delay)
+				Increment('globus_supervisor_worker_exits_total',worker=worker.worker_id)
+				LogEvent('worker_exited',worker=worker.worker_id,exitcode=worker.process.exitcode,
+					seconds=now - worker.started)
+				worker.process = None
+				worker.restart_at = now + worker.restart_delay
+				worker.restart_delay = min(2*worker.restart_delay,self.max_restart_delay)
+
+			if worker.process is None and not self.stopping and now >= worker.restart_at:
+				self.StartWorker(worker)
+
+		SetGauge('globus_supervisor_workers',len([w for w in self.workers if w.process is not None]))
+
+	def Stop(self,timeout=30):
+		self.stopping = True
+		running = [w for w in self.workers if w.process is not None and w.process.is_alive()]
+		for worker in running:
+			worker.process.terminate()
+		deadline = time.time() + timeout
+		for worker in running:
+			worker.process.join(max(0.,deadline - time.time()))
+			if worker.process.is_alive():
+				os.kill(worker.process.pid,signal.SIGKILL)
+				worker.process.join()
+
+	def Run(self):
+		print '*** STARTING %d WORKERS ***' % len(self.workers)
+
+		def Terminate(signum,frame):
+			self.stopping = True
+		signal.signal(signal.SIGTERM,Terminate)
+
+		try:
+			while not self.stopping:
+				self.Check()
+				time.sleep(self.check_sec)
+		finally:
+			print '%s: Stopping workers' % time.ctime()
+			self.Stop()
+
+def LoadSupervisor(config_path):
+	'''
+	A GlobusSupervisor from a JSON file holding its arguments.
+	'''
+	f = open(config_path)
+	try:
+		config = _Str(json.load(f))
+	finally:
+		f.close()
+	return GlobusSupervisor(**config)
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print 'usage: python GlobusSupervisor_PyMod.py supervisor.json'
+		sys.exit(1)
+	LoadSupervisor(sys.argv[1]).Run()
@@ -10,32 +10,102 @@ GlobusTransferTools_PyMod.py
 20141125 CHF - Added source_endpoint, destination_endpoint, label to dictionary output
 				in GlobusTransferStatus
 20141126 CHF - Minor bug fix in globus_transfer_details['source_endpoint'] (character was being deleted)
+20261017 - All cli.globusonline.org calls go through the pooled, multiplexed ssh
+				session in GlobusSession_PyMod instead of forking a new ssh each time.
+20261017 - Added GlobusTransferStatusBulk to get the status of many tasks in one call.
+20261017 - Transfer details are parsed by field name following TRANSFER_DETAILS_SCHEMA instead
+				of by line number, with integer byte/file/fault counts. Details of finished
+				tasks are cached. Finished FormatCLIOutputDict.
+20261017 - Added SubmitGlobusTransferBatch to submit many datasets in a few tasks, with the
+				task IDs generated up front (GenerateGlobusTransferIDs).
+20261017 - Added *Async versions of the CLI functions (CLIFutures from GlobusExecutor_PyMod).
+				Bulk status chunks, ID generation and batch submissions run concurrently.
+20261017 - Added GlobusEndpointCredentials (credential status and time left, used by
+				RunGlobusConnect and GlobusEndpoint_PyMod). GlobusActivateEndpoint returns
+				whether the activation worked.
+20261017 - TransferLabel split out of SubmitGlobusTransferTask, and CachedTransferDetails, for the REST transport
+				(GlobusTransport_PyMod), which uses the functions here as its CLI backend.
+20261017 - Padded field names ("Status      : ACTIVE") are matched too. Added ParseTaskList
+				for `task-list` output. Tests with recorded CLI output in tests/.
+20261017 - Added GlobusTaskList (`task-list`, parsed by ParseTaskList).
+20261017 - SubmitGlobusTransferBatch takes the ID and submit functions to use (generate_ids,
+				submit_task), so GlobusTransport.SubmitBatch runs on it instead of a copy.
 '''
 
 from subprocess import Popen, PIPE, STDOUT
 import os
+from GlobusSession_PyMod import RunGlobusCLI
+from GlobusExecutor_PyMod import GetExecutor, WaitAll
+
+def _String(value,user):
+	return value
+
+def _Count(value,user):
+	try:
+		return int(value.replace(',',''))
+	except ValueError:
+		return value
+
+def _Endpoint(value,user):
+	# lux#foo -> foo
+	if value.startswith('%s#' % user):
+		return value[len(user)+1:]
+	return value
+
+# How the fields of `details` output map onto the transfer details dictionary:
+# (CLI field name, dictionary keys, converter)
+TRANSFER_DETAILS_SCHEMA = [
+	('Task ID',					('transfer_id',),				_String),
+	('Task Type',				('task_type',),					_String),
+	('Status',					('status',),					_String),
+	('Completion Time',			('completion_time',),			_String),
+	('Total Tasks',				('tasks_total',),				_String),
+	('Tasks Successful',		('tasks_successful',),			_String),
+	('Tasks Failed',			('tasks_failed',),				_String),
+	('Tasks Pending',			('tasks_pending',),				_String),
+	('Label',					('transfer_name','label'),		_String),
+	('Source Endpoint',			('source_endpoint',),			_Endpoint),
+	('Destination Endpoint',	('destination_endpoint',),		_Endpoint),
+	('Files',					('files',),						_Count),
+	('Files Skipped',			('files_skipped',),				_Count),
+	('Directories',				('directories',),				_Count),
+	('Bytes Transferred',		('bytes_transferred',),			_Count),
+	('Faults',					('faults',),					_Count),
+	]
+_transfer_details_fields = dict([(field_name,(keys,convert)) for (field_name,keys,convert) in TRANSFER_DETAILS_SCHEMA])
+
+# Once a task gets here its details don't change any more (FAILED tasks that
+# get resubmitted are dropped from the cache by SubmitGlobusTransfer)
+TERMINAL_STATUSES = ('SUCCEEDED','COMPLETE','FAILED')
+_terminal_details_cache = dict()
 
 def SubmitGlobusTransfer(source,destination,dataset,user,transfer_id=''):
 
+	return SubmitGlobusTransferTask(source,destination,[dataset],user,transfer_id)
+
+def SubmitGlobusTransferTask(source,destination,datasets,user,transfer_id=''):
+	'''
+	Submit one transfer task that copies every dataset in datasets.
+	Returns (transfer_id,transfer_label), both -1 on failure.
+	'''
+
+	# Resubmitting an existing task: its old final status is no longer final
+	if transfer_id:
+		ForgetTransferStatus(transfer_id)
+
 	# If no transfer ID specified, get a new one
 	if not transfer_id:
-		# Command to generate the unique transfer ID
-		genid_command = 'ssh %s@cli.globusonline.org transfer --generate-id' % user
-		# Execute command
-		p = Popen(genid_command, stdout=PIPE, shell=True)
-		# Grab transfer ID
-		transfer_id = p.communicate()[0].strip() # something that looks like 98d0879c-3919-11e4-b5ed-12313940394d
+		transfer_id = GenerateGlobusTransferIDs(1,user)[0]
 
 	# Give this transfer a more legible, yet unique label
-	from_location = source.split(os.path.sep)[0].split('#')[1]
-	to_location = destination.split(os.path.sep)[0].split('#')[1]
-	transfer_label = '%s_%s_%s_%s' % (dataset,from_location,to_location,transfer_id[:8])
+	transfer_label = TransferLabel(source,destination,datasets,transfer_id)
 
-	# The Globus transfer command
-	transfer_command = '''echo "%s/%s/ %s/%s/ -r" | ssh %s@cli.globusonline.org transfer --taskid='%s' -s 3 --label='%s' ''' % (source,dataset,destination,dataset,user,transfer_id,transfer_label)
+	# The Globus transfer command, the file list (one line per dataset) goes in on stdin
+	transfer_input = ''.join(['%s/%s/ %s/%s/ -r\n' % (source,dataset,destination,dataset) for dataset in datasets])
+	transfer_args = ['transfer','--taskid=%s' % transfer_id,'-s','3','--label=%s' % transfer_label]
 
-	p2 = Popen(transfer_command, stdout=PIPE, shell=True)
-	return_val = p2.communicate()
+	(out,err,returncode) = RunGlobusCLI(user,transfer_args,transfer_input)
+	return_val = (out,err)
 	print return_val
 
 	if return_val[0].find(transfer_id) != -1:
@@ -45,70 +115,334 @@ def SubmitGlobusTransfer(source,destination,dataset,user,transfer_id=''):
 		transfer_label = -1
 		return transfer_id, transfer_label
 
+def TransferLabel(source,destination,datasets,transfer_id):
+	'''
+	lux10_20141010T1200_src_dst_98d0879c, or with _and_<n>_more after the
+	first dataset of a task carrying several.
+	'''
+	from_location = source.split(os.path.sep)[0].split('#')[1]
+	to_location = destination.split(os.path.sep)[0].split('#')[1]
+	if len(datasets) == 1:
+		dataset_label = datasets[0]
+	else:
+		dataset_label = '%s_and_%d_more' % (datasets[0],len(datasets)-1)
+	return '%s_%s_%s_%s' % (dataset_label,from_location,to_location,transfer_id[:8])
+
+def GenerateGlobusTransferIDs(n,user='lux'):
+	'''
+	Get n new transfer IDs up front. The --generate-id calls go out
+	concurrently over the pooled ssh session. IDs that could not be generated
+	come back as empty strings.
+	'''
+
+	def Generate():
+		(genid_out,err,returncode) = RunGlobusCLI(user,['transfer','--generate-id'])
+		if returncode != 0:
+			return ''
+		# Grab transfer ID
+		return genid_out.strip() # something that looks like 98d0879c-3919-11e4-b5ed-12313940394d
+
+	return [transfer_id or '' for transfer_id in GetExecutor().Map(Generate,[()]*n)]
+
+def PackTransferBatches(datasets,max_datasets=20,max_bytes=None,dataset_bytes=None):
+	'''
+	Split datasets (in order) into batches of at most max_datasets datasets and
+	max_bytes bytes (dataset_bytes: dataset -> size). A dataset bigger than
+	max_bytes gets a batch of its own.
+	'''
+	if dataset_bytes is None:
+		dataset_bytes = dict()
+
+	batches = []
+	batch = []
+	batch_bytes = 0
+	for dataset in datasets:
+		size = dataset_bytes.get(dataset) or 0
+		if batch and (len(batch) >= max_datasets or (max_bytes and batch_bytes + size > max_bytes)):
+			batches.append(batch)
+			batch = []
+			batch_bytes = 0
+		batch.append(dataset)
+		batch_bytes += size
+	if batch:
+		batches.append(batch)
+
+	return batches
+
+def SubmitGlobusTransferBatch(source,destination,datasets,user,max_datasets=20,max_bytes=None,dataset_bytes=None,
+	generate_ids=None,submit_task=None):
+	'''
+	Submit many datasets in as few transfer tasks as the limits allow, with
+	all task IDs generated ahead of time. Returns a list of
+	(transfer_id,transfer_label,datasets), one per task; transfer_id and
+	transfer_label are -1 for tasks that could not be submitted.
+	The IDs come from generate_ids(n) and the tasks go out through
+	submit_task(source,destination,datasets,transfer_id), the CLI calls
+	here unless given (a GlobusTransport passes its own).
+	'''
+	if generate_ids is None:
+		generate_ids = lambda n: GenerateGlobusTransferIDs(n,user)
+	if submit_task is None:
+		submit_task = lambda source,destination,datasets,transfer_id: \
+			SubmitGlobusTransferTask(source,destination,datasets,user,transfer_id)
+	batches = PackTransferBatches(datasets,max_datasets,max_bytes,dataset_bytes)
+	transfer_ids = generate_ids(len(batches))
+
+	# The tasks are submitted concurrently
+	executor = GetExecutor()
+	futures = [executor.Submit(submit_task,source,destination,batch,transfer_id)
+		for (batch,transfer_id) in zip(batches,transfer_ids) if transfer_id]
+	WaitAll(futures)
+
+	results = []
+	for (batch,transfer_id) in zip(batches,transfer_ids):
+		if not transfer_id:
+			results.append((-1,-1,batch))
+			continue
+		future = futures.pop(0)
+		if future.exc_info is not None or future.result is None:
+			results.append((-1,-1,batch))
+			continue
+		(transfer_id,transfer_label) = future.result
+		results.append((transfer_id,transfer_label,batch))
+
+	return results
+
 def GlobusTransferStatus(transfer_id,user='lux'):
 
+	# Tasks that already finished never change, don't ask again
+	if transfer_id in _terminal_details_cache:
+		return dict(_terminal_details_cache[transfer_id])
+
 	# Get details for task ID
-	globus_details_command = "ssh -Y %s@cli.globusonline.org details %s" % (user,transfer_id)
-	p = Popen(globus_details_command, stdout=PIPE, shell=True)
-	(globus_details_raw,err) = p.communicate()
+	(globus_details_raw,err,returncode) = RunGlobusCLI(user,['details',transfer_id])
 
 	# Parse output
 	details_raw = globus_details_raw.split('\n\n')
-	details_split = details_raw[0].split('\n')
+
+	return CacheTransferDetails(ParseTransferDetails(details_raw[0],transfer_id,user))
+
+def GlobusTransferStatusBulk(transfer_ids,user='lux',chunk_size=50):
+	'''
+	Get the details of many tasks with one `details id1 id2 ...` call per
+	chunk_size IDs. Returns a dictionary transfer_id -> details dictionary
+	(same format as GlobusTransferStatus). IDs the CLI did not report on are
+	left out.
+	'''
+
+	# Drop duplicates (several datasets can point at the same task) but keep order
+	unique_ids = []
+	for transfer_id in transfer_ids:
+		if transfer_id and transfer_id not in unique_ids:
+			unique_ids.append(transfer_id)
+
+	# Finished tasks come out of the cache
+	all_details = dict()
+	for transfer_id in unique_ids:
+		if transfer_id in _terminal_details_cache:
+			all_details[transfer_id] = dict(_terminal_details_cache[transfer_id])
+	unique_ids = [x for x in unique_ids if x not in all_details]
+
+	# One `details` call per chunk, all chunks at once
+	chunks = [unique_ids[i:i+chunk_size] for i in range(0,len(unique_ids),chunk_size)]
+	outputs = GetExecutor().Map(RunGlobusCLI,[(user,['details'] + chunk) for chunk in chunks])
+
+	for (chunk,output) in zip(chunks,outputs):
+		if output is None:
+			continue
+		(globus_details_raw,err,returncode) = output
+		for transfer_id,details_block in SplitDetailsBlocks(globus_details_raw).iteritems():
+			if transfer_id in chunk:
+				all_details[transfer_id] = CacheTransferDetails(ParseTransferDetails(details_block,transfer_id,user))
+
+	return all_details
+
+def SplitDetailsBlocks(globus_details_raw):
+	'''
+	Split the output of a multi-task `details` call into one block per task.
+	Each block starts at a "Task ID:" line (which may be padded, "Task ID  :")
+	and ends at the next blank line.
+	Returns a dictionary transfer_id -> block.
+	'''
+	blocks = dict()
+	transfer_id = None
+	lines = []
+	for line in globus_details_raw.split('\n'):
+		(field_name,sep,value) = line.partition(': ')
+		if sep and field_name.strip() == 'Task ID':
+			if transfer_id:
+				blocks[transfer_id] = '\n'.join(lines)
+			transfer_id = value.strip()
+			lines = [line]
+		elif not line.strip():
+			if transfer_id:
+				blocks[transfer_id] = '\n'.join(lines)
+			transfer_id = None
+			lines = []
+		elif transfer_id:
+			lines.append(line)
+	if transfer_id:
+		blocks[transfer_id] = '\n'.join(lines)
+
+	return blocks
+
+def ParseTransferDetails(details_block,transfer_id,user='lux'):
+	'''
+	Turn the "Field Name: value" lines of one `details` block into a
+	dictionary following TRANSFER_DETAILS_SCHEMA. Lines are matched by field
+	name, not position, so extra or reordered lines from the CLI don't matter,
+	nor does padding around the field name. Fields missing from the output
+	are None.
+	'''
 
 	# Convert output into a dictionary
 	globus_transfer_details = dict()
+	for (field_name,keys,convert) in TRANSFER_DETAILS_SCHEMA:
+		for key in keys:
+			globus_transfer_details[key] = None
+
+	for line in details_block.split('\n'):
+		(field_name,sep,value) = line.partition(': ')
+		field_name = field_name.strip()
+		if not sep or field_name not in _transfer_details_fields:
+			continue
+		(keys,convert) = _transfer_details_fields[field_name]
+		value = convert(value.strip(),user)
+		for key in keys:
+			globus_transfer_details[key] = value
+
 	globus_transfer_details['transfer_id'] = transfer_id
-	globus_transfer_details['task_type'] = details_split[1].split(': ')[1]
-	globus_transfer_details['status'] = details_split[2].split(': ')[1]
-	globus_transfer_details['completion_time'] = details_split[5].split(': ')[1]
-	globus_transfer_details['tasks_total'] = details_split[6].split(': ')[1]
-	globus_transfer_details['tasks_successful'] = details_split[7].split(': ')[1]
-	globus_transfer_details['tasks_failed'] = details_split[10].split(': ')[1]
-	globus_transfer_details['tasks_pending'] = details_split[11].split(': ')[1]
-	globus_transfer_details['transfer_name'] = details_split[14].split(': ')[1]
-	globus_transfer_details['files'] = details_split[21].split(': ')[1]
-	globus_transfer_details['files_skipped'] = details_split[22].split(': ')[1]
-	globus_transfer_details['directories'] = details_split[23].split(': ')[1]
-	globus_transfer_details['bytes_transferred'] = details_split[25].split(': ')[1]
-	globus_transfer_details['faults'] = details_split[28].split(': ')[1]
-	globus_transfer_details['source_endpoint'] = details_split[15].split(': ')[1].strip('%s' % user).strip('#')
-	globus_transfer_details['destination_endpoint'] = details_split[16].split(': ')[1].strip('%s#' % user)
-	globus_transfer_details['label'] = details_split[14].split(': ')[1]
+	if globus_transfer_details['status'] is None:
+		globus_transfer_details['status'] = 'UNKNOWN'
 
 	return globus_transfer_details
 
-def GlobusActivateEndpoint(globus_endpoint,user='lux'):
-	activation_command = 'ssh %s@cli.globusonline.org endpoint-activate %s' % (user,globus_endpoint)
+def ParseTaskList(globus_task_list_raw,user='lux'):
+	'''
+	The blocks of `task-list` output (the same "Field Name: value" lines as
+	`details`, one blank-line separated block per task) as a list of
+	transfer details dictionaries, in the order listed.
+	'''
+	task_list = []
+	for block in globus_task_list_raw.split('\n\n'):
+		blocks = SplitDetailsBlocks(block)
+		for transfer_id,details_block in blocks.items():
+			task_list.append(ParseTransferDetails(details_block,transfer_id,user))
+	return task_list
+
+def GlobusTaskList(user='lux',filter=None,limit=None):
+	'''
+	Transfer details of the user's tasks from `task-list`, most recent
+	first: all of them, or limit, matching filter (e.g. task_id:<id>,<id>)
+	if given. Raises IOError if the call failed.
+	'''
+	command_args = ['task-list']
+	if limit is not None:
+		command_args += ['-l',str(limit)]
+	if filter:
+		command_args += ['--filter',filter]
+	(globus_task_list_raw,err,returncode) = RunGlobusCLI(user,command_args)
+	if returncode != 0:
+		raise IOError('task-list: %s' % (err.strip() or 'exit code %d' % returncode))
+	return ParseTaskList(globus_task_list_raw,user)
+
+def CacheTransferDetails(globus_transfer_details):
+	'''
+	Remember the details of tasks that reached a final status.
+	'''
+	if globus_transfer_details['status'] in TERMINAL_STATUSES:
+		_terminal_details_cache[globus_transfer_details['transfer_id']] = dict(globus_transfer_details)
+	return globus_transfer_details
 
-	p = Popen(activation_command, stdout=PIPE, shell=True)
-	(activation_details_raw,err) = p.communicate()
+def CachedTransferDetails(transfer_id):
+	'''
+	The details of a task known to be finished, None if it isn't.
+	'''
+	if transfer_id in _terminal_details_cache:
+		return dict(_terminal_details_cache[transfer_id])
+	return None
 
-	print activation_details_raw
+def ForgetTransferStatus(transfer_id):
+	'''
+	Drop a task from the finished-task cache, e.g. when it gets resubmitted.
+	'''
+	_terminal_details_cache.pop(transfer_id,None)
 
-def RunGlobusConnect(globus_endpoint,local_command,user='lux'):
+def GlobusActivateEndpoint(globus_endpoint,user='lux'):
+	(activation_details_raw,err,returncode) = RunGlobusCLI(user,['endpoint-activate',globus_endpoint])
 
-	status_check_command = 'ssh %s@cli.globusonline.org endpoint-list -v -f credential_status %s' % (user,globus_endpoint)
+	print activation_details_raw
 
-	p = Popen(status_check_command, stdout=PIPE, shell=True)
-	(endpoint_details_raw,err) = p.communicate()
+	return returncode == 0
+
+def ParseCredentialTimeLeft(time_left):
+	'''
+	"264:00:00" (hours:minutes:seconds) -> seconds. None if it can't be read.
+	'''
+	try:
+		(hours,minutes,seconds) = time_left.strip().split(':')
+		return int(hours)*3600 + int(minutes)*60 + int(seconds)
+	except (AttributeError,ValueError):
+		return None
+
+def GlobusEndpointCredentials(globus_endpoint,user='lux'):
+	'''
+	Credential status of an endpoint ('ACTIVE', 'EXPIRED', ...) and how many
+	seconds its credential has left (None if not reported). Both are None if
+	the CLI call failed.
+	'''
+	(endpoint_details_raw,err,returncode) = RunGlobusCLI(user,['endpoint-list','-v','-f','credential_status,credential_time_left',globus_endpoint])
+	if returncode != 0:
+		return None, None
+
+	endpoint_details = FormatCLIOutputDict(endpoint_details_raw)
+	return endpoint_details.get('credential_status'), ParseCredentialTimeLeft(endpoint_details.get('credential_time_left'))
 
-	# Parse output
-	endpoint_status = endpoint_details_raw.strip().split(': ')[1]
+def RunGlobusConnect(globus_endpoint,local_command,user='lux'):
+
+	(endpoint_status,time_left) = GlobusEndpointCredentials(globus_endpoint,user)
 
 	print 'Status for %s is %s' % (globus_endpoint,endpoint_status)
 
 	if endpoint_status == 'ACTIVE':
 		print 'Globus Connect currently running for %s. Nothing to do.' % globus_endpoint
 	else:
-		print 'Executing local command to re-animate Globus at %s' % globus_endpoint
-		p = Popen(local_command, stdout=PIPE, shell=True)
-		(out,err) = p.communicate()
+		if local_command:
+			print 'Executing local command to re-animate Globus at %s' % globus_endpoint
+			p = Popen(local_command, stdout=PIPE, shell=True)
+			(out,err) = p.communicate()
 
 		print 'Activating endpoint %s' % globus_endpoint
-		GlobusActivateEndpoint(globus_endpoint,'lux')
+		GlobusActivateEndpoint(globus_endpoint,user)
+
+# Concurrent versions of the CLI functions above. Each returns a CLIFuture
+# right away; timeout (seconds) overrides the executor's call_timeout.
+
+def SubmitGlobusTransferAsync(source,destination,dataset,user,transfer_id='',timeout=None):
+	return GetExecutor().SubmitTimed(timeout or GetExecutor().call_timeout,
+		SubmitGlobusTransfer,source,destination,dataset,user,transfer_id)
+
+def SubmitGlobusTransferTaskAsync(source,destination,datasets,user,transfer_id='',timeout=None):
+	return GetExecutor().SubmitTimed(timeout or GetExecutor().call_timeout,
+		SubmitGlobusTransferTask,source,destination,datasets,user,transfer_id)
+
+def GlobusTransferStatusAsync(transfer_id,user='lux',timeout=None):
+	return GetExecutor().SubmitTimed(timeout or GetExecutor().call_timeout,
+		GlobusTransferStatus,transfer_id,user)
+
+def GlobusActivateEndpointAsync(globus_endpoint,user='lux',timeout=None):
+	return GetExecutor().SubmitTimed(timeout or GetExecutor().call_timeout,
+		GlobusActivateEndpoint,globus_endpoint,user)
+
+def RunGlobusConnectAsync(globus_endpoint,local_command,user='lux',timeout=None):
+	return GetExecutor().SubmitTimed(timeout or GetExecutor().call_timeout,
+		RunGlobusConnect,globus_endpoint,local_command,user)
 
 def FormatCLIOutputDict(globus_details_raw):
+	'''
+	Generic version of the above: every "Field Name: value" line of the first
+	block of CLI output goes in the dictionary as field_name -> value (strings).
+	'''
 
 	output_dict = dict()
 
@@ -117,11 +451,10 @@ def FormatCLIOutputDict(globus_details_raw):
 
 	for line in details_split:
 
-		a = line.split[': '][0]
-		b = line.split[': '][0]
-		field_name = a.lower().replace(' ')
-
-
-
-
+		(a,sep,b) = line.partition(': ')
+		if not sep:
+			continue
+		field_name = a.strip().lower().replace(' ','_').replace('/','_per_')
+		output_dict[field_name] = b.strip()
 
+	return output_dict
@@ -0,0 +1,523 @@
+'''
+GlobusTransport_PyMod.py
+
+How GlobusDaemon talks to Globus. A transport submits transfer tasks, gets
+their status and checks and activates endpoints; the daemon only sees the
+transfer details dictionaries of GlobusTransferTools_PyMod
+(TRANSFER_DETAILS_SCHEMA keys) and the same -1/None failure values.
+
+	GlobusCLITransport	the hosted CLI over the pooled ssh session, with its
+						text output parsed (GlobusTransferTools_PyMod)
+	GlobusRESTTransport	the Globus Transfer REST API, JSON over a pool of
+						keep-alive HTTP(S) connections: no process per call
+						and nothing to scrape
+
+	transport = MakeTransport('rest',user='lux',token=os.environ['GLOBUS_TRANSFER_TOKEN'])
+	(transfer_id,transfer_label) = transport.SubmitTask(source,destination,datasets)
+	all_transfer_details = transport.StatusBulk(transfer_ids)
+
+The REST calls used are GET submission_id, POST transfer, GET and PUT
+task/<id> (the latter to label a new task with its ID), GET task_list (paginated, filtered on task IDs for bulk status), GET
+endpoint/<endpoint> and POST endpoint/<endpoint>/autoactivate. The bearer
+token comes from the token argument or GLOBUS_TRANSFER_TOKEN.
+GlobusFakeCLI_PyMod.StartFakeTransferAPI serves the same calls locally.
+
+20261017 - Created
+20261017 - GlobusCLITransport.TaskList, through GlobusTaskList.
+20261017 - SubmitBatch is SubmitGlobusTransferBatch with the transport's own ID and submit calls.
+20261017 - A REST task is labelled after its task ID (PUT task/<id> once it is known), so the
+				label matches the globus_transfer_<id> marker.
+'''
+
+import httplib
+import json
+import os
+import posixpath
+import socket
+import threading
+import urllib
+import urlparse
+from GlobusTransferTools_PyMod import GenerateGlobusTransferIDs, SubmitGlobusTransferTask, SubmitGlobusTransferBatch
+from GlobusTransferTools_PyMod import GlobusTransferStatus, GlobusTransferStatusBulk, GlobusEndpointCredentials, GlobusActivateEndpoint
+from GlobusTransferTools_PyMod import GlobusTaskList
+from GlobusTransferTools_PyMod import TransferLabel, CacheTransferDetails, CachedTransferDetails, ForgetTransferStatus
+from GlobusTransferTools_PyMod import TRANSFER_DETAILS_SCHEMA
+from GlobusExecutor_PyMod import GetExecutor
+from GlobusSession_PyMod import GetCancelToken
+from GlobusMetrics_PyMod import Timer, Increment
+
+GLOBUS_TRANSFER_API = 'https://transfer.api.globusonline.org/v0.10'
+
+class GlobusTransport:
+	'''
+	What the daemon needs from Globus. Subclasses implement everything but
+	SubmitBatch, which is built on GenerateTransferIDs and SubmitTask.
+	'''
+
+	name = None
+
+	def GenerateTransferIDs(self,n):
+		'''
+		n IDs to submit tasks with, '' for the ones that could not be had.
+		'''
+		raise NotImplementedError
+
+	def SubmitTask(self,source,destination,datasets,transfer_id=''):
+		'''
+		One task copying every dataset of datasets (source and destination
+		are endpoint/path/). Returns (transfer_id,transfer_label), both -1
+		on failure. The returned transfer_id is the task's from then on.
+		'''
+		raise NotImplementedError
+
+	def SubmitBatch(self,source,destination,datasets,max_datasets=20,max_bytes=None,dataset_bytes=None):
+		'''
+		SubmitGlobusTransferBatch through this transport: a list of
+		(transfer_id,transfer_label,datasets), one per task.
+		'''
+		return SubmitGlobusTransferBatch(source,destination,datasets,self.user,max_datasets,max_bytes,dataset_bytes,
+			self.GenerateTransferIDs,self.SubmitTask)
+
+	def Status(self,transfer_id):
+		'''
+		Transfer details dictionary of one task (status 'UNKNOWN' if it
+		could not be had).
+		'''
+		raise NotImplementedError
+
+	def StatusBulk(self,transfer_ids):
+		'''
+		transfer_id -> transfer details for as many of transfer_ids as
+		could be had.
+		'''
+		raise NotImplementedError
+
+	def EndpointCredentials(self,endpoint):
+		'''
+		(credential status, seconds left), both None if unknown.
+		'''
+		raise NotImplementedError
+
+	def ActivateEndpoint(self,endpoint):
+		'''
+		True if the endpoint was (or already is) activated.
+		'''
+		raise NotImplementedError
+
+	def TaskList(self,filter=None,limit=None):
+		'''
+		Transfer details of the user's tasks, most recent first: all of
+		them or limit, matching filter (task_id:<id>,<id>) if given. Raises
+		IOError if they can't be had.
+		'''
+		raise NotImplementedError
+
+	def Close(self):
+		pass
+
+class GlobusCLITransport(GlobusTransport):
+	'''
+	The functions of GlobusTransferTools_PyMod, run as user.
+	'''
+
+	name = 'cli'
+
+	def __init__(self,user='lux'):
+		self.user = user
+
+	def GenerateTransferIDs(self,n):
+		return GenerateGlobusTransferIDs(n,self.user)
+
+	def SubmitTask(self,source,destination,datasets,transfer_id=''):
+		return SubmitGlobusTransferTask(source,destination,datasets,self.user,transfer_id)
+
+	def Status(self,transfer_id):
+		return GlobusTransferStatus(transfer_id,self.user)
+
+	def StatusBulk(self,transfer_ids):
+		return GlobusTransferStatusBulk(transfer_ids,self.user)
+
+	def EndpointCredentials(self,endpoint):
+		return GlobusEndpointCredentials(endpoint,self.user)
+
+	def ActivateEndpoint(self,endpoint):
+		return GlobusActivateEndpoint(endpoint,self.user)
+
+	def TaskList(self,filter=None,limit=None):
+		return GlobusTaskList(self.user,filter,limit)
+
+class HTTPConnectionPool:
+	'''
+	Up to size persistent connections to the host of url, each reused for
+	as many requests as the server keeps it open.
+	'''
+
+	def __init__(self,url,size=8,timeout=60):
+		parts = urlparse.urlsplit(url)
+		self.scheme = parts.scheme
+		self.host = parts.hostname
+		self.port = parts.port
+		self.base_path = parts.path.rstrip('/')
+		self.size = size
+		self.timeout = timeout
+		self.connections_opened = 0
+		self._idle = []
+		self._slots = threading.BoundedSemaphore(size)
+		self._lock = threading.Lock()
+
+	def _Connect(self):
+		if self.scheme == 'https':
+			connection = httplib.HTTPSConnection(self.host,self.port,timeout=self.timeout)
+		else:
+			connection = httplib.HTTPConnection(self.host,self.port,timeout=self.timeout)
+		with self._lock:
+			self.connections_opened += 1
+		Increment('globus_rest_connections_total')
+		return connection
+
+	def _Send(self,connection,method,path,body,headers):
+		connection.request(method,self.base_path + path,body,headers)
+		return connection.getresponse()
+
+	def Request(self,method,path,body=None,headers=None):
+		'''
+		Send a request for path (below the url's path) and read the whole
+		response. Returns (status,body). Raises httplib.HTTPException or
+		socket.error if the server can't be reached.
+		'''
+		headers = dict(headers or dict())
+		with self._slots:
+			with self._lock:
+				connection = self._idle.pop() if self._idle else None
+			reused = connection is not None
+			if not reused:
+				connection = self._Connect()
+			try:
+				try:
+					response = self._Send(connection,method,path,body,headers)
+				except (httplib.HTTPException,socket.error):
+					connection.close()
+					if not reused:
+						raise
+					# The server dropped the idle connection: once more on a new
+					# one. This is safe for transfers too, which Globus won't
+					# run twice for the same submission_id.
+					connection = self._Connect()
+					response = self._Send(connection,method,path,body,headers)
+				data = response.read()
+			except:
+				connection.close()
+				raise
+			if response.will_close:
+				connection.close()
+			else:
+				with self._lock:
+					self._idle.append(connection)
+		return response.status, data
+
+	def Close(self):
+		with self._lock:
+			idle = self._idle
+			self._idle = []
+		for connection in idle:
+			connection.close()
+
+def _Text(value,user):
+	if isinstance(value,unicode):
+		return value.encode('utf-8')
+	return value
+
+def _Number(value,user):
+	# The CLI's task counts are strings
+	if value is None:
+		return None
+	return str(value)
+
+def _Count(value,user):
+	if value is None:
+		return None
+	try:
+		return int(value)
+	except (TypeError,ValueError):
+		return value
+
+def _Endpoint(value,user):
+	value = _Text(value,user)
+	if value and value.startswith('%s#' % user):
+		return value[len(user)+1:]
+	return value
+
+# How the fields of a task document map onto the transfer details dictionary
+# (the keys of TRANSFER_DETAILS_SCHEMA): (task field, dictionary keys, converter)
+TASK_DOCUMENT_SCHEMA = [
+	('task_id',					('transfer_id',),				_Text),
+	('type',					('task_type',),					_Text),
+	('status',					('status',),					_Text),
+	('completion_time',			('completion_time',),			_Text),
+	('subtasks_total',			('tasks_total',),				_Number),
+	('subtasks_succeeded',		('tasks_successful',),			_Number),
+	('subtasks_failed',			('tasks_failed',),				_Number),
+	('subtasks_pending',		('tasks_pending',),				_Number),
+	('label',					('transfer_name','label'),		_Text),
+	('source_endpoint',			('source_endpoint',),			_Endpoint),
+	('destination_endpoint',	('destination_endpoint',),		_Endpoint),
+	('files',					('files',),						_Count),
+	('files_skipped',			('files_skipped',),				_Count),
+	('directories',				('directories',),				_Count),
+	('bytes_transferred',		('bytes_transferred',),			_Count),
+	('faults',					('faults',),					_Count),
+	]
+
+def ParseTaskDocument(task,transfer_id,user='lux'):
+	'''
+	Turn a task document (dictionary from JSON, or None) into a transfer
+	details dictionary, the same as ParseTransferDetails makes of CLI output.
+	'''
+	globus_transfer_details = dict()
+	for (field_name,keys,convert) in TRANSFER_DETAILS_SCHEMA:
+		for key in keys:
+			globus_transfer_details[key] = None
+
+	for (field_name,keys,convert) in TASK_DOCUMENT_SCHEMA:
+		if task is None or field_name not in task:
+			continue
+		value = convert(task[field_name],user)
+		for key in keys:
+			globus_transfer_details[key] = value
+
+	globus_transfer_details['transfer_id'] = transfer_id
+	if globus_transfer_details['status'] is None:
+		globus_transfer_details['status'] = 'UNKNOWN'
+
+	return globus_transfer_details
+
+def SplitGlobusPath(globus_path):
+	# lux#src//data/lux10_foo/ -> ('lux#src','/data/lux10_foo/')
+	(endpoint,sep,path) = globus_path.partition('/')
+	return endpoint, '/' + path.lstrip('/')
+
+class GlobusRESTTransport(GlobusTransport):
+	'''
+	The Globus Transfer API at base_url, with the bearer token (or
+	GLOBUS_TRANSFER_TOKEN) and at most pool_size connections open at once.
+	Requests time out after timeout seconds. Task lists are fetched
+	page_size tasks at a time.
+	'''
+
+	name = 'rest'
+
+	def __init__(self,user='lux',base_url=GLOBUS_TRANSFER_API,token=None,pool_size=8,timeout=60,page_size=100):
+		self.user = user
+		self.base_url = base_url
+		self.token = token if token is not None else os.environ.get('GLOBUS_TRANSFER_TOKEN')
+		self.page_size = page_size
+		self.pool = HTTPConnectionPool(base_url,pool_size,timeout)
+		# Submission IDs handed out by GenerateTransferIDs and not used yet.
+		# Anything else passed to SubmitTask is the ID of an earlier task.
+		self.submission_ids = set()
+		self._lock = threading.Lock()
+
+	def Request(self,call,method,path,query=None,document=None):
+		'''
+		One API call (call names it in the metrics). Returns the JSON
+		document of the response. Raises IOError if the call failed, with
+		the API's error code and message.
+		'''
+		token = GetCancelToken()
+		if token is not None and token.cancelled:
+			raise IOError('%s %s: cancelled' % (method,path))
+		if query:
+			path = '%s?%s' % (path,urllib.urlencode(sorted(query.items())))
+		headers = {'Accept':'application/json'}
+		if self.token:
+			headers['Authorization'] = 'Bearer %s' % self.token
+		body = None
+		if document is not None:
+			body = json.dumps(document)
+			headers['Content-Type'] = 'application/json'
+
+		with Timer('globus_rest_seconds',call=call):
+			try:
+				(status,data) = self.pool.Request(method,path,body,headers)
+			except (httplib.HTTPException,socket.error),e:
+				Increment('globus_rest_errors_total',call=call)
+				raise IOError('%s %s: %s' % (method,path,e or e.__class__.__name__))
+
+		try:
+			result = json.loads(data) if data else dict()
+		except ValueError:
+			result = None
+		if status >= 300 or not isinstance(result,dict):
+			Increment('globus_rest_errors_total',call=call)
+			if isinstance(result,dict):
+				raise IOError('%s %s: %d %s: %s' % (method,path,status,result.get('code'),result.get('message')))
+			raise IOError('%s %s: %d %s' % (method,path,status,data[:200].strip()))
+		return result
+
+	def _SubmissionID(self):
+		try:
+			submission_id = _Text(self.Request('submission_id','GET','/submission_id')['value'],self.user)
+		except (IOError,KeyError),e:
+			print 'Could not get a submission ID: %s' % e
+			return ''
+		with self._lock:
+			self.submission_ids.add(submission_id)
+		return submission_id
+
+	def GenerateTransferIDs(self,n):
+		return [submission_id or '' for submission_id in GetExecutor().Map(self._SubmissionID,[()]*n)]
+
+	def SubmitTask(self,source,destination,datasets,transfer_id=''):
+
+		# Resubmitting an existing task: it gets a new task ID, but drop
+		# the old one's final status anyway
+		with self._lock:
+			if transfer_id in self.submission_ids:
+				self.submission_ids.discard(transfer_id)
+				submission_id = transfer_id
+			else:
+				ForgetTransferStatus(transfer_id)
+				submission_id = ''
+		if not submission_id:
+			submission_id = self._SubmissionID()
+			if not submission_id:
+				return -1, -1
+			with self._lock:
+				self.submission_ids.discard(submission_id)
+
+		# Labelled after the submission ID for now: the task ID it should
+		# carry, like the globus_transfer_<id> markers, comes back below
+		transfer_label = TransferLabel(source,destination,datasets,submission_id)
+		(source_endpoint,source_path) = SplitGlobusPath(source)
+		(destination_endpoint,destination_path) = SplitGlobusPath(destination)
+		items = [dict(DATA_TYPE='transfer_item',recursive=True,
+			source_path=posixpath.join(source_path,dataset) + '/',
+			destination_path=posixpath.join(destination_path,dataset) + '/') for dataset in datasets]
+		document = dict(DATA_TYPE='transfer',submission_id=submission_id,label=transfer_label,
+			source_endpoint=source_endpoint,destination_endpoint=destination_endpoint,
+			sync_level=3,DATA=items)
+
+		try:
+			result = self.Request('transfer','POST','/transfer',document=document)
+		except IOError,e:
+			print 'Transfer submission failed: %s' % e
+			return -1, -1
+		print 'Submitted %s: %s %s' % (result.get('task_id'),result.get('code'),result.get('message') or '')
+		if not result.get('task_id'):
+			return -1, -1
+		transfer_id = _Text(result['task_id'],self.user)
+		return transfer_id, self.Relabel(transfer_id,TransferLabel(source,destination,datasets,transfer_id),transfer_label)
+
+	def Relabel(self,transfer_id,label,current_label=None):
+		'''
+		Give a task a new label. Returns the label the task has afterwards:
+		current_label if the update failed.
+		'''
+		try:
+			self.Request('task_update','PUT','/task/%s' % urllib.quote(transfer_id,safe=''),
+				document=dict(DATA_TYPE='task',label=label))
+		except IOError,e:
+			print 'Could not label %s as %s: %s' % (transfer_id,label,e)
+			return current_label
+		return label
+
+	def Status(self,transfer_id):
+
+		# Tasks that already finished never change, don't ask again
+		cached = CachedTransferDetails(transfer_id)
+		if cached is not None:
+			return cached
+
+		try:
+			task = self.Request('task','GET','/task/%s' % urllib.quote(transfer_id,safe=''))
+		except IOError,e:
+			print 'Could not get the status of %s: %s' % (transfer_id,e)
+			task = None
+		return CacheTransferDetails(ParseTaskDocument(task,transfer_id,self.user))
+
+	def StatusBulk(self,transfer_ids,chunk_size=50):
+		'''
+		Same as GlobusTransferStatusBulk, with one task_list query (filtered
+		on up to chunk_size task IDs) per chunk.
+		'''
+		unique_ids = []
+		for transfer_id in transfer_ids:
+			if transfer_id and transfer_id not in unique_ids:
+				unique_ids.append(transfer_id)
+
+		all_details = dict()
+		for transfer_id in unique_ids:
+			cached = CachedTransferDetails(transfer_id)
+			if cached is not None:
+				all_details[transfer_id] = cached
+		unique_ids = [x for x in unique_ids if x not in all_details]
+
+		def ListChunk(chunk):
+			try:
+				return self.TaskList('task_id:%s' % ','.join(chunk))
+			except IOError,e:
+				print 'Could not get the status of %d tasks: %s' % (len(chunk),e)
+				return None
+
+		chunks = [unique_ids[i:i+chunk_size] for i in range(0,len(unique_ids),chunk_size)]
+		for (chunk,task_details) in zip(chunks,GetExecutor().Map(ListChunk,[(chunk,) for chunk in chunks])):
+			for details in task_details or []:
+				if details['transfer_id'] in chunk:
+					all_details[details['transfer_id']] = CacheTransferDetails(details)
+
+		return all_details
+
+	def TaskList(self,filter=None,limit=None):
+		'''
+		Follows the pages of task_list until limit tasks (all if None) or
+		the end. Raises IOError if a page can't be had.
+		'''
+		all_details = []
+		offset = 0
+		while limit is None or len(all_details) < limit:
+			query = dict(offset=offset,limit=self.page_size if limit is None else min(self.page_size,limit - len(all_details)))
+			if filter:
+				query['filter'] = filter
+			page = self.Request('task_list','GET','/task_list',query)
+			tasks = page.get('DATA') or []
+			for task in tasks:
+				all_details.append(ParseTaskDocument(task,_Text(task.get('task_id'),self.user),self.user))
+			offset += len(tasks)
+			if not tasks or offset >= page.get('total',0):
+				break
+		return all_details
+
+	def EndpointCredentials(self,endpoint):
+		try:
+			document = self.Request('endpoint','GET','/endpoint/%s' % urllib.quote(endpoint,safe=''))
+		except IOError,e:
+			print 'Could not get endpoint %s: %s' % (endpoint,e)
+			return None, None
+		expires_in = document.get('expires_in')
+		if expires_in is None or expires_in < 0:
+			expires_in = None
+		return ('ACTIVE' if document.get('activated') else 'EXPIRED'), expires_in
+
+	def ActivateEndpoint(self,endpoint):
+		try:
+			result = self.Request('autoactivate','POST','/endpoint/%s/autoactivate' % urllib.quote(endpoint,safe=''),document=dict())
+		except IOError,e:
+			print 'Could not activate endpoint %s: %s' % (endpoint,e)
+			return False
+		code = result.get('code') or ''
+		print '%s: %s' % (code,result.get('message') or '')
+		return code.startswith('AutoActivated') or code.startswith('AlreadyActivated')
+
+	def Close(self):
+		self.pool.Close()
+
+TRANSPORTS = dict(cli=GlobusCLITransport,rest=GlobusRESTTransport)
+
+def MakeTransport(kind='cli',user='lux',**options):
+	'''
+	A transport by name ('cli' or 'rest'), as user, with the options of its
+	constructor (base_url, token, pool_size ... for 'rest').
+	'''
+	if kind not in TRANSPORTS:
+		raise ValueError('Unknown Globus transport %r, use one of %s' % (kind,', '.join(sorted(TRANSPORTS))))
+	return TRANSPORTS[kind](user,**options)
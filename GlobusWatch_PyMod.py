@@ -0,0 +1,269 @@
+'''
+GlobusWatch_PyMod.py
+
+Change detection for the source data directory. GlobusDaemon used to find new
+flag files by listing everything every sleep_time_sec; DatasetWatcher wakes it
+up as soon as something it cares about shows up instead:
+
+	- a lux10* dataset directory appearing or disappearing in the source root
+	- a flag file (incoming data complete, delete_dat_files, ...) or a
+	  globus_transfer_* marker appearing in a dataset directory
+
+On Linux this uses inotify (through ctypes, no extra packages needed). Anywhere
+else, or if inotify can't be set up, it falls back to polling directory mtimes.
+
+	watcher = DatasetWatcher(source_root,'lux10',['incoming_done','delete_dat_files'])
+	changed = watcher.Wait(120)	# set of dataset names, or None for "rescan everything"
+
+20261017 - Created
+20261017 - Ignore: files the daemon writes itself (its transfer markers) don't wake it up
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from fnmatch import fnmatch
+from glob import glob
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+ROOT_MASK = IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM | IN_ONLYDIR
+DATASET_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+def _LoadInotify():
+	'''
+	Returns the libc handle if inotify is usable here, otherwise None.
+	'''
+	if not os.uname()[0] == 'Linux':
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+		libc.inotify_init1
+		libc.inotify_add_watch
+		libc.inotify_rm_watch
+	except (OSError,AttributeError):
+		return None
+	libc.inotify_add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+	return libc
+
+class DatasetWatcher:
+	'''
+	Watches a source root and its dataset directories.
+
+	mode is 'auto' (inotify if available, else polling), 'inotify' or 'poll'.
+	'''
+
+	def __init__(self,root,dataset_prefix='lux10',flag_names=(),marker_prefix='globus_transfer_',
+		mode='auto',poll_interval=5):
+
+		self.root = root
+		self.dataset_prefix = dataset_prefix
+		self.flag_names = list(flag_names)
+		self.marker_prefix = marker_prefix
+		self.poll_interval = poll_interval
+
+		self._libc = None
+		self._fd = None
+		self._wd_to_dataset = dict()
+		self._dataset_to_wd = dict()
+		self._poll_state = dict()
+		# dataset -> names of files the caller writes itself (Ignore)
+		self._ignored = dict()
+
+		if mode in ('auto','inotify'):
+			self._libc = _LoadInotify()
+			if self._libc is not None:
+				self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+				if self._fd < 0:
+					self._fd = None
+			if self._fd is None and mode == 'inotify':
+				raise OSError('inotify is not available')
+
+		if self._fd is not None:
+			self.mode = 'inotify'
+			self._AddWatch(self.root,None,ROOT_MASK)
+			for dataset in self._ListDatasets():
+				self._AddWatch(os.path.join(self.root,dataset),dataset,DATASET_MASK)
+		else:
+			self.mode = 'poll'
+			self._poll_state = self._PollSnapshot()
+
+	def IsInteresting(self,name):
+		'''
+		Is a file with this name inside a dataset worth waking up for?
+		'''
+		if name.startswith(self.marker_prefix):
+			return True
+		for flag_name in self.flag_names:
+			if fnmatch(name,flag_name):
+				return True
+		return False
+
+	def Ignore(self,dataset,name):
+		'''
+		Don't wake up for name being created, renamed or removed in dataset:
+		the caller is doing it itself (e.g. its own transfer markers).
+		'''
+		self._ignored.setdefault(dataset,set()).add(name)
+
+	def _IsIgnored(self,dataset,name):
+		return name in self._ignored.get(dataset,())
+
+	def _ListDatasets(self):
+		try:
+			names = os.listdir(self.root)
+		except OSError:
+			return []
+		return [x for x in names if x.startswith(self.dataset_prefix) and os.path.isdir(os.path.join(self.root,x))]
+
+	def _AddWatch(self,path,dataset,mask):
+		wd = self._libc.inotify_add_watch(self._fd,path,mask)
+		if wd < 0:
+			err = ctypes.get_errno()
+			if err not in (errno.ENOENT,errno.ENOTDIR):
+				print 'Could not watch %s: %s' % (path,os.strerror(err))
+			return
+		self._wd_to_dataset[wd] = dataset
+		if dataset is not None:
+			self._dataset_to_wd[dataset] = wd
+
+	def Wait(self,timeout):
+		'''
+		Block for up to timeout seconds. Returns the set of datasets that
+		changed (empty on timeout), or None if the caller should rescan
+		everything (event queue overflow).
+		'''
+		if self.mode == 'inotify':
+			return self._WaitInotify(timeout)
+		return self._WaitPoll(timeout)
+
+	def _WaitInotify(self,timeout):
+		deadline = time.time() + max(0.,timeout)
+		changed = set()
+		while True:
+			remaining = max(0.,deadline - time.time())
+			try:
+				readable = select.select([self._fd],[],[],remaining)[0]
+			except select.error,e:
+				if e[0] == errno.EINTR:
+					continue
+				raise
+			if not readable:
+				return changed
+
+			result = self._ReadEvents(changed)
+			if result is None:
+				return None
+			if changed:
+				return changed
+
+	def _ReadEvents(self,changed):
+		try:
+			data = os.read(self._fd,64*1024)
+		except OSError,e:
+			if e.errno == errno.EAGAIN:
+				return changed
+			raise
+
+		offset = 0
+		while offset + _EVENT_HEADER.size <= len(data):
+			(wd,mask,cookie,length) = _EVENT_HEADER.unpack_from(data,offset)
+			offset += _EVENT_HEADER.size
+			name = data[offset:offset+length].rstrip('\0')
+			offset += length
+
+			if mask & IN_Q_OVERFLOW:
+				return None
+
+			if mask & IN_IGNORED:
+				dataset = self._wd_to_dataset.pop(wd,None)
+				if dataset is not None and self._dataset_to_wd.get(dataset) == wd:
+					del self._dataset_to_wd[dataset]
+				continue
+
+			if wd not in self._wd_to_dataset:
+				continue
+			dataset = self._wd_to_dataset[wd]
+
+			# Event in the source root: only dataset directories matter
+			if dataset is None:
+				if not (mask & IN_ISDIR) or not name.startswith(self.dataset_prefix):
+					continue
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					self._AddWatch(os.path.join(self.root,name),name,DATASET_MASK)
+				else:
+					self._ignored.pop(name,None)
+				changed.add(name)
+
+			# Event in a dataset directory: only flags and transfer markers matter
+			elif self.IsInteresting(name) and not self._IsIgnored(dataset,name):
+				changed.add(dataset)
+
+		return changed
+
+	def _PollSnapshot(self):
+		'''
+		mtime of every dataset directory, plus the flag/marker files found in
+		the ones whose mtime changed since the last snapshot.
+		'''
+		snapshot = dict()
+		for dataset in self._ListDatasets():
+			path = os.path.join(self.root,dataset)
+			try:
+				mtime = os.stat(path).st_mtime
+			except OSError:
+				continue
+			previous = self._poll_state.get(dataset)
+			if previous is not None and previous[0] == mtime:
+				snapshot[dataset] = previous
+				continue
+			flags = set()
+			for pattern in self.flag_names + [self.marker_prefix + '*']:
+				flags.update(os.path.basename(x) for x in glob(os.path.join(path,pattern)))
+			snapshot[dataset] = (mtime,frozenset(flags))
+		return snapshot
+
+	def _WaitPoll(self,timeout):
+		deadline = time.time() + max(0.,timeout)
+		while True:
+			snapshot = self._PollSnapshot()
+			changed = set()
+			for dataset in set(snapshot) | set(self._poll_state):
+				old = self._poll_state.get(dataset)
+				new = snapshot.get(dataset)
+				if old is None or new is None:
+					changed.add(dataset)
+					if new is None:
+						self._ignored.pop(dataset,None)
+				elif [name for name in old[1] ^ new[1] if not self._IsIgnored(dataset,name)]:
+					changed.add(dataset)
+			self._poll_state = snapshot
+			if changed:
+				return changed
+
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return changed
+			time.sleep(min(self.poll_interval,remaining))
+
+	def Close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
@@ -19,16 +19,135 @@ For each dat dataset folder, it will:
 20141011 TB  - Implemented the deletion of files in sets with delete_dat_files flag set prior to transfer.
 20141103 TB  - The code now attempts to make sure that the final rsync has started.
 20150410 TB  - I updated the dataset deletion logic to also check for no_dp and no_event_build flags before deletion.
+20261017 - SyncFolders gets the status of all submitted transfers with one bulk query per pass.
+20261017 - Rebuilt GlobusDaemon around a per-dataset state machine. The waits that used to be
+				time.sleep calls inside a pass (flag grace period, straggler wait before deletion,
+				final rsync retries) are now timers in a DeadlineScheduler.
+20261017 - start_daemon waits on a DatasetWatcher (inotify, or polling as a fallback) so new
+				flag files and transfer markers are acted on right away.
+20261017 - Flags and transfer markers are read from a per-dataset index (one scandir pass,
+				cached by directory mtime) instead of globbing each dataset five times.
+20261017 - Dataset/task life cycle is kept in a SQLite state store (GlobusStateStore_PyMod) so
+				a restarted daemon resumes without re-querying finished tasks. Marker files are
+				still written.
+20261017 - Datasets are deleted in-process by GlobusDelete_PyMod.DeleteTree (parallel unlinks,
+				optional rate limit, throughput report) instead of `rm -r`.
+20261017 - In-flight transfers are polled on an adaptive cadence (AdaptivePoller) based on
+				their observed transfer rate instead of every sleep_time_sec.
+20261017 - Datasets that become ready in a pass are submitted together in batched transfer tasks.
+20261017 - Pass, rsync, delete and life cycle latency metrics (GlobusMetrics_PyMod), exposed as a
+				Prometheus text file or local endpoint, plus a JSONL event log.
+20261017 - The rsync executable is configurable (rsync_command), e.g. for GlobusBenchmark_PyMod.
+20261017 - CLI work in a pass goes out concurrently through GlobusExecutor_PyMod: status chunks
+				and single-task fallbacks at once, resubmissions of failed tasks alongside the
+				new submissions, and endpoint reanimation in the background.
+20261017 - The final rsync and the deletion run on a background CleanupQueue (GlobusCleanup_PyMod),
+				several datasets at a time. The rsync output is streamed with deadlines and its
+				progress recorded as bytes/s. A dataset is only deleted once its final rsync
+				succeeded; after max_cleanup_retries failures it is left as cleanup-failed.
+20261017 - Datasets are submitted, and flagged ones deleted, once quiescence_snapshots manifest
+				snapshots in a row (GlobusManifest_PyMod) show no change, instead of after a fixed
+				sleep_time_sec*2 straggler wait. Finished transfers can optionally be checked
+				against the destination (sizes, or parallel checksums) before cleanup.
+20261017 - Endpoint credentials are tracked by an EndpointHealthCache (GlobusEndpoint_PyMod):
+				checked every endpoint_check_sec and reactivated in the background before they
+				expire. Submissions wait while an endpoint is known to be down instead of
+				failing, and failures share one reactivation. The Globus user is now the
+				globus_user argument instead of 'lux' everywhere.
+20261017 - Optional shard (GlobusSupervisor_PyMod.DatasetShard): the daemon only works on the
+				datasets it holds a lease for, so several workers can share a source root.
+20261017 - Submissions go through a SubmissionQueue: best first by data age, size or flags,
+				with aging so nothing starves, and at most max_in_flight_tasks transfer tasks
+				running. Queued datasets take the slots of tasks as they finish.
+20261017 - Globus is reached through a GlobusTransport (GlobusTransport_PyMod) picked with the
+				transport argument: the hosted CLI over ssh ('cli', as before) or the Transfer
+				REST API over keep-alive HTTP connections ('rest', transport_options).
+20261017 - A dataset whose directory is gone, found at startup or when it is forgotten, is
+				closed in the state store instead of being resumed after every restart.
+20261017 - UpdatePolling: don't count UNKNOWN or non-ACTIVE statuses as zero progress
+20261017 - A transfer task is registered with the poller once, sized by all its datasets, and
+				its status is fed to the poller once per pass instead of once per dataset
+20261017 - A dataset sent again after a failed verify loses its old globus_transfer_<id> marker,
+				and a queued dataset no longer picks up a leftover marker as its task
+20261017 - The quiescence snapshots are sleep_time_sec apart by default (quiescence_interval_sec
+				None), and a dataset already queued for submission is not walked again every pass
+20261017 - A failed task held back while an endpoint is down is queued for resubmission once
+				(pending_resubmissions is keyed by transfer_id), not again every pass
+20261017 - InspectDataset checks a transfer in flight only when the poller says it is due, and
+				the watcher ignores the globus_transfer_<id> markers the daemon writes itself
+20261017 - The quiescence snapshots are 5 s apart by default instead of sleep_time_sec, so a
+				submission waits seconds for a settled dataset rather than minutes
 '''
 
 import os
-import subprocess
 import datetime
 import time
 import re
 import sys
-from glob import glob
-from GlobusTransferTools_PyMod import SubmitGlobusTransfer,GlobusTransferStatus,RunGlobusConnect
+from collections import OrderedDict
+from GlobusTransferTools_PyMod import CacheTransferDetails,PackTransferBatches
+from GlobusTransport_PyMod import GlobusTransport,MakeTransport
+from GlobusEndpoint_PyMod import EndpointHealthCache
+from GlobusExecutor_PyMod import GetExecutor,WaitAll
+from GlobusScheduler_PyMod import DeadlineScheduler,AdaptivePoller,SubmissionQueue
+from GlobusWatch_PyMod import DatasetWatcher
+from GlobusDatasetIndex_PyMod import DatasetIndexCache
+from GlobusStateStore_PyMod import GlobusStateStore
+from GlobusDelete_PyMod import DeleteTree
+from GlobusCleanup_PyMod import CleanupQueue,RunRsync
+from GlobusManifest_PyMod import ManifestTracker,VerifyDataset
+from GlobusMetrics_PyMod import Observe,Increment,SetGauge,RemoveGauge,ClearGauge,LogEvent,SetEventLog,WritePrometheusFile,StartMetricsServer
+
+# Dataset states
+WAITING_FOR_DATA = 'waiting-for-data'
+SUBMITTED = 'submitted'
+ACTIVE = 'active'
+CLEANUP_PENDING = 'cleanup-pending'
+CLEANUP_FAILED = 'cleanup-failed'
+DELETING = 'deleting'
+FREED = 'freed'
+GONE = 'gone' # directory disappeared before it was freed
+
+# States in which a dataset is in the hands of the cleanup timers/queue (or
+# waiting for someone to look at it) and left alone by the passes
+CLEANUP_STATES = (CLEANUP_PENDING,CLEANUP_FAILED,DELETING)
+
+# Timers a dataset can have pending in GlobusDaemon.scheduler
+DATASET_TIMERS = ('inspect','cleanup','delete')
+
+def _AsCount(value):
+	# Counts from the CLI are ints unless the CLI printed something odd
+	if isinstance(value,(int,long)):
+		return value
+	return 0
+
+class DatasetState:
+	'''
+	Where one lux10* dataset is in its life cycle.
+	'''
+
+	def __init__(self,name,on_change=None):
+		self.name = name
+		self.state = WAITING_FOR_DATA
+		self.transfer_id = None
+		self.globus_status = None
+		self.bytes_transferred = None
+		self.first_seen = time.time()
+		self.state_since = self.first_seen
+		# Life cycle timestamps for the latency metrics
+		self.complete_time = None
+		self.submit_time = None
+		self.succeeded_time = None
+		self.cleanup_attempts = 0
+		# Called with this object whenever the state changes
+		self.on_change = on_change
+
+	def SetState(self,state):
+		if state != self.state:
+			self.state = state
+			self.state_since = time.time()
+			if self.on_change is not None:
+				self.on_change(self)
 
 class GlobusDaemon:
 	'''
@@ -43,7 +162,9 @@ class GlobusDaemon:
 		incoming_data_complete_flag_name,outgoing_transfer_done_flag_name,globus_source_path_root = '/',
 		globus_destination_path_root = '/', delete_dat_files_flag_name='delete_dat_files', 
 		no_dp_flag_name='no_dp', no_event_build_flag_name='no_event_build', 
-		execute_delete_dat_files=False):
+		execute_delete_dat_files=False, watch_mode='auto', state_db_path=None,
+		metrics_file=None, metrics_port=None, event_log=None, globus_user='lux', shard=None,
+		submit_order='age', transport='cli', transport_options=None):
 
 		# Clean up the input
 		if source_data_dir[0] == '~':
@@ -60,6 +181,15 @@ class GlobusDaemon:
 		self.globus_source = globus_source
 		self.globus_destination = globus_destination
 		self.globus_local_command = globus_local_command
+		self.globus_user = globus_user
+		# How Globus is reached (GlobusTransport_PyMod): 'cli' for the hosted
+		# CLI over ssh, 'rest' for the Transfer API (transport_options are the
+		# GlobusRESTTransport arguments, e.g. base_url and token), or a
+		# GlobusTransport
+		if isinstance(transport,GlobusTransport):
+			self.transport = transport
+		else:
+			self.transport = MakeTransport(transport,globus_user,**(transport_options or dict()))
 		self.destination_user = destination_user
 		self.destination_address = destination_address
 		self.destination_data_dir = destination_data_dir
@@ -72,6 +202,21 @@ class GlobusDaemon:
 		self.no_event_build_flag_name = no_event_build_flag_name
 		# Find out if the user wants to delete the dat files if the flag is set
 		self.execute_delete_dat_files = execute_delete_dat_files
+		# How to notice new flag files: 'auto' (inotify, else polling), 'inotify',
+		# 'poll' or 'off' (plain listdir every sleep_time_sec)
+		self.watch_mode = watch_mode
+		self.watcher = None
+		# Metrics in Prometheus text format: written to metrics_file after every
+		# pass and/or served on localhost:metrics_port. event_log is a JSONL file.
+		self.metrics_file = metrics_file
+		self.metrics_port = metrics_port
+		if event_log:
+			SetEventLog(event_log)
+
+		# One-pass, mtime-cached index of the flags in each dataset
+		self.index_cache = DatasetIndexCache(self.source_data_dir_raw,
+			[incoming_data_complete_flag_name,delete_dat_files_flag_name,no_dp_flag_name,no_event_build_flag_name],
+			size_flag=incoming_data_complete_flag_name)
 
 		self.source = '%s/%s/' % (globus_source,source_data_dir)
 		self.destination = '%s/%s/' % (globus_destination,destination_data_dir)
@@ -79,7 +224,130 @@ class GlobusDaemon:
 		# Constants
 		self.sleep_time_sec = 2*60 # 2 mins
 		self.rsync_timeout = 90
+		self.rsync_command = 'rsync'
+		# The final rsync is killed after rsync_deadline_sec, or when it has
+		# printed nothing for rsync_timeout seconds
+		self.rsync_deadline_sec = 30*60
 		self.wait_for_delete_dat_files_flag = 10
+		self.max_cleanup_retries = 2
+		self.safety_poll_sec = 15*60 # full pass when watching and nothing is in flight
+		# Dataset deletion: unlink threads and optional rate limits (None = no limit)
+		# so deleting doesn't starve the live DAQ writes
+		self.delete_workers = 8
+		self.delete_max_files_per_sec = None
+		self.delete_max_bytes_per_sec = None
+
+		# Final rsyncs and deletions run in the background, cleanup_workers at
+		# a time. The main loop checks on them every cleanup_poll_sec.
+		self.cleanup_workers = 4
+		self.cleanup_poll_sec = 1
+		self.cleanup_queue = CleanupQueue(self.cleanup_workers)
+
+		# A dataset is submitted (or, if flagged, deleted) once this many
+		# manifest snapshots taken quiescence_interval_sec apart are identical,
+		# i.e. after a 10 s window by default. The snapshots are taken on
+		# 'inspect' timers, not by the pass.
+		self.quiescence_snapshots = 3
+		self.quiescence_interval_sec = 5
+		self.manifests = ManifestTracker(self.source_data_dir_raw,
+			['globus_transfer_*',outgoing_transfer_done_flag_name])
+
+		# Optionally check the .dat files of a finished transfer against the
+		# destination (over ssh) before cleaning up: sizes, and checksums
+		# computed on checksum_workers threads if verify_checksums is set
+		self.verify_destination = False
+		self.verify_checksums = False
+		self.checksum_workers = 4
+		self.destination_ssh_command = 'ssh'
+
+		# Datasets ready to be submitted are sent in batches at the end of a pass
+		self.submit_max_datasets = 20
+		self.submit_max_bytes = 2e12 # 2 TB
+		self.submit_batch_window_sec = 5
+		# Failed tasks to resubmit: transfer_id -> its datasets, oldest first
+		self.pending_resubmissions = OrderedDict()
+
+		# ... best first, while fewer than max_in_flight_tasks transfer tasks
+		# are running (None for no limit). submit_order is 'age' (oldest data
+		# first), 'size' (smallest first) or 'fifo'. Every second a dataset
+		# waits adds a second to its priority, and flagged datasets (whose
+		# data is dropped further down the chain) count an hour younger.
+		self.max_in_flight_tasks = 10
+		self.submission_queue = SubmissionQueue(submit_order,aging_weight=1.,
+			flag_priority={delete_dat_files_flag_name:-3600,no_dp_flag_name:-3600})
+		self.resubmitted_ids = set()
+		# Next poll of every task whose status was fed to the poller this
+		# pass: the other datasets in the same task reuse it
+		self.polled_transfers = dict()
+
+		# Deadline for the concurrent CLI calls of a pass
+		self.cli_timeout = 5*60
+
+		# Credential status of both endpoints, cached for endpoint_ttl_sec and
+		# checked in the background every endpoint_check_sec. Credentials with
+		# less than endpoint_refresh_margin_sec left are renewed ahead of time.
+		# Submissions held back by an inactive endpoint are retried after
+		# endpoint_retry_sec.
+		self.endpoint_ttl_sec = 5*60
+		self.endpoint_check_sec = 5*60
+		self.endpoint_refresh_margin_sec = 12*3600
+		self.endpoint_retry_sec = 60
+		self.endpoints = EndpointHealthCache(globus_user,
+			{globus_source:globus_local_command,globus_destination:None},
+			self.endpoint_ttl_sec,self.endpoint_refresh_margin_sec,self.cli_timeout,self.transport)
+
+		# When several workers share the source root (GlobusSupervisor_PyMod),
+		# the DatasetShard of this one: only datasets it holds a lease for are
+		# looked at. Membership is checked at least every shard_refresh_sec.
+		self.shard = shard
+		self.shard_refresh_sec = 30
+
+		# Per-dataset state machines and the timers that drive them
+		self.datasets = dict()
+		self.scheduler = DeadlineScheduler()
+
+		# Status checks of in-flight transfers follow their observed rate
+		self.poll_slack_sec = 5 # poll tasks that are due this soon in the same pass
+		self.poller = AdaptivePoller(min_interval=15,max_interval=30*60,default_interval=self.sleep_time_sec)
+
+		# Dataset/task life cycle survives restarts in a SQLite file, by
+		# default a hidden file in the source root
+		if state_db_path is None:
+			state_db_path = os.path.join(self.source_data_dir_raw,'.globus_daemon_state.sqlite')
+		self.state_store = GlobusStateStore(state_db_path,self.source_data_dir_raw)
+		self.LoadState()
+
+	def LoadState(self):
+		'''
+		Pick up where a previous run left off: the datasets not freed yet,
+		their transfer tasks, and the details of tasks that already finished
+		(so those are never asked for again).
+		'''
+		resumed_bytes = dict()
+		for row in self.state_store.GetOpenDatasets():
+			# Removed while the daemon was down: close it for good
+			if not os.path.isdir(self.DatasetPathRaw(row['dataset'])):
+				self.state_store.RecordGone(row['dataset'],GONE)
+				continue
+			if self.shard is not None and not self.shard.Claim(row['dataset']):
+				continue
+			state = self.NewDatasetState(row['dataset'])
+			state.transfer_id = row['transfer_id']
+			state.globus_status = row['globus_status']
+			state.bytes_transferred = row['bytes_transferred']
+			if row['details']:
+				CacheTransferDetails(row['details'])
+			# Cleanup and deletion are redone from the start
+			if row['state'] in (SUBMITTED,ACTIVE):
+				state.state = row['state']
+				if row['bytes'] is not None:
+					resumed_bytes[row['transfer_id']] = resumed_bytes.get(row['transfer_id'],0) + row['bytes']
+				else:
+					resumed_bytes.setdefault(row['transfer_id'],None)
+			self.datasets[row['dataset']] = state
+		# Check on these right away
+		for (transfer_id,n_bytes) in resumed_bytes.iteritems():
+			self.poller.Register(transfer_id,n_bytes,delay=0)
 
 	def start_daemon(self):
 		print '*** INITIALIZING SYNC ***'
@@ -87,153 +355,705 @@ class GlobusDaemon:
 		print '%s' % time.ctime()
 		print '-------------------------'
 
-		# Loop forever
+		if self.metrics_port:
+			StartMetricsServer(self.metrics_port)
+			print 'Serving metrics on localhost:%d' % self.metrics_port
+
+		watcher = self.watcher = self.StartWatcher()
+		self.CheckEndpoints()
+
+		# Loop forever. A sync pass runs every PassInterval() seconds, deferred
+		# actions (deletions, cleanup retries, ...) run as soon as they are due
+		# and flag files showing up wake the loop right away.
+		next_pass = 0.
 		while True:
-			self.SyncFolders()
-			# Chill for a bit when there are no data sets to transfer
-			time.sleep(self.sleep_time_sec)
+			if time.time() >= next_pass:
+				self.SyncFolders()
+				next_pass = time.time() + self.PassInterval(watcher)
+
+			self.scheduler.RunDue()
+			self.cleanup_queue.ProcessCompleted()
+
+			# Chill until the next pass or the next timer, whichever comes first
+			wait = next_pass - time.time()
+			time_until_timer = self.scheduler.TimeUntilNext()
+			if time_until_timer is not None:
+				wait = min(wait,time_until_timer)
+			if self.cleanup_queue.Pending():
+				wait = min(wait,self.cleanup_poll_sec)
+			if wait <= 0:
+				continue
+
+			if watcher is None:
+				time.sleep(wait)
+				continue
+
+			changed = watcher.Wait(wait)
+			if changed is None or [d for d in changed if d not in self.datasets
+				and (self.shard is None or self.shard.MapsTo(d))]:
+				# New dataset (or lost events): do a full pass now
+				next_pass = 0.
+			else:
+				for d in changed:
+					if not self.scheduler.IsScheduled((d,'inspect')):
+						self.InspectDataset(d)
+
+	def StartWatcher(self):
+		'''
+		Set up change detection on the source root according to watch_mode.
+		Returns None if the daemon should just poll every sleep_time_sec.
+		'''
+		if not self.watch_mode or self.watch_mode == 'off':
+			return None
+		flag_names = [self.incoming_data_complete_flag_name,self.delete_dat_files_flag_name,
+			self.no_dp_flag_name,self.no_event_build_flag_name]
+		watcher = DatasetWatcher(self.source_data_dir_raw,'lux10',flag_names,'globus_transfer_',mode=self.watch_mode)
+		print 'Watching %s for changes (%s)' % (self.source_data_dir_raw,watcher.mode)
+		return watcher
+
+	def PassInterval(self,watcher):
+		'''
+		Time until the next full pass. Without a watcher that is every
+		sleep_time_sec; with one, new files are noticed by the watcher and the
+		pass is just a safety net. Either way the pass comes early when the
+		AdaptivePoller says an in-flight transfer is due for a status check.
+		'''
+		if watcher is None:
+			interval = self.sleep_time_sec
+		else:
+			interval = self.safety_poll_sec
+
+		time_until_poll = self.poller.TimeUntilNextPoll()
+		if time_until_poll is not None:
+			interval = min(interval,time_until_poll)
+		if self.shard is not None:
+			# Notice workers coming and going
+			interval = min(interval,self.shard_refresh_sec)
+		return interval
 
 	def SyncFolders(self):
+		'''
+		One pass over all datasets. Nothing in here sleeps: anything that has
+		to wait is handed to self.scheduler as a timer.
+		'''
 
-		# Get list of all dat folders
-		dataset_list_temp = os.listdir(self.source_data_dir_raw)
+		pass_start = time.time()
 
-		# Clean up dat folders.
-		dataset_list = [x for x in dataset_list_temp if x[:5]=='lux10' and os.path.isdir(self.source_data_dir_raw+'/'+x)]
+		# Get list of all dat folders
+		dataset_list = self.ListDatasets()
+		self.UpdateDatasetStates(dataset_list)
 
 		# If there are no datasets in existence...
 		if not dataset_list:
 			print '%s: Currently nothing to do...' % time.ctime()
+			self.RecordPassMetrics(pass_start)
 			return
 
-		# Make sure than any and all delete_dat_files flags have time to be written/transfered
-		time.sleep(self.wait_for_delete_dat_files_flag)
-		
+		# Leave out datasets whose delete_dat_files flags may still be on their
+		# way (their 'inspect' timer will pick them up) and datasets already
+		# handed over to a cleanup or delete timer.
+		ready_list = [d for d in dataset_list if not self.scheduler.IsScheduled((d,'inspect'))
+			and self.datasets[d].state not in CLEANUP_STATES]
+
+		# Transfers in flight are only checked when their polling cadence says so
+		now = time.time()
+		ready_list = [d for d in ready_list if self.datasets[d].state not in (SUBMITTED,ACTIVE)
+			or self.poller.IsDue(self.datasets[d].transfer_id,now,self.poll_slack_sec)]
+
+		# Get the status of every submitted transfer in one round trip
+		all_transfer_details = self.GetAllTransferDetails(ready_list)
+		self.resubmitted_ids = set()
+		self.polled_transfers = dict()
+
 		# Loop for every datasets
+		for d in ready_list:
+			self.AdvanceDataset(d,all_transfer_details)
+
+		# Everything that became ready for Globus in this pass goes out together
+		self.SubmitPending()
+
+		self.RecordPassMetrics(pass_start)
+
+	def RecordPassMetrics(self,pass_start):
+		'''
+		Pass duration, datasets per state and in-flight tasks, then write out
+		the metrics file if one is configured.
+		'''
+		pass_seconds = time.time() - pass_start
+		Observe('globus_sync_pass_seconds',pass_seconds)
+
+		counts = dict()
+		for state in self.datasets.values():
+			counts[state.state] = counts.get(state.state,0) + 1
+		ClearGauge('globus_datasets')
+		for (state,count) in counts.iteritems():
+			SetGauge('globus_datasets',count,state=state)
+		SetGauge('globus_in_flight_tasks',len(self.poller.tasks))
+		LogEvent('pass',seconds=pass_seconds,datasets=counts)
+
+		if self.metrics_file:
+			WritePrometheusFile(self.metrics_file)
+
+	def ListDatasets(self):
+
+		# Get list of all dat folders
+		dataset_list = self.index_cache.ListDatasets('lux10')
+
+		# Only the ones leased to this worker
+		if self.shard is not None:
+			self.shard.Refresh(self.BusyDatasets())
+			dataset_list = self.shard.Filter(dataset_list)
+		return dataset_list
+
+	def BusyDatasets(self):
+		'''
+		Datasets in the middle of cleanup or deletion, which this worker keeps
+		even if the shard moves them to another one.
+		'''
+		return set([d for (d,state) in self.datasets.iteritems()
+			if state.state in CLEANUP_STATES or self.cleanup_queue.InFlight(d)])
+
+	def UpdateDatasetStates(self,dataset_list):
+		'''
+		Start tracking new datasets and forget the ones that are gone.
+		'''
 		for d in dataset_list:
+			if d not in self.datasets:
+				self.datasets[d] = self.NewDatasetState(d)
+				# Make sure than any and all delete_dat_files flags have time to be written/transfered
+				self.scheduler.Schedule(self.wait_for_delete_dat_files_flag,(d,'inspect'),self.InspectDataset,d)
 
-			print '\n\nLooking at dataset %s' % d
-			sys.stdout.flush()
-
-			# Build source and destination paths
-			self.source_dataset_fullpath = '%s/%s' % (self.source_data_dir,d)
-			# specify the full path for cleanup
-			self.source_dataset_fullpath_raw = '%s/%s' % (self.source_data_dir_raw,d)
-
-			# Check if acquisition is done
-			incoming_transfer_done_flag = self.CheckIncomingTransferDone(d)
-			#
-			#----------------------------- DAT set deletion
-			# The function will go to the next dataset if the current one is 
-			# set for deletion or was deleted
-			if self.RunDatDeletion(d, incoming_transfer_done_flag): continue
-			#-----------------------------
-			#
-			# We want to wait until all files have been transferred.
-			# Otherwise DO NOTHING for this dataset
-			# If it's done getting here, then...
-			if incoming_transfer_done_flag:
-
-				# Check if this job has already been submitted.
-				# An empty transfer_id means it has not been submitted.
-				transfer_id = self.GetGlobusTaskID(d)
+		for d in self.datasets.keys():
+			if d not in dataset_list:
+				self.ForgetDataset(d)
 
-				# If this dataset has been submitted to Globus
-				if transfer_id:
+	def NewDatasetState(self,dataset):
+		return DatasetState(dataset,self.RecordDatasetState)
+
+	def GetDatasetState(self,dataset):
+		if dataset not in self.datasets:
+			self.datasets[dataset] = self.NewDatasetState(dataset)
+		return self.datasets[dataset]
+
+	def RecordDatasetState(self,state):
+		self.state_store.RecordState(state.name,state.state)
+
+	def RecordTransferStatus(self,dataset,globus_transfer_details):
+		'''
+		Keep the state store up to date with a task's status (only written
+		when the status or byte count moved).
+		'''
+		state = self.GetDatasetState(dataset)
+		if state.globus_status == globus_transfer_details['status'] and \
+			state.bytes_transferred == globus_transfer_details['bytes_transferred']:
+			return
+		state.globus_status = globus_transfer_details['status']
+		state.bytes_transferred = globus_transfer_details['bytes_transferred']
+		self.state_store.RecordTransferStatus(dataset,globus_transfer_details)
+		LogEvent('status',dataset=dataset,transfer_id=globus_transfer_details['transfer_id'],
+			status=state.globus_status,bytes_transferred=state.bytes_transferred)
+
+	def RecordSubmission(self,dataset,transfer_id,transfer_label):
+		index = self.GetDatasetIndex(dataset)
+		n_bytes = index.TotalBytes() if index is not None else None
+		self.state_store.RecordSubmission(dataset,transfer_id,transfer_label,n_bytes)
+		state = self.GetDatasetState(dataset)
+		state.transfer_id = transfer_id
+		state.globus_status = 'SUBMITTED'
+		state.submit_time = time.time()
+		if state.complete_time is not None:
+			Observe('globus_dataset_latency_seconds',state.submit_time - state.complete_time,stage='complete_to_submit')
+		LogEvent('submitted',dataset=dataset,transfer_id=transfer_id,label=transfer_label,bytes=n_bytes)
+
+	def RegisterTransfer(self,transfer_id):
+		'''
+		Start polling a newly submitted task, once, sized by all the
+		datasets that went out in it.
+		'''
+		self.poller.Register(transfer_id,self.TransferBytes(transfer_id))
+
+	def TransferBytes(self,transfer_id):
+		'''
+		Total size of the datasets in a transfer task, None if none is known.
+		'''
+		sizes = [index.TotalBytes() for index in map(self.GetDatasetIndex,self.DatasetsForTransfer(transfer_id))
+			if index is not None and index.TotalBytes() is not None]
+		if not sizes:
+			return None
+		return sum(sizes)
+
+	def UpdatePolling(self,dataset,globus_transfer_details):
+		'''
+		Feed a task's progress to the AdaptivePoller (or stop polling it once
+		it is finished), once per pass however many of our datasets are in
+		it. Returns the seconds until its next status check.
+		'''
+		transfer_id = globus_transfer_details['transfer_id']
+		if transfer_id in self.polled_transfers:
+			return self.polled_transfers[transfer_id]
+		if globus_transfer_details['status'] in ('SUCCEEDED','COMPLETE','FAILED'):
+			self.poller.Forget(transfer_id)
+			RemoveGauge('globus_transfer_bytes_per_second',transfer_id=transfer_id)
+			next_poll = None
+		# An UNKNOWN status (the call failed) or a task that isn't running
+		# says nothing about progress: counting it as zero bytes would back
+		# off and skew the rate once real numbers come back
+		elif globus_transfer_details['status'] != 'ACTIVE' or globus_transfer_details['bytes_transferred'] is None:
+			next_poll = self.poller.Defer(transfer_id)
+		else:
+			next_poll = self.poller.Update(transfer_id,_AsCount(globus_transfer_details['bytes_transferred']),
+				_AsCount(globus_transfer_details['files']),self.TransferBytes(transfer_id))
+			rate = self.poller.GetThroughput(transfer_id)
+			if rate is not None:
+				SetGauge('globus_transfer_bytes_per_second',rate,transfer_id=transfer_id)
+		self.polled_transfers[transfer_id] = next_poll
+		return next_poll
+
+	def GetTransferThroughput(self,dataset):
+		'''
+		(bytes/s, ETA in seconds) of a dataset's transfer, None where unknown.
+		'''
+		state = self.datasets.get(dataset)
+		if state is None or not state.transfer_id:
+			return None, None
+		return self.poller.GetThroughput(state.transfer_id), self.poller.GetETA(state.transfer_id)
+
+	def ForgetDataset(self,dataset):
+		for action in DATASET_TIMERS:
+			self.scheduler.Cancel((dataset,action))
+		state = self.datasets.pop(dataset,None)
+		self.manifests.Forget(dataset)
+		self.submission_queue.Remove(dataset)
+		# Stop polling a task none of our datasets are in any more (e.g. it
+		# went to another worker)
+		if state is not None and state.transfer_id and not self.DatasetsForTransfer(state.transfer_id):
+			self.poller.Forget(state.transfer_id)
+		gone = not os.path.isdir(self.DatasetPathRaw(dataset))
+		if gone:
+			self.state_store.RecordGone(dataset,GONE)
+		if self.shard is not None:
+			self.shard.Release(dataset,remove=gone)
+
+	def DatasetPathRaw(self,dataset):
+		return '%s/%s' % (self.source_data_dir_raw,dataset)
+
+	def InspectDataset(self,dataset):
+		'''
+		Timer callback: look at a single dataset outside of the regular pass.
+		'''
+		if dataset not in self.datasets or not os.path.isdir(self.DatasetPathRaw(dataset)):
+			self.ForgetDataset(dataset)
+			return
+		state = self.datasets[dataset]
+		if state.state in CLEANUP_STATES:
+			return
+		# A transfer in flight is only checked when the poller says so, the
+		# same as in the pass
+		if state.state in (SUBMITTED,ACTIVE) and state.transfer_id \
+			and not self.poller.IsDue(state.transfer_id,time.time(),self.poll_slack_sec):
+			return
+		self.resubmitted_ids = set()
+		self.polled_transfers = dict()
+		self.AdvanceDataset(dataset,self.GetAllTransferDetails([dataset]))
+
+		# Give other datasets that become ready around now a chance to go
+		# out in the same batch
+		if (self.pending_resubmissions or (self.submission_queue and self.FreeTaskSlots() != 0)) \
+			and not self.scheduler.IsScheduled((None,'submit')):
+			self.scheduler.Schedule(self.submit_batch_window_sec,(None,'submit'),self.SubmitPending)
+
+	def AdvanceDataset(self,d,all_transfer_details):
+		'''
+		Move dataset d one step along its state machine:
+		waiting-for-data -> submitted -> active -> cleanup-pending -> deleting
+		'''
+
+		print '\n\nLooking at dataset %s' % d
+		sys.stdout.flush()
+
+		state = self.GetDatasetState(d)
+
+		# Build source and destination paths
+		self.source_dataset_fullpath = '%s/%s' % (self.source_data_dir,d)
+		# specify the full path for cleanup
+		self.source_dataset_fullpath_raw = self.DatasetPathRaw(d)
+
+		# Check if acquisition is done
+		incoming_transfer_done_flag = self.CheckIncomingTransferDone(d)
+		#
+		#----------------------------- DAT set deletion
+		# Go to the next dataset if the current one is set for deletion or
+		# was scheduled for deletion
+		if self.RunDatDeletion(d, incoming_transfer_done_flag): return
+		#-----------------------------
+		#
+		# We want to wait until all files have been transferred.
+		# Otherwise DO NOTHING for this dataset
+		if incoming_transfer_done_flag and state.complete_time is None:
+			state.complete_time = time.time()
+			LogEvent('data_complete',dataset=d)
+		if not incoming_transfer_done_flag:
+			state.SetState(WAITING_FOR_DATA)
+			print "Skipping %s for now, it's not done syncing to %s (could not find %s)\nTransfer will begin when all files are in %s..." % (d,self.globus_source,self.incoming_data_complete_flag_name, self.globus_source)
+			return
 
-					print "%s: Dataset %s, transfer task found: %s" % (time.ctime(),d,transfer_id)
+		# Check if this job has already been submitted.
+		# An empty transfer_id means it has not been submitted.
+		transfer_id = self.GetGlobusTaskID(d)
 
-					# Get the transfer details for this ID
-					globus_transfer_details = GlobusTransferStatus(transfer_id)
+		# If this dataset has been submitted to Globus
+		if transfer_id:
 
-					self.PrintTransferDetails(globus_transfer_details)
+			print "%s: Dataset %s, transfer task found: %s" % (time.ctime(),d,transfer_id)
+			state.transfer_id = transfer_id
 
-					# If it's done, write flag and clean up
-					if (globus_transfer_details['status'] == 'COMPLETE') or (globus_transfer_details['status'] == 'SUCCEEDED'):
+			# Already resubmitted in this pass along with another dataset of its batch
+			if transfer_id in self.resubmitted_ids:
+				print 'Transfer task was just resubmitted'
+				return
 
-						# Once the previous while loop is happy, finish it off by:
-						# 	(1) Write the rsync_done_flag
-						#	(2) rsync --remove-source-files   (this will sync .log and rsync_done_flag for the first time)
-						print '%s: Transfer %s done, writing flag, syncing log and deleting sources!' % (time.ctime(),d)
+			# Failed and already waiting to be resubmitted (held back while an
+			# endpoint is down, say): once is enough
+			if transfer_id in self.pending_resubmissions:
+				print 'Transfer task is waiting to be resubmitted'
+				return
 
-						# Write sync done flag
-						os.system('touch %s/%s' % (self.source_dataset_fullpath_raw,self.outgoing_transfer_done_flag_name))
+			# Get the transfer details for this ID. Fall back to a single
+			# query if it was missing from the bulk answer.
+			globus_transfer_details = all_transfer_details.get(transfer_id)
+			if globus_transfer_details is None:
+				globus_transfer_details = self.transport.Status(transfer_id)
 
-						# rsync with --remove-source-files and delete folder
-						self.CleanUpAndDelete(d)
+			self.PrintTransferDetails(globus_transfer_details)
+			self.RecordTransferStatus(d,globus_transfer_details)
+			next_poll = self.UpdatePolling(d,globus_transfer_details)
 
-					# If it's still ongoing, just print status info
-					elif globus_transfer_details['status'] == 'ACTIVE':
-						print 'Transfer task currently active'
+			# If it's done, write flag and hand it to the cleanup timer
+			if (globus_transfer_details['status'] == 'COMPLETE') or (globus_transfer_details['status'] == 'SUCCEEDED'):
 
-					# If it failed, resubmit!
-					elif globus_transfer_details['status'] == 'FAILED':
-						print '*** Transfer failed. Details:'
+				# Once the transfer is happy, finish it off by:
+				# 	(1) Write the rsync_done_flag
+				#	(2) rsync --remove-source-files   (this will sync .log and rsync_done_flag for the first time)
+				print '%s: Transfer %s done, writing flag, syncing log and deleting sources!' % (time.ctime(),d)
 
-						print 'Resubmitting transfer with the same ID...'
-						# Re-submit!
-						transfer_id, transfer_label = SubmitGlobusTransfer(self.source, self.destination, d, 'lux', transfer_id)
-						print transfer_id
-						if transfer_id and (transfer_id != -1):
-							print 'Resubmitted successfully!'
-						else:
-							print '*** ERROR: Could not submit job. There may be a problem with one of the endpoints (check that Globus is running and credentials have not expired).'
-							# Try to activate the endpoint
-							RunGlobusConnect(self.globus_source,self.globus_local_command,'lux')
+				if state.succeeded_time is None:
+					state.succeeded_time = time.time()
+					if state.submit_time is not None:
+						Observe('globus_dataset_latency_seconds',state.succeeded_time - state.submit_time,stage='submit_to_succeeded')
 
-					else:
-						print 'Not sure what to do here... (unknown status)'
+				state.SetState(CLEANUP_PENDING)
+				if self.verify_destination:
+					# Check what arrived first, the flag is written after that
+					self.scheduler.Schedule(0,(d,'cleanup'),self.VerifyTransfer,d)
+				else:
+					# Write sync done flag
+					os.system('touch %s/%s' % (self.source_dataset_fullpath_raw,self.outgoing_transfer_done_flag_name))
 
-				# If it has not been submitted to Globus, do so!
+					# rsync with --remove-source-files and delete folder
+					self.scheduler.Schedule(0,(d,'cleanup'),self.CleanUpAndDelete,d)
+
+			# If it's still ongoing, just print status info
+			elif globus_transfer_details['status'] == 'ACTIVE':
+				state.SetState(ACTIVE)
+				(rate,eta) = self.GetTransferThroughput(d)
+				if rate is not None:
+					print 'Transfer task currently active (%.1f MB/s, ETA %s), next check in %d s' % (rate/1e6,
+						'%d s' % eta if eta is not None else 'unknown',next_poll)
 				else:
+					print 'Transfer task currently active, next check in %d s' % next_poll
+
+			# If it failed, resubmit!
+			elif globus_transfer_details['status'] == 'FAILED':
+				print '*** Transfer failed. Details:'
+
+				# The task may carry other datasets too: resubmit all of them
+				# together, at the end of the pass with the new submissions
+				self.resubmitted_ids.add(transfer_id)
+				self.pending_resubmissions[transfer_id] = self.DatasetsForTransfer(transfer_id)
+				print 'Transfer will be resubmitted...'
+
+			else:
+				print 'Not sure what to do here... (unknown status)'
+
+		# If it has not been submitted to Globus, do so! (at the end of the
+		# pass, batched with the other datasets that are ready)
+		else:
+			# Already found settled: no need to walk it again every pass
+			if d in self.submission_queue:
+				return
+			# Only once nothing in the dataset has changed for a while
+			if not self.CheckQuiescent(d):
+				# Changing again: not ready after all
+				self.submission_queue.Remove(d)
+				return
+			self.QueueSubmission(d)
+
+	def CheckQuiescent(self,dataset):
+		'''
+		Take a manifest snapshot of the dataset if one is due. True once
+		quiescence_snapshots snapshots in a row matched; otherwise the
+		dataset is looked at again (an 'inspect' timer) when the next
+		snapshot is due.
+		'''
+		if self.quiescence_snapshots <= 1:
+			return True
+		interval = self.quiescence_interval_sec
+		try:
+			stable = self.manifests.Snapshot(dataset,interval)
+		except OSError:
+			return False
+		if stable >= self.quiescence_snapshots:
+			return True
+
+		print '%s: %d of %d matching snapshots, waiting for it to settle' % (dataset,stable,self.quiescence_snapshots)
+		if not self.scheduler.IsScheduled((dataset,'inspect')):
+			self.scheduler.Schedule(self.manifests.TimeUntilNextSnapshot(dataset,interval),
+				(dataset,'inspect'),self.InspectDataset,dataset)
+		return False
+
+	def DatasetsForTransfer(self,transfer_id):
+		'''
+		All known datasets that went out in the given transfer task.
+		'''
+		return sorted([d for d,state in self.datasets.iteritems() if state.transfer_id == transfer_id])
+
+	def DatasetTime(self,dataset):
+		'''
+		When a dataset's data was taken, from its name (lux10_20141010T1200),
+		or else when the daemon first saw it.
+		'''
+		match = re.search(r'(\d{8}T\d{4})',dataset)
+		if match is not None:
+			try:
+				return time.mktime(time.strptime(match.group(1),'%Y%m%dT%H%M'))
+			except ValueError:
+				pass
+		return self.GetDatasetState(dataset).first_seen
+
+	def QueueSubmission(self,dataset):
+		'''
+		Queue a dataset that is ready for Globus, along with what its
+		priority depends on.
+		'''
+		index = self.GetDatasetIndex(dataset)
+		flags = []
+		if index is not None:
+			flags = [f for f in (self.delete_dat_files_flag_name,self.no_dp_flag_name,self.no_event_build_flag_name)
+				if index.HasFlag(f)]
+		self.submission_queue.Add(dataset,self.DatasetTime(dataset),
+			index.TotalBytes() if index is not None else None,flags)
+
+	def InFlightTasks(self):
+		return set([state.transfer_id for state in self.datasets.values()
+			if state.state in (SUBMITTED,ACTIVE) and state.transfer_id])
+
+	def FreeTaskSlots(self):
+		'''
+		How many more transfer tasks may be started, None if there's no limit.
+		'''
+		if self.max_in_flight_tasks is None:
+			return None
+		return max(0,self.max_in_flight_tasks - len(self.InFlightTasks()))
+
+	def TakeSubmissions(self):
+		'''
+		Take the best queued datasets that fit in the free task slots out of
+		the queue. Returns them best first, and their queue entries (to put
+		them back if the submission fails).
+		'''
+		for d in [d for d in self.submission_queue.entries if d not in self.datasets]:
+			self.submission_queue.Remove(d)
+		free_slots = self.FreeTaskSlots()
+		if not self.submission_queue or free_slots == 0:
+			return [], dict()
 
-					# Submit to Globus
-					transfer_id, transfer_label = SubmitGlobusTransfer(self.source, self.destination, d, 'lux')
+		ordered = self.submission_queue.Ordered()
+		dataset_bytes = dict([(d,entry['bytes']) for (d,entry) in self.submission_queue.entries.iteritems()])
+		batches = PackTransferBatches(ordered,self.submit_max_datasets,self.submit_max_bytes,dataset_bytes)
+		if free_slots is not None:
+			batches = batches[:free_slots]
 
-					if transfer_id and (transfer_id != -1):
+		datasets = [d for batch in batches for d in batch]
+		entries = self.submission_queue.Take(datasets)
+		now = time.time()
+		for d in datasets:
+			Observe('globus_submission_wait_seconds',now - entries[d]['queued'])
+		return datasets, entries
+
+	def SubmitPending(self):
+		'''
+		Submit the best datasets queued by AdvanceDataset that fit in the free
+		transfer task slots, packed into as few tasks as submit_max_datasets/
+		submit_max_bytes allow, and resubmit the failed tasks, all at the
+		same time. Whatever doesn't fit stays queued for the slots of the
+		tasks that finish next.
+		'''
+		self.scheduler.Cancel((None,'submit'))
+		resubmissions = self.pending_resubmissions.items()
+		self.pending_resubmissions = OrderedDict()
+		if not self.submission_queue and not resubmissions:
+			return
+
+		# Don't submit to an endpoint whose credential is known to be gone:
+		# hold everything back until it has been reactivated
+		down = [e for e in (self.globus_source,self.globus_destination) if not self.endpoints.IsHealthy(e)]
+		if down:
+			print '%s: %s not active, holding back %d submissions' % (time.ctime(),', '.join(down),len(self.submission_queue) + len(resubmissions))
+			for endpoint in down:
+				self.endpoints.Reactivate(endpoint)
+			self.pending_resubmissions = OrderedDict(resubmissions + self.pending_resubmissions.items())
+			self.scheduler.Schedule(self.endpoint_retry_sec,(None,'submit'),self.SubmitPending)
+			return
+
+		# Resubmissions keep the slot of the task they replace, new tasks
+		# only get the free ones
+		(datasets,entries) = self.TakeSubmissions()
+		free_slots = self.FreeTaskSlots()
+		SetGauge('globus_free_task_slots',free_slots if free_slots is not None else -1)
+		SetGauge('globus_submission_queue',len(self.submission_queue))
+		if self.submission_queue:
+			print '%s: %d datasets wait for a free transfer task slot (%d tasks in flight)' % (time.ctime(),
+				len(self.submission_queue),len(self.InFlightTasks()))
+
+		# Re-submit!
+		executor = GetExecutor()
+		futures = [executor.SubmitTimed(self.cli_timeout,self.transport.SubmitTask,self.source,self.destination,batch,transfer_id)
+			for (transfer_id,batch) in resubmissions]
+
+		failed = False
+		if datasets:
+			dataset_bytes = dict()
+			for d in datasets:
+				if entries[d]['bytes']:
+					dataset_bytes[d] = entries[d]['bytes']
+
+			# Submit to Globus
+			results = self.transport.SubmitBatch(self.source, self.destination, datasets,
+				self.submit_max_datasets, self.submit_max_bytes, dataset_bytes)
+
+			for (transfer_id, transfer_label, batch) in results:
+				if transfer_id and (transfer_id != -1):
+					for d in batch:
 						print '%s: Submitted dataset %s with transfer ID %s' % (time.ctime(),d,transfer_id)
 						# Write the transfer_id flag in the directory
-						os.system('touch %s/globus_transfer_%s' % (self.source_dataset_fullpath_raw,transfer_id))
-					else:
-						print '*** ERROR: Could not submit job. There may be a problem with one of the endpoints (check that Globus is running and credentials have not expired).'
-
-						# Try to activate the endpoint
-						RunGlobusConnect(self.globus_source,self.globus_local_command,'lux')
-						
+						self.WriteTransferMarker(d,transfer_id)
+						self.RecordSubmission(d,transfer_id,transfer_label)
+						self.GetDatasetState(d).SetState(SUBMITTED)
+					self.RegisterTransfer(transfer_id)
+				else:
+					print '*** ERROR: Could not submit %s. There may be a problem with one of the endpoints (check that Globus is running and credentials have not expired).' % ', '.join(batch)
+					# Back in line where they were
+					self.submission_queue.Return(dict([(d,entries[d]) for d in batch]))
+					failed = True
 
-			# It's not done syncing, leave it alone for now
+		WaitAll(futures)
+		for ((old_transfer_id,batch),future) in zip(resubmissions,futures):
+			(transfer_id,transfer_label) = (-1,-1)
+			if future.exc_info is None and future.result is not None:
+				(transfer_id,transfer_label) = future.result
+			if transfer_id and (transfer_id != -1):
+				for b in batch:
+					# The REST API gives the resubmitted task a new ID
+					if transfer_id != old_transfer_id:
+						self.WriteTransferMarker(b,transfer_id,old_transfer_id)
+					self.RecordSubmission(b,transfer_id,transfer_label)
+					self.GetDatasetState(b).SetState(SUBMITTED)
+				self.RegisterTransfer(transfer_id)
+				print 'Resubmitted %s successfully!' % transfer_id
 			else:
-				print "Skipping %s for now, it's not done syncing to %s (could not find %s)\nTransfer will begin when all files are in %s..." % (d,self.globus_source,self.incoming_data_complete_flag_name, self.globus_source)
+				print '*** ERROR: Could not resubmit %s (%s). There may be a problem with one of the endpoints (check that Globus is running and credentials have not expired).' % (old_transfer_id,', '.join(batch))
+				failed = True
+
+		if failed:
+			# Try to activate the endpoint
+			self.ReanimateEndpoint()
+
+	def ReanimateEndpoint(self):
+		'''
+		A submission failed: check both endpoints again and reactivate the
+		ones that need it. This runs in the background so the pass doesn't
+		wait on it, and joins any reactivation already in flight.
+		'''
+		for endpoint in (self.globus_source,self.globus_destination):
+			self.endpoints.ReportFailure(endpoint)
+
+	def CheckEndpoints(self):
+		'''
+		Periodic background check of the endpoints' credentials, renewing
+		them before they expire.
+		'''
+		self.endpoints.RefreshDue()
+		self.scheduler.Schedule(self.endpoint_check_sec,(None,'endpoints'),self.CheckEndpoints)
+
+	def GetAllTransferDetails(self,dataset_list):
+		'''
+		Query the status of all submitted, complete datasets at once.
+		Returns a dictionary transfer_id -> transfer details.
+		'''
+		transfer_ids = []
+		for d in dataset_list:
+			if self.CheckIncomingTransferDone(d):
+				transfer_id = self.GetGlobusTaskID(d)
+				if transfer_id:
+					transfer_ids.append(transfer_id)
+
+		if not transfer_ids:
+			return dict()
 
-		# Once all folders have been inspected/acted on, sleep for a bit
-		print 'Sleeping for %d seconds' % self.sleep_time_sec
-		time.sleep(self.sleep_time_sec)			
+		all_transfer_details = self.transport.StatusBulk(transfer_ids)
+
+		# Ask for the tasks missing from the bulk answer one by one, all at once
+		missing = sorted(set([t for t in transfer_ids if t not in all_transfer_details]))
+		executor = GetExecutor()
+		futures = [executor.SubmitTimed(self.cli_timeout,self.transport.Status,transfer_id) for transfer_id in missing]
+		WaitAll(futures,self.cli_timeout)
+		for (transfer_id,future) in zip(missing,futures):
+			if future.Done() and future.exc_info is None and future.result is not None:
+				all_transfer_details[transfer_id] = future.result
+
+		return all_transfer_details
+
+	def GetDatasetIndex(self,dataset):
+		'''
+		Flags, transfer marker and file counts of a dataset from one scandir
+		pass, cached until the directory changes. None if the dataset is gone.
+		'''
+		try:
+			return self.index_cache.Get(dataset)
+		except OSError:
+			self.index_cache.Invalidate(dataset)
+			return None
 
 	def GetGlobusTaskID(self,dataset):
+		# Already known from this run or from the state store
+		if dataset in self.datasets and self.datasets[dataset].transfer_id:
+			return self.datasets[dataset].transfer_id
+
+		# Queued to be (re)submitted: whatever marker is left belongs to an
+		# earlier task
+		if dataset in self.submission_queue:
+			return None
+
 		# Initialize
 		transfer_id = None
 
 		# See if any globus task ID file is in the folder
-		globus_task_id_file_wildcard = '%s/%s/globus_transfer_*' % (self.source_data_dir_raw,dataset)
-		task_id_file = glob(globus_task_id_file_wildcard)
+		index = self.GetDatasetIndex(dataset)
 
 		# If you found one, get the task ID and return it
-		if task_id_file:
-			transfer_id = re.findall('\w{8}-\w{4}-\w{4}-\w{4}-\w{12}$',task_id_file[0])[0]
+		if index is not None:
+			transfer_id = index.transfer_id
 
 		return transfer_id
 
 	def CheckIncomingTransferDone(self,dataset):
 
-		# Re-doing here so that the function can be called without running the main loop
-		source_dataset_fullpath_raw = '%s/%s/' % (self.source_data_dir_raw,dataset)
-
-		# Get flag status tuple
-		# Using glob here instead of os.path.isfile since glob can use * wildcards, which are used for daquiri transfers
-		incoming_data_complete_flag = glob(source_dataset_fullpath_raw + "/" + self.incoming_data_complete_flag_name)
+		# Get flag status from the dataset index. The flag name can have *
+		# wildcards, which are used for daquiri transfers
+		index = self.GetDatasetIndex(dataset)
 
 		# Check if incoming data is finished syncing
-		if incoming_data_complete_flag:
+		if index is not None and index.HasFlag(self.incoming_data_complete_flag_name):
 			return 1
 		else:
 			return 0
@@ -244,14 +1064,15 @@ class GlobusDaemon:
 		no_dp flags to make sure the deletion can happen on LOC.
 		"""
 
-		# Re-doing here so that the function can be called without running the main loop
-		source_dataset_fullpath_raw = '%s/%s/' % (self.source_data_dir_raw,dataset)
+		# Get flag status from the dataset index. The flag names can have *
+		# wildcards, which are used for daquiri transfers
+		index = self.GetDatasetIndex(dataset)
+		if index is None:
+			return 0
 
-		# Get flag status tuple
-		# Using glob here instead of os.path.isfile since glob can use * wildcards, which are used for daquiri transfers
-		delete_dat_files_flag = glob(source_dataset_fullpath_raw + "/" + self.delete_dat_files_flag_name)
-		no_dp_flag = glob(source_dataset_fullpath_raw + "/" + self.no_dp_flag_name)
-		no_event_build_flag = glob(source_dataset_fullpath_raw + "/" + self.no_event_build_flag_name)
+		delete_dat_files_flag = index.HasFlag(self.delete_dat_files_flag_name)
+		no_dp_flag = index.HasFlag(self.no_dp_flag_name)
+		no_event_build_flag = index.HasFlag(self.no_event_build_flag_name)
 		
 		# Check if delete_dat_files flag is present
 		if delete_dat_files_flag and no_dp_flag and no_event_build_flag:
@@ -277,11 +1098,14 @@ class GlobusDaemon:
 				# computer in the chain. Also, go on copying the rest of the
 				# data sets while this one finish transfering here. 
 				if incoming_transfer_done_flag:
-					# Set has nominally finished transfering. But wait a little
-					# bit to make sure we get the stragglers
-					print 'DAT files in set %s will be deleted in %.1f seconds' %(d, self.sleep_time_sec*2.)
-					time.sleep(self.sleep_time_sec*2)
-					os.system("rm -r %s" % self.source_dataset_fullpath_raw)
+					# Set has nominally finished transfering. But make sure we
+					# get the stragglers: only delete once the dataset has
+					# stopped changing. Until then CheckQuiescent keeps looking
+					# from a timer so the other datasets keep moving.
+					if not self.scheduler.IsScheduled((d,'delete')) and self.CheckQuiescent(d):
+						print 'DAT files in set %s will be deleted now' %(d)
+						self.GetDatasetState(d).SetState(DELETING)
+						self.scheduler.Schedule(0,(d,'delete'),self.DeleteDataset,d)
 					return True		# success. Go to the next dataset
 				else:
 					# the set to be deleted hasn't transfered yet.
@@ -295,6 +1119,140 @@ class GlobusDaemon:
 		
 		return False
 
+	def DeleteDataset(self,dataset):
+		'''
+		Timer callback: remove a DAT set marked with delete_dat_files.
+		'''
+		print '%s: Deleting DAT files in set %s' % (time.ctime(),dataset)
+		self.RemoveDataset(dataset)
+
+	def RemoveDataset(self,dataset):
+		'''
+		Hand a dataset directory to the parallel deletion engine on the
+		cleanup queue. FinishRemoval records the result.
+		'''
+		self.GetDatasetState(dataset).SetState(DELETING)
+		self.cleanup_queue.Submit(dataset,DeleteTree,(self.DatasetPathRaw(dataset),self.delete_workers,
+			self.delete_max_files_per_sec,self.delete_max_bytes_per_sec),self.FinishRemoval)
+
+	def FinishRemoval(self,dataset,stats,error):
+		'''
+		Cleanup queue callback: report how fast the disk was freed and stop
+		tracking the dataset.
+		'''
+		if error is not None:
+			print '*** ERROR: Could not delete %s: %s' % (dataset,error)
+			Increment('globus_delete_errors_total')
+			self.GetDatasetState(dataset).SetState(CLEANUP_FAILED)
+			return
+		print 'Deleted %s' % stats
+		if stats.errors:
+			print '*** WARNING: %d files could not be deleted, e.g. %s: %s' % (len(stats.errors),stats.errors[0][0],stats.errors[0][1])
+		self.state_store.RecordFreed(dataset,FREED)
+
+		Observe('globus_delete_seconds',stats.seconds)
+		Increment('globus_deleted_files_total',stats.files)
+		Increment('globus_deleted_bytes_total',stats.bytes)
+		Increment('globus_delete_errors_total',len(stats.errors))
+		state = self.datasets.get(dataset)
+		if state is not None:
+			freed_time = time.time()
+			if state.succeeded_time is not None:
+				Observe('globus_dataset_latency_seconds',freed_time - state.succeeded_time,stage='succeeded_to_freed')
+			if state.complete_time is not None:
+				Observe('globus_dataset_latency_seconds',freed_time - state.complete_time,stage='complete_to_freed')
+		LogEvent('freed',dataset=dataset,files=stats.files,bytes=stats.bytes,seconds=stats.seconds,
+			errors=len(stats.errors))
+		self.ForgetDataset(dataset)
+		print '*'*40 + '\nFinished %s!\n' % dataset + '*'*40
+
+	def VerifyTransfer(self,dataset):
+		'''
+		Timer callback: compare the dataset's .dat files with the destination
+		on the cleanup queue. FinishVerify takes it from there.
+		'''
+		print 'Checking %s against %s:%s' % (dataset,self.destination_address,self.destination_data_dir_raw)
+		self.cleanup_queue.Submit(dataset,VerifyDataset,(self.DatasetPathRaw(dataset),self.destination_user,
+			self.destination_address,'%s/%s' % (self.destination_data_dir_raw,dataset),'*.dat',self.verify_checksums,
+			self.checksum_workers,self.destination_ssh_command),self.FinishVerify)
+
+	def FinishVerify(self,dataset,problems,error):
+		'''
+		Cleanup queue callback: clean up a dataset that arrived intact, have
+		Globus go over it again if it didn't.
+		'''
+		if dataset not in self.datasets:
+			return
+		state = self.datasets[dataset]
+		if error is None and not problems:
+			print '%s verified at the destination' % dataset
+			# Write sync done flag
+			os.system('touch %s/%s' % (self.DatasetPathRaw(dataset),self.outgoing_transfer_done_flag_name))
+			self.CleanUpAndDelete(dataset)
+			return
+
+		Increment('globus_verify_failures_total')
+		state.cleanup_attempts += 1
+		if error is not None:
+			print '*** ERROR: Could not check %s against the destination: %s' % (dataset,error)
+			if state.cleanup_attempts <= self.max_cleanup_retries:
+				self.scheduler.Schedule(self.rsync_timeout,(dataset,'cleanup'),self.VerifyTransfer,dataset)
+			else:
+				state.SetState(CLEANUP_FAILED)
+			return
+
+		print '*** %s is incomplete at the destination (%d problems), e.g. %s' % (dataset,len(problems),problems[0])
+		LogEvent('verify_failed',dataset=dataset,problems=len(problems))
+		if state.cleanup_attempts > self.max_cleanup_retries:
+			print '*** ERROR: Giving up on %s after %d attempts. The dataset is NOT deleted.' % (dataset,state.cleanup_attempts)
+			state.SetState(CLEANUP_FAILED)
+			return
+		# Send it again in a task of its own, the other datasets of its task
+		# may be gone from the source by now (sync level 3 only copies what
+		# differs). The old task's marker goes, or the dataset would be
+		# taken for finished again.
+		self.RemoveTransferMarkers(dataset)
+		state.transfer_id = None
+		state.SetState(WAITING_FOR_DATA)
+		self.QueueSubmission(dataset)
+		self.SubmitPending()
+
+	def WriteTransferMarker(self,dataset,transfer_id,old_transfer_id=None):
+		'''
+		Mark a dataset as sent in transfer_id: a new globus_transfer_<id>
+		file, or old_transfer_id's renamed. The watcher is told not to wake
+		up for either.
+		'''
+		path = self.DatasetPathRaw(dataset)
+		if self.watcher is not None:
+			self.watcher.Ignore(dataset,'globus_transfer_%s' % transfer_id)
+		if old_transfer_id is not None:
+			if self.watcher is not None:
+				self.watcher.Ignore(dataset,'globus_transfer_%s' % old_transfer_id)
+			try:
+				os.rename('%s/globus_transfer_%s' % (path,old_transfer_id),'%s/globus_transfer_%s' % (path,transfer_id))
+				return
+			except OSError:
+				pass
+		os.system('touch %s/globus_transfer_%s' % (path,transfer_id))
+
+	def RemoveTransferMarkers(self,dataset):
+		'''
+		Delete the globus_transfer_<id> markers of a dataset's earlier tasks.
+		'''
+		index = self.GetDatasetIndex(dataset)
+		if index is None:
+			return
+		for name in index.names:
+			if name.startswith('globus_transfer_'):
+				if self.watcher is not None:
+					self.watcher.Ignore(dataset,name)
+				try:
+					os.remove('%s/%s' % (self.DatasetPathRaw(dataset),name))
+				except OSError, e:
+					print '*** ERROR: Could not remove %s/%s: %s' % (self.DatasetPathRaw(dataset),name,e)
+		self.index_cache.Invalidate(dataset)
+
 	def CleanUpAndDelete(self,dataset):
 		#
 		"""# Sync one last time with --remove-source-files
@@ -307,51 +1265,64 @@ class GlobusDaemon:
 		# "/bin/sh: /bin/rm: Argument list too long"
 		# error. Hence below I remove the set recursively.
 		#
-		# but first sync up any remaining flags, but not dat files
-		rsync_command_cleanup = \
-			"rsync --remove-source-files -aP --timeout=%s --exclude='*.dat' --exclude='.*' --progress %s %s@%s:%s/"\
-				% (self.rsync_timeout, self.source_dataset_fullpath_raw, self.destination_user, \
-				self.destination_address, self.destination_data_dir_raw)
+		source_dataset_fullpath_raw = self.DatasetPathRaw(dataset)
+		#
+		# but first sync up any remaining flags, but not dat files. This runs
+		# on the cleanup queue, FinishCleanupRsync takes it from there.
+		rsync_command_cleanup = [self.rsync_command,'--remove-source-files','-aP','--timeout=%d' % self.rsync_timeout,
+			'--exclude=*.dat','--exclude=.*','--progress',source_dataset_fullpath_raw,
+			'%s@%s:%s/' % (self.destination_user,self.destination_address,self.destination_data_dir_raw)]
 		print 'final rsync command:'
-		print rsync_command_cleanup
-		p = subprocess.Popen(rsync_command_cleanup, stdout=subprocess.PIPE, shell=True)
-		rsync_read_loop_counter = 0
-		rsync_failure_counter = 0
-		while True:
-			line = p.stdout.readline()
-			if line: 
-				print '.',
-				rsync_read_loop_counter += 1
-			else:
-				if rsync_read_loop_counter > 0 or rsync_failure_counter > 1:
-					print ' '
-					if rsync_failure_counter > 1:
-						print 'We had an issue with the rsync. The sync flag may not have been transfered.'
-					break
-				else:
-					# We get here if rsync start was delayed. Then the first
-					# readline() returns nothing and the code skipps to the 
-					# here. In the past, the directory would be deleted and 
-					# the sync flag would not be transfered. We deal with this
-					# here. 
-					# wait here instead
-					print 'rsync did not seem to be initiated in time. Wait a bit.'
-					rsync_failure_counter += 1
-					time.sleep(self.rsync_timeout)
-		# remove the transfered directory
-		print 'recursively delete the dataset'
-		command_rm = "rm -r %s" % self.source_dataset_fullpath_raw
-		p1 = subprocess.Popen(command_rm, stdout=subprocess.PIPE, shell=True)
-		p1.wait()
-		# The below is now useless since the dataset was completally removed. 
-		"""
-		# Delete any remaining hidden files
-		os.system("find %s -name '.*' | xargs -n1 rm" % self.source_dataset_fullpath_raw)
+		print ' '.join(rsync_command_cleanup)
+		self.GetDatasetState(dataset).SetState(CLEANUP_PENDING)
+		self.cleanup_queue.Submit(dataset,RunRsync,(rsync_command_cleanup,self.rsync_deadline_sec,self.rsync_timeout),
+			self.FinishCleanupRsync)
 
-		# Now delete the empty folder, we're done here
-		os.system('rmdir %s' % self.source_dataset_fullpath_raw)
-		"""
-		print '*'*40 + '\nFinished!\n' + '*'*40
+	def FinishCleanupRsync(self,dataset,result,error):
+		'''
+		Cleanup queue callback for the final rsync. The dataset is only
+		deleted if the rsync succeeded; failures are retried from a timer.
+		'''
+		if dataset not in self.datasets:
+			return
+		state = self.datasets[dataset]
+		if error is not None:
+			print '*** ERROR: Final rsync for %s could not run: %s' % (dataset,error)
+			returncode = None
+		else:
+			print 'Final rsync for %s: %s' % (dataset,result)
+			returncode = result.returncode
+			Observe('globus_rsync_seconds',result.seconds)
+			if result.progress.Bytes():
+				Increment('globus_rsync_bytes_total',result.progress.Bytes())
+			rate = result.BytesPerSec()
+			if rate:
+				SetGauge('globus_rsync_bytes_per_second',rate)
+		LogEvent('cleanup_rsync',dataset=dataset,returncode=returncode,
+			timed_out=result.timed_out if result is not None else None,
+			bytes=result.progress.Bytes() if result is not None else None,
+			seconds=result.seconds if result is not None else None)
+
+		if error is None and result.Succeeded():
+			# remove the transfered directory
+			print 'recursively delete the dataset'
+			self.RemoveDataset(dataset)
+			return
+
+		Increment('globus_rsync_errors_total')
+		if result is not None and result.output_tail:
+			print '\n'.join(result.output_tail)
+		# In the past the rsync would sometimes start late and the
+		# directory got deleted before the sync flag was transfered.
+		# Try again later from a timer, and never delete without the flags.
+		state.cleanup_attempts += 1
+		if state.cleanup_attempts <= self.max_cleanup_retries:
+			print 'Retrying the final rsync for %s in %d seconds.' % (dataset,self.rsync_timeout)
+			self.scheduler.Schedule(self.rsync_timeout,(dataset,'cleanup'),self.CleanUpAndDelete,dataset)
+			return
+		print '*** ERROR: The final rsync for %s failed %d times. The dataset is NOT deleted, the sync flag may not have been transfered.' % (dataset,state.cleanup_attempts)
+		Increment('globus_cleanup_failures_total')
+		state.SetState(CLEANUP_FAILED)
 
 	def PrintTransferDetails(self,globus_transfer_details):
 		print '%s' % '-'*36
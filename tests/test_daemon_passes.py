@@ -0,0 +1,181 @@
+'''
+GlobusDaemon passes (SyncGlobus_PyMod) over a scratch source directory, with
+Globus answered by a stub GlobusTransport.
+
+	python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import uuid
+from StringIO import StringIO
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GlobusTransferTools_PyMod as TransferTools
+from GlobusTransport_PyMod import GlobusTransport
+from GlobusExecutor_PyMod import GetExecutor
+from GlobusWatch_PyMod import DatasetWatcher
+from SyncGlobus_PyMod import GlobusDaemon
+
+FAILED_ID = '1d37a2b0-4f2a-11e4-b5ed-12313940394d'
+RESUBMITTED_ID = '5f0b7d42-5a1c-11e4-8d3e-22000a97197b'
+
+class StubTransport(GlobusTransport):
+	'''
+	Every task has the given status; new tasks keep their generated ID,
+	resubmissions get RESUBMITTED_ID. The endpoints' credentials are expired
+	while down is set.
+	'''
+
+	name = 'stub'
+
+	def __init__(self,status='FAILED'):
+		self.user = 'lux'
+		self.status = status
+		self.down = False
+		self.generated = []
+		self.submitted = []
+		self.status_calls = 0
+
+	def GenerateTransferIDs(self,n):
+		transfer_ids = [str(uuid.uuid1()) for i in range(n)]
+		self.generated.extend(transfer_ids)
+		return transfer_ids
+
+	def SubmitTask(self,source,destination,datasets,transfer_id=''):
+		self.submitted.append((transfer_id,list(datasets)))
+		if transfer_id in self.generated:
+			return transfer_id, 'submitted'
+		return RESUBMITTED_ID, 'resubmitted'
+
+	def Status(self,transfer_id):
+		self.status_calls += 1
+		return TransferTools.ParseTransferDetails('Task ID: %s\nStatus: %s\nBytes Transferred: 0' % (transfer_id,self.status),
+			transfer_id)
+
+	def StatusBulk(self,transfer_ids):
+		self.status_calls += 1
+		return dict([(transfer_id,TransferTools.ParseTransferDetails('Task ID: %s\nStatus: %s\nBytes Transferred: 0' % (transfer_id,self.status),
+			transfer_id)) for transfer_id in transfer_ids])
+
+	def EndpointCredentials(self,endpoint):
+		if self.down:
+			return 'EXPIRED', None
+		return 'ACTIVE', 3600*24*10
+
+	def ActivateEndpoint(self,endpoint):
+		return not self.down
+
+class ResubmissionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp(prefix='globus_daemon_test_')
+		self.source = os.path.join(self.work_dir,'src')
+		self.dataset = 'lux10_20261010T1200'
+		path = os.path.join(self.source,self.dataset)
+		os.makedirs(path)
+		for name in ('%s_f000000001.dat' % self.dataset,'done','globus_transfer_%s' % FAILED_ID):
+			open(os.path.join(path,name),'w').close()
+
+		self.transport = StubTransport()
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+		self.daemon = GlobusDaemon('lux#src','lux#dst','true',self.source,'lux','localhost',
+			os.path.join(self.work_dir,'dst'),'done','outdone',watch_mode='off',
+			state_db_path=os.path.join(self.work_dir,'state.sqlite'),transport=self.transport)
+		self.daemon.endpoint_retry_sec = 0
+		self.daemon.wait_for_delete_dat_files_flag = 0
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+		self.daemon.state_store.Close()
+		shutil.rmtree(self.work_dir,True)
+		for transfer_id in (FAILED_ID,RESUBMITTED_ID):
+			TransferTools.ForgetTransferStatus(transfer_id)
+
+	def testHeldBackFailureIsResubmittedOnce(self):
+		# The endpoint is down: the failed task is held back pass after pass
+		self.transport.down = True
+		for i in range(5):
+			self.daemon.SyncFolders()
+			self.daemon.scheduler.RunDue()
+		self.assertEqual(self.transport.submitted,[])
+		self.assertEqual(self.daemon.pending_resubmissions.items(),[(FAILED_ID,[self.dataset])])
+
+		# Back up: it goes out once, for its dataset. A background check
+		# still finishing would put the endpoints back down
+		for future in self.daemon.endpoints.in_flight.values():
+			future.Wait(5)
+		self.transport.down = False
+		self.daemon.endpoints.Invalidate('lux#src')
+		self.daemon.endpoints.Invalidate('lux#dst')
+		self.daemon.SyncFolders()
+		self.daemon.scheduler.RunDue()
+		self.assertEqual(self.transport.submitted,[(FAILED_ID,[self.dataset])])
+		self.assertEqual(len(self.daemon.pending_resubmissions),0)
+		self.assertEqual(self.daemon.datasets[self.dataset].transfer_id,RESUBMITTED_ID)
+		self.assertEqual(sorted(os.listdir(os.path.join(self.source,self.dataset))),
+			['done','globus_transfer_%s' % RESUBMITTED_ID,'%s_f000000001.dat' % self.dataset])
+
+class WatcherTest(unittest.TestCase):
+
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp(prefix='globus_daemon_test_')
+		self.source = os.path.join(self.work_dir,'src')
+		self.datasets = ['lux10_20261010T12%02d' % i for i in range(5)]
+		for dataset in self.datasets:
+			path = os.path.join(self.source,dataset)
+			os.makedirs(path)
+			for name in ('%s_f000000001.dat' % dataset,'done'):
+				open(os.path.join(path,name),'w').close()
+
+		self.transport = StubTransport('ACTIVE')
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+		self.daemon = GlobusDaemon('lux#src','lux#dst','true',self.source,'lux','localhost',
+			os.path.join(self.work_dir,'dst'),'done','outdone',watch_mode='off',
+			state_db_path=os.path.join(self.work_dir,'state.sqlite'),transport=self.transport)
+		self.daemon.wait_for_delete_dat_files_flag = 0
+		self.daemon.submit_batch_window_sec = 0
+		self.daemon.quiescence_snapshots = 1
+		self.daemon.watcher = DatasetWatcher(self.source,'lux10',['done'],'globus_transfer_',mode='poll')
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+		self.daemon.watcher.Close()
+		self.daemon.state_store.Close()
+		shutil.rmtree(self.work_dir,True)
+
+	def testOwnMarkersDontTriggerPolls(self):
+		self.daemon.SyncFolders()
+		for i in range(3):
+			self.daemon.scheduler.RunDue()
+		self.assertEqual(len(self.transport.submitted),1)
+		transfer_id = self.transport.submitted[0][0]
+		self.assertEqual(self.daemon.DatasetsForTransfer(transfer_id),self.datasets)
+		interval = self.daemon.poller.tasks[transfer_id]['interval']
+
+		# The markers just written are the daemon's own: nothing to wake up for
+		self.assertEqual(self.daemon.watcher.Wait(0),set())
+
+		# Nor is the task due for a check when a dataset is looked at anyway
+		self.transport.status_calls = 0
+		for dataset in self.datasets:
+			self.daemon.InspectDataset(dataset)
+		self.assertEqual(self.transport.status_calls,0)
+		self.assertEqual(self.daemon.poller.tasks[transfer_id]['interval'],interval)
+
+		# Somebody else's flag still does
+		open(os.path.join(self.source,self.datasets[2],'delete_dat_files'),'w').close()
+		open(os.path.join(self.source,self.datasets[3],'done'),'w').close()
+		os.remove(os.path.join(self.source,self.datasets[3],'done'))
+		self.assertEqual(self.daemon.watcher.Wait(0),set([self.datasets[3]]))
+
+def tearDownModule():
+	GetExecutor().Shutdown(wait=True)
+
+if __name__ == '__main__':
+	unittest.main()
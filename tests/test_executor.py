@@ -0,0 +1,39 @@
+'''
+GlobusCLIExecutor (GlobusExecutor_PyMod) worker bookkeeping.
+
+	python -m unittest discover -s tests
+'''
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GlobusExecutor_PyMod import GlobusCLIExecutor
+
+class ShutdownTest(unittest.TestCase):
+
+	def testSubmitAfterShutdown(self):
+		executor = GlobusCLIExecutor(max_workers=2)
+		release = threading.Event()
+		busy = executor.Submit(release.wait,5)
+
+		# The worker finishes its call only after Shutdown: it must not be
+		# taken for an idle worker that will pick up the next call
+		executor.Shutdown()
+		release.set()
+		self.assertTrue(busy.Wait(5))
+
+		future = executor.Submit(lambda: 42)
+		self.assertTrue(future.Wait(5))
+		self.assertEqual(future.Result(),42)
+		executor.Shutdown(wait=True)
+
+	def testMap(self):
+		executor = GlobusCLIExecutor(max_workers=3)
+		self.assertEqual(executor.Map(lambda x: x*x,[(i,) for i in range(10)]),[i*i for i in range(10)])
+		executor.Shutdown(wait=True)
+
+if __name__ == '__main__':
+	unittest.main()
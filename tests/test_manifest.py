@@ -0,0 +1,89 @@
+'''
+Manifest snapshots (GlobusManifest_PyMod) of a scratch dataset directory.
+
+	python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GlobusManifest_PyMod import Manifest, ManifestTracker
+
+DATASET = 'lux10_20261010T1200'
+
+class ManifestTest(unittest.TestCase):
+
+	def setUp(self):
+		self.root = tempfile.mkdtemp(prefix='globus_manifest_test_')
+		self.path = os.path.join(self.root,DATASET)
+		os.makedirs(os.path.join(self.path,'slow_control'))
+		# 40 .dat files written an hour ago, and the one being written now
+		hour_ago = time.time() - 3600
+		for i in range(40):
+			self.Write('%s_f%09d.dat' % (DATASET,i),'x'*100)
+			os.utime(os.path.join(self.path,'%s_f%09d.dat' % (DATASET,i)),(hour_ago,hour_ago))
+		self.Write('slow_control/sc.txt','x')
+		os.utime(os.path.join(self.path,'slow_control','sc.txt'),(hour_ago,hour_ago))
+		self.Write('globus_transfer_1d37a2b0-4f2a-11e4-b5ed-12313940394d','')
+		self.Write('%s_f%09d.dat' % (DATASET,40),'x'*10)
+		for relative_dir in ('slow_control','.'):
+			os.utime(os.path.join(self.path,relative_dir),(hour_ago,hour_ago))
+
+	def tearDown(self):
+		shutil.rmtree(self.root,True)
+
+	def Write(self,name,data,mode='w'):
+		f = open(os.path.join(self.path,name),mode)
+		f.write(data)
+		f.close()
+
+	def testFullScan(self):
+		manifest = Manifest(self.path,['globus_transfer_*'])
+		self.assertEqual(manifest.n_files,42)
+		self.assertEqual(manifest.total_bytes,40*100 + 1 + 10)
+		self.assertTrue('slow_control/sc.txt' in manifest.entries)
+
+	def testIncrementalScan(self):
+		first = Manifest(self.path,['globus_transfer_*'])
+
+		# Nothing listed again, only the directories and the file being
+		# written are stat'ed
+		second = Manifest(self.path,['globus_transfer_*'],first)
+		self.assertEqual(second.stat_calls,3)
+		self.assertTrue(second.Matches(first))
+
+		# An append to it is seen
+		self.Write('%s_f%09d.dat' % (DATASET,40),'x'*10,'a')
+		third = Manifest(self.path,['globus_transfer_*'],second)
+		self.assertEqual(third.Diff(second),([],[],['%s_f%09d.dat' % (DATASET,40)]))
+
+		# So is a new file, which changes the directory
+		self.Write('%s_f%09d.dat' % (DATASET,41),'x')
+		fourth = Manifest(self.path,['globus_transfer_*'],third)
+		self.assertEqual(fourth.Diff(third),(['%s_f%09d.dat' % (DATASET,41)],[],[]))
+		self.assertEqual(fourth.entries,Manifest(self.path,['globus_transfer_*']).entries)
+
+	def testTracker(self):
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			tracker = ManifestTracker(self.root,['globus_transfer_*'])
+			self.assertEqual(tracker.Snapshot(DATASET),1)
+			self.assertEqual(tracker.Snapshot(DATASET),2)
+			# Too soon for another snapshot
+			self.assertEqual(tracker.Snapshot(DATASET,60),2)
+			self.Write('%s_f%09d.dat' % (DATASET,40),'x','a')
+			self.assertEqual(tracker.Snapshot(DATASET),1)
+		finally:
+			sys.stdout = stdout
+		self.assertEqual(tracker.snapshots,3)
+		self.assertTrue(tracker.stat_calls < 2*45)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,157 @@
+'''
+GlobusRESTTransport (GlobusTransport_PyMod) against the fake Transfer API of
+GlobusFakeCLI_PyMod, served locally.
+
+	python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GlobusFakeCLI_PyMod as FakeCLI
+from GlobusTransport_PyMod import MakeTransport
+from GlobusTransferTools_PyMod import ForgetTransferStatus
+from GlobusExecutor_PyMod import GetExecutor
+
+TOKEN = 'fake-token'
+SOURCE = None
+DESTINATION = None
+
+_work_dir = None
+_server = None
+
+def setUpModule():
+	global _work_dir, _server, SOURCE, DESTINATION
+	_work_dir = tempfile.mkdtemp(prefix='globus_rest_test_')
+	for dataset in ('lux10_20261010T1200','lux10_20261010T1300','lux10_20261010T1400'):
+		os.makedirs(os.path.join(_work_dir,'src',dataset))
+		f = open(os.path.join(_work_dir,'src',dataset,'%s_f000000001.dat' % dataset),'w')
+		f.write('x'*1000)
+		f.close()
+	SOURCE = 'lux#src/%s/src/' % _work_dir
+	DESTINATION = 'lux#dst/%s/dst/' % _work_dir
+	FakeCLI.ConfigureFakeCLI(os.path.join(_work_dir,'globus'),transfer_sec=60,credential_sec=3600)
+	_server = FakeCLI.StartFakeTransferAPI(token=TOKEN)
+
+def tearDownModule():
+	_server.shutdown()
+	_server.server_close()
+	shutil.rmtree(_work_dir,True)
+	GetExecutor().Shutdown(wait=True)
+
+class RESTTransportTest(unittest.TestCase):
+
+	def setUp(self):
+		self.transport = MakeTransport('rest','lux',base_url=_server.URL(),token=TOKEN,pool_size=2,page_size=2)
+		self.calls = []
+		request = self.transport.Request
+		def CountedRequest(call,*args,**kwargs):
+			self.calls.append(call)
+			return request(call,*args,**kwargs)
+		self.transport.Request = CountedRequest
+
+	def tearDown(self):
+		self.transport.Close()
+
+	def testSubmit(self):
+		(transfer_id,transfer_label) = self.transport.SubmitTask(SOURCE,DESTINATION,
+			['lux10_20261010T1200','lux10_20261010T1300'])
+		self.assertEqual(self.calls,['submission_id','transfer','task_update'])
+		self.assertEqual(len(transfer_id),36)
+		# Labelled after the task ID, like the globus_transfer_<id> marker
+		self.assertEqual(transfer_label,'lux10_20261010T1200_and_1_more_src_dst_%s' % transfer_id[:8])
+
+		details = self.transport.Status(transfer_id)
+		self.assertEqual(details['transfer_id'],transfer_id)
+		self.assertEqual(details['status'],'ACTIVE')
+		self.assertEqual(details['label'],transfer_label)
+		self.assertEqual(details['source_endpoint'],'src')
+		self.assertEqual(details['destination_endpoint'],'dst')
+		self.assertEqual(details['tasks_total'],'2')
+		self.assertEqual(details['directories'],2)
+
+	def testSubmitBatch(self):
+		datasets = ['lux10_20261010T1200','lux10_20261010T1300','lux10_20261010T1400']
+		results = self.transport.SubmitBatch(SOURCE,DESTINATION,datasets,max_datasets=2)
+		self.assertEqual([batch for (transfer_id,transfer_label,batch) in results],
+			[datasets[:2],datasets[2:]])
+		for (transfer_id,transfer_label,batch) in results:
+			self.assertTrue(transfer_label.endswith('_%s' % transfer_id[:8]))
+			self.assertEqual(self.transport.Status(transfer_id)['tasks_total'],str(len(batch)))
+
+	def testResubmitGetsNewTaskID(self):
+		(transfer_id,transfer_label) = self.transport.SubmitTask(SOURCE,DESTINATION,['lux10_20261010T1200'])
+		(new_transfer_id,new_transfer_label) = self.transport.SubmitTask(SOURCE,DESTINATION,
+			['lux10_20261010T1200'],transfer_id)
+		self.assertNotEqual(new_transfer_id,transfer_id)
+		self.assertTrue(new_transfer_label.endswith('_%s' % new_transfer_id[:8]))
+
+	def testMissingTask(self):
+		transfer_id = '2e5a6c10-4f2a-11e4-b5ed-12313940394d'
+		ForgetTransferStatus(transfer_id)
+		details = self.transport.Status(transfer_id)
+		self.assertEqual(details['status'],'UNKNOWN')
+		self.assertEqual(details['transfer_id'],transfer_id)
+
+	def testTaskList(self):
+		transfer_ids = [self.transport.SubmitTask(SOURCE,DESTINATION,[dataset])[0]
+			for dataset in ('lux10_20261010T1200','lux10_20261010T1300','lux10_20261010T1400')]
+		del self.calls[:]
+
+		# Most recent first, over two pages of two
+		task_list = self.transport.TaskList(limit=3)
+		self.assertEqual([details['transfer_id'] for details in task_list],transfer_ids[::-1])
+		self.assertEqual(self.calls,['task_list','task_list'])
+
+		task_list = self.transport.TaskList('task_id:%s' % transfer_ids[1])
+		self.assertEqual([details['transfer_id'] for details in task_list],[transfer_ids[1]])
+
+		all_details = self.transport.StatusBulk(transfer_ids + ['2e5a6c10-4f2a-11e4-b5ed-12313940394d'])
+		self.assertEqual(sorted(all_details),sorted(transfer_ids))
+		self.assertEqual(set([details['status'] for details in all_details.values()]),set(['ACTIVE']))
+
+	def testEndpointActivation(self):
+		(credential_status,time_left) = self.transport.EndpointCredentials('lux#src')
+		self.assertEqual(credential_status,'ACTIVE')
+		self.assertTrue(0 < time_left <= 3600)
+
+		os.environ['GLOBUS_FAKE_CREDENTIAL_SEC'] = '1'
+		try:
+			time.sleep(1.1)
+			self.assertEqual(self.transport.EndpointCredentials('lux#src')[0],'EXPIRED')
+			self.assertTrue(self.transport.ActivateEndpoint('lux#src'))
+			self.assertEqual(self.transport.EndpointCredentials('lux#src')[0],'ACTIVE')
+		finally:
+			os.environ['GLOBUS_FAKE_CREDENTIAL_SEC'] = '3600'
+		self.assertEqual(self.calls,['endpoint','endpoint','autoactivate','endpoint'])
+
+	def testBadToken(self):
+		transport = MakeTransport('rest','lux',base_url=_server.URL(),token='wrong-token')
+		self.assertEqual(transport.SubmitTask(SOURCE,DESTINATION,['lux10_20261010T1200']),(-1,-1))
+		self.assertEqual(transport.EndpointCredentials('lux#src'),(None,None))
+		self.assertRaises(IOError,transport.TaskList)
+		transport.Close()
+
+	def testRetryAfterDroppedConnection(self):
+		self.transport.EndpointCredentials('lux#src')
+		self.assertEqual(self.transport.pool.connections_opened,1)
+
+		# Reused while the server keeps it open
+		self.transport.EndpointCredentials('lux#src')
+		self.assertEqual(self.transport.pool.connections_opened,1)
+
+		# The server closed the idle connection: the call goes out again on
+		# a new one instead of failing
+		_server.DropConnections()
+		(transfer_id,transfer_label) = self.transport.SubmitTask(SOURCE,DESTINATION,['lux10_20261010T1200'])
+		self.assertNotEqual(transfer_id,-1)
+		self.assertEqual(self.transport.pool.connections_opened,2)
+		self.assertEqual(self.transport.Status(transfer_id)['status'],'ACTIVE')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,59 @@
+'''
+GlobusSSHSession (GlobusSession_PyMod) against the fake ssh of
+GlobusFakeCLI_PyMod.
+
+	python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GlobusFakeCLI_PyMod as FakeCLI
+from GlobusSession_PyMod import GlobusSSHSession
+
+class SessionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp(prefix='globus_session_test_')
+		(self.ssh_command,rsync_command) = FakeCLI.WriteFakeCommands(os.path.join(self.work_dir,'bin'))
+		FakeCLI.ConfigureFakeCLI(os.path.join(self.work_dir,'globus'))
+		self.session = GlobusSSHSession('lux',ssh_command=self.ssh_command,
+			control_dir=os.path.join(self.work_dir,'control'))
+
+	def tearDown(self):
+		self.session.Close()
+		shutil.rmtree(self.work_dir,True)
+
+	def testOneMasterForSeveralCalls(self):
+		# The fake master stays in the background holding on to its stdout
+		# and stderr, like older OpenSSH: connecting must not wait for it
+		results = []
+		hung = []
+		def Calls():
+			for i in range(5):
+				if not hung:
+					results.append(self.session.Run(['endpoint-list','lux#src']))
+		t = threading.Thread(target=Calls)
+		t.daemon = True
+		t.start()
+		t.join(10)
+		if t.is_alive():
+			# Let the master go, so the calls can finish
+			hung.append(True)
+			while t.is_alive():
+				if os.path.exists(self.session.control_path):
+					os.remove(self.session.control_path)
+				t.join(0.5)
+		self.assertFalse(hung)
+
+		self.assertEqual([returncode for (out,err,returncode) in results],[0]*5)
+		self.assertEqual(self.session.connections_opened,1)
+		self.assertTrue(self.session.IsAlive())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,207 @@
+'''
+Parsing of recorded Globus CLI output (tests/fixtures) by
+GlobusTransferTools_PyMod.
+
+	python -m unittest discover -s tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GlobusTransferTools_PyMod as TransferTools
+from GlobusExecutor_PyMod import GetExecutor
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+def ReadFixture(name):
+	f = open(os.path.join(FIXTURES,name))
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+class FakeCLI:
+	'''
+	Stands in for RunGlobusCLI: answers each command (its first word)
+	with recorded (stdout,stderr,returncode) and remembers the calls.
+	'''
+
+	def __init__(self,outputs):
+		self.outputs = outputs
+		self.calls = []
+
+	def __call__(self,user,command_args,input=None,timeout=None):
+		self.calls.append(list(command_args))
+		return self.outputs[command_args[0]]
+
+class ParseTransferDetailsTest(unittest.TestCase):
+
+	def testSucceeded(self):
+		details = TransferTools.ParseTransferDetails(ReadFixture('details_succeeded.txt'),
+			'98d0879c-3919-11e4-b5ed-12313940394d')
+		self.assertEqual(details['transfer_id'],'98d0879c-3919-11e4-b5ed-12313940394d')
+		self.assertEqual(details['task_type'],'TRANSFER')
+		self.assertEqual(details['status'],'SUCCEEDED')
+		self.assertEqual(details['completion_time'],'2014-09-10 18:31:05Z')
+		self.assertEqual(details['tasks_total'],'1')
+		self.assertEqual(details['tasks_successful'],'1')
+		self.assertEqual(details['tasks_failed'],'0')
+		self.assertEqual(details['tasks_pending'],'0')
+		self.assertEqual(details['label'],'lux10_20140910T1801_sanford_pdsf_98d0879c')
+		self.assertEqual(details['transfer_name'],details['label'])
+		self.assertEqual(details['source_endpoint'],'sanford')
+		self.assertEqual(details['destination_endpoint'],'pdsf')
+		self.assertEqual(details['files'],4112)
+		self.assertEqual(details['files_skipped'],0)
+		self.assertEqual(details['directories'],1)
+		self.assertEqual(details['bytes_transferred'],134987221504)
+		self.assertEqual(details['faults'],0)
+
+	def testPadded(self):
+		details = TransferTools.ParseTransferDetails(ReadFixture('details_padded.txt'),
+			'5f0b7d42-5a1c-11e4-8d3e-22000a97197b')
+		self.assertEqual(details['status'],'ACTIVE')
+		self.assertEqual(details['completion_time'],'n/a')
+		self.assertEqual(details['tasks_pending'],'2')
+		self.assertEqual(details['label'],'lux10_20141022T0301_and_2_more_sanford_pdsf_5f0b7d42')
+		self.assertEqual(details['source_endpoint'],'sanford')
+		self.assertEqual(details['files_skipped'],12)
+		self.assertEqual(details['bytes_transferred'],51200884736)
+		self.assertEqual(details['faults'],2)
+
+	def testReorderedAndExtraLines(self):
+		lines = ReadFixture('details_succeeded.txt').strip().split('\n')
+		lines.reverse()
+		lines.insert(3,'Some New Field: 42')
+		details = TransferTools.ParseTransferDetails('\n'.join(lines),'98d0879c-3919-11e4-b5ed-12313940394d')
+		self.assertEqual(details['status'],'SUCCEEDED')
+		self.assertEqual(details['bytes_transferred'],134987221504)
+
+	def testEmptyOutput(self):
+		details = TransferTools.ParseTransferDetails('','2e5a6c10-4f2a-11e4-b5ed-12313940394d')
+		self.assertEqual(details['status'],'UNKNOWN')
+		self.assertEqual(details['transfer_id'],'2e5a6c10-4f2a-11e4-b5ed-12313940394d')
+		self.assertEqual(details['bytes_transferred'],None)
+
+class SplitDetailsBlocksTest(unittest.TestCase):
+
+	def testMultiTask(self):
+		blocks = TransferTools.SplitDetailsBlocks(ReadFixture('details_multi.txt'))
+		self.assertEqual(sorted(blocks),['0c8f3f56-4f2a-11e4-b5ed-12313940394d','1d37a2b0-4f2a-11e4-b5ed-12313940394d'])
+		failed = TransferTools.ParseTransferDetails(blocks['1d37a2b0-4f2a-11e4-b5ed-12313940394d'],
+			'1d37a2b0-4f2a-11e4-b5ed-12313940394d')
+		self.assertEqual(failed['status'],'FAILED')
+		self.assertEqual(failed['faults'],14)
+		active = TransferTools.ParseTransferDetails(blocks['0c8f3f56-4f2a-11e4-b5ed-12313940394d'],
+			'0c8f3f56-4f2a-11e4-b5ed-12313940394d')
+		self.assertEqual(active['status'],'ACTIVE')
+		self.assertEqual(active['bytes_transferred'],20401094656)
+
+	def testPadded(self):
+		blocks = TransferTools.SplitDetailsBlocks(ReadFixture('details_padded.txt'))
+		self.assertEqual(blocks.keys(),['5f0b7d42-5a1c-11e4-8d3e-22000a97197b'])
+
+class ParseTaskListTest(unittest.TestCase):
+
+	def testTaskList(self):
+		task_list = TransferTools.ParseTaskList(ReadFixture('task_list.txt'))
+		self.assertEqual([(t['transfer_id'],t['status']) for t in task_list],[
+			('1d37a2b0-4f2a-11e4-b5ed-12313940394d','FAILED'),
+			('0c8f3f56-4f2a-11e4-b5ed-12313940394d','ACTIVE'),
+			('98d0879c-3919-11e4-b5ed-12313940394d','SUCCEEDED')])
+		self.assertEqual(task_list[1]['bytes_transferred'],20401094656)
+		self.assertEqual(task_list[2]['files'],4112)
+		self.assertEqual(task_list[0]['destination_endpoint'],'pdsf')
+		# Not listed by task-list
+		self.assertEqual(task_list[0]['directories'],None)
+
+	def testEmpty(self):
+		self.assertEqual(TransferTools.ParseTaskList(''),[])
+
+class FormatCLIOutputDictTest(unittest.TestCase):
+
+	def testEndpointList(self):
+		endpoint_details = TransferTools.FormatCLIOutputDict(ReadFixture('endpoint_list.txt'))
+		self.assertEqual(endpoint_details['credential_status'],'ACTIVE')
+		self.assertEqual(TransferTools.ParseCredentialTimeLeft(endpoint_details['credential_time_left']),263*3600 + 41*60 + 7)
+
+class TransferStatusTest(unittest.TestCase):
+
+	def setUp(self):
+		self.run_globus_cli = TransferTools.RunGlobusCLI
+		TransferTools._terminal_details_cache.clear()
+
+	def tearDown(self):
+		TransferTools.RunGlobusCLI = self.run_globus_cli
+		TransferTools._terminal_details_cache.clear()
+
+	def testFailedCall(self):
+		TransferTools.RunGlobusCLI = FakeCLI({'details':('',ReadFixture('details_not_found.err'),1)})
+		details = TransferTools.GlobusTransferStatus('2e5a6c10-4f2a-11e4-b5ed-12313940394d')
+		self.assertEqual(details['status'],'UNKNOWN')
+		self.assertEqual(details['transfer_id'],'2e5a6c10-4f2a-11e4-b5ed-12313940394d')
+
+	def testTimedOutCall(self):
+		TransferTools.RunGlobusCLI = FakeCLI({'details':('','Timed out after 300 s',-9)})
+		self.assertEqual(TransferTools.GlobusTransferStatusBulk(['98d0879c-3919-11e4-b5ed-12313940394d']),dict())
+
+	def testFinishedTasksAreCached(self):
+		cli = FakeCLI({'details':(ReadFixture('details_succeeded.txt'),'',0)})
+		TransferTools.RunGlobusCLI = cli
+		first = TransferTools.GlobusTransferStatus('98d0879c-3919-11e4-b5ed-12313940394d')
+		second = TransferTools.GlobusTransferStatus('98d0879c-3919-11e4-b5ed-12313940394d')
+		self.assertEqual(first,second)
+		self.assertEqual(len(cli.calls),1)
+		TransferTools.ForgetTransferStatus('98d0879c-3919-11e4-b5ed-12313940394d')
+		TransferTools.GlobusTransferStatus('98d0879c-3919-11e4-b5ed-12313940394d')
+		self.assertEqual(len(cli.calls),2)
+
+	def testActiveTasksAreNotCached(self):
+		cli = FakeCLI({'details':(ReadFixture('details_padded.txt'),'',0)})
+		TransferTools.RunGlobusCLI = cli
+		TransferTools.GlobusTransferStatus('5f0b7d42-5a1c-11e4-8d3e-22000a97197b')
+		TransferTools.GlobusTransferStatus('5f0b7d42-5a1c-11e4-8d3e-22000a97197b')
+		self.assertEqual(len(cli.calls),2)
+
+	def testBulkLeavesOutMissingTasks(self):
+		cli = FakeCLI({'details':(ReadFixture('details_multi.txt'),ReadFixture('details_not_found.err'),0)})
+		TransferTools.RunGlobusCLI = cli
+		all_details = TransferTools.GlobusTransferStatusBulk(['0c8f3f56-4f2a-11e4-b5ed-12313940394d',
+			'1d37a2b0-4f2a-11e4-b5ed-12313940394d','0c8f3f56-4f2a-11e4-b5ed-12313940394d',
+			'2e5a6c10-4f2a-11e4-b5ed-12313940394d'])
+		self.assertEqual(cli.calls,[['details','0c8f3f56-4f2a-11e4-b5ed-12313940394d',
+			'1d37a2b0-4f2a-11e4-b5ed-12313940394d','2e5a6c10-4f2a-11e4-b5ed-12313940394d']])
+		self.assertEqual(sorted([(t,d['status']) for (t,d) in all_details.items()]),[
+			('0c8f3f56-4f2a-11e4-b5ed-12313940394d','ACTIVE'),('1d37a2b0-4f2a-11e4-b5ed-12313940394d','FAILED')])
+
+		# The FAILED one is final now and isn't asked about again
+		TransferTools.GlobusTransferStatusBulk(['0c8f3f56-4f2a-11e4-b5ed-12313940394d','1d37a2b0-4f2a-11e4-b5ed-12313940394d'])
+		self.assertEqual(cli.calls[-1],['details','0c8f3f56-4f2a-11e4-b5ed-12313940394d'])
+
+class TaskListTest(unittest.TestCase):
+
+	def setUp(self):
+		self.run_globus_cli = TransferTools.RunGlobusCLI
+
+	def tearDown(self):
+		TransferTools.RunGlobusCLI = self.run_globus_cli
+
+	def testTaskList(self):
+		cli = FakeCLI({'task-list':(ReadFixture('task_list.txt'),'',0)})
+		TransferTools.RunGlobusCLI = cli
+		task_list = TransferTools.GlobusTaskList(limit=3,filter='task_id:1d37a2b0-4f2a-11e4-b5ed-12313940394d')
+		self.assertEqual(cli.calls,[['task-list','-l','3','--filter','task_id:1d37a2b0-4f2a-11e4-b5ed-12313940394d']])
+		self.assertEqual([t['status'] for t in task_list],['FAILED','ACTIVE','SUCCEEDED'])
+
+	def testFailedCall(self):
+		TransferTools.RunGlobusCLI = FakeCLI({'task-list':('','Error: Timed out',1)})
+		self.assertRaises(IOError,TransferTools.GlobusTaskList)
+
+def tearDownModule():
+	# Let the bulk calls' worker threads go before the interpreter does
+	GetExecutor().Shutdown(wait=True)
+
+if __name__ == '__main__':
+	unittest.main()